@@ -0,0 +1,28 @@
+from __future__ import print_function
+import sys, timeit
+from wormhole import ipaddrs
+
+# Run this as 'python misc/bench-addresses.py [COUNT]' to compare the ways
+# we find our own IP addresses when building direct hints: forking 'ip' or
+# 'ifconfig' (what we always used to do), asking the kernel in-process with
+# getifaddrs(), and the cached answer that most callers now get.
+
+
+def main(count=100):
+    count = int(count)
+    ways = [("ip/ifconfig", ipaddrs._query_commands),
+            ("getifaddrs", ipaddrs._interface_addresses),
+            ("cached", ipaddrs.find_addresses),
+            ]
+    for name, f in ways:
+        addresses = f()
+        if addresses is None:
+            print("%-12s (not available here)" % name)
+            continue
+        elapsed = timeit.timeit(f, number=count) / count
+        print("%-12s %9.1f us  %s" % (name, elapsed * 1e6,
+                                      ", ".join(addresses)))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,59 @@
+from __future__ import print_function
+import sys, time
+from twisted.internet import task
+from twisted.python import log
+from wormhole.eventual import EventualQueue
+
+# Run this as 'python misc/bench-eventual.py [CALLS] [QUEUES]' to measure how
+# long an EventualQueue takes to drain CALLS (default 100000) queued calls in
+# one turn, and QUEUES (default 1000) queues sharing one reactor (as many
+# wormholes in one process do) with CALLS/QUEUES calls each. "list" is the
+# old list.pop(0) queue, which is quadratic in the number of queued calls.
+
+
+class ListQueue(EventualQueue):
+    def __init__(self, clock):
+        EventualQueue.__init__(self, clock)
+        self._calls = []
+
+    def _turn(self):
+        while self._calls:
+            (f, args, kwargs) = self._calls.pop(0)
+            try:
+                f(*args, **kwargs)
+            except Exception:
+                log.err()
+        self._timer = None
+        d, self._flush_d = self._flush_d, None
+        if d:
+            d.callback(None)
+
+
+def drain(queue_class, queues, calls):
+    clock = task.Clock()
+    eqs = [queue_class(clock) for i in range(queues)]
+    ran = [0]
+
+    def f(arg):
+        ran[0] += 1
+    for eq in eqs:
+        for i in range(calls // queues):
+            eq.eventually(f, i)
+    start = time.time()
+    clock.advance(0)
+    elapsed = time.time() - start
+    assert ran[0] == (calls // queues) * queues
+    return elapsed
+
+
+def main(calls="100000", queues="1000"):
+    calls, queues = int(calls), int(queues)
+    for name, queue_class in [("list", ListQueue), ("deque", EventualQueue)]:
+        one = drain(queue_class, 1, calls)
+        many = drain(queue_class, queues, calls)
+        print("%-6s 1 queue: %7.3fs   %d queues: %7.3fs" % (
+            name, one, queues, many))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
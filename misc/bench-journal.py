@@ -0,0 +1,65 @@
+from __future__ import print_function
+import json, os, shutil, sys, tempfile, time
+from twisted.internet import defer, task
+from twisted.internet.defer import inlineCallbacks
+from wormhole import journal
+
+# Run this as 'python misc/bench-journal.py [COUNT]' to measure how many
+# messages per second a durable journal can process. Each message is one
+# process() block that changes the state and queues one outbound message.
+# The baseline is a plain Journal whose save_checkpoint() rewrites and fsyncs
+# a state file for every message; the rest are GroupCommitJournals with
+# different fsync intervals (0 means one fsync per message).
+
+INTERVALS = [0, 0.001, 0.005, 0.02]
+
+
+def fsync_checkpoint(path, state):
+    def save_checkpoint():
+        with open(path, "w") as f:
+            json.dump(state, f)
+            f.flush()
+            os.fsync(f.fileno())
+    return save_checkpoint
+
+
+@inlineCallbacks
+def one_run(reactor, j, state, count):
+    released = []
+    start = time.time()
+    for i in range(count):
+        with j.process():
+            state["count"] = i
+            j.queue_outbound(released.append, i)
+        # let the reactor run between inbound messages, as it would if they
+        # arrived from the network
+        yield task.deferLater(reactor, 0, lambda: None)
+    while len(released) < count:
+        yield task.deferLater(reactor, 0.001, lambda: None)
+    defer.returnValue(count / (time.time() - start))
+
+
+@inlineCallbacks
+def main(reactor, count="2000"):
+    count = int(count)
+    tmpdir = tempfile.mkdtemp()
+    try:
+        state = {"count": 0, "padding": "x" * 200}
+        j = journal.Journal(fsync_checkpoint(os.path.join(tmpdir, "state"),
+                                             state))
+        rate = yield one_run(reactor, j, state, count)
+        print("%-24s %8.0f msgs/s" % ("fsync per checkpoint", rate))
+        for interval in INTERVALS:
+            path = os.path.join(tmpdir, "log-%s" % interval)
+            j = journal.GroupCommitJournal(path, lambda: state, reactor,
+                                           commit_interval=interval)
+            rate = yield one_run(reactor, j, state, count)
+            j.close()
+            print("%-24s %8.0f msgs/s" % ("group commit %gs" % interval,
+                                          rate))
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
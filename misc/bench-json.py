@@ -0,0 +1,40 @@
+from __future__ import print_function
+import os, sys, timeit
+from binascii import hexlify
+from wormhole import _json, util
+
+# Run this as 'python misc/bench-json.py [COUNT]' to compare the JSON
+# libraries that util.dict_to_bytes/bytes_to_dict can use, on the kind of
+# messages the rendezvous connection carries. Only the libraries that are
+# installed (and that agree with the stdlib) are measured.
+
+
+def frames():
+    body = hexlify(os.urandom(1024)).decode("ascii")
+    add = {"type": "add", "phase": "0", "body": body, "id": "a1b2"}
+    message = {"type": "message", "side": "abcdef0123", "phase": "0",
+               "body": body, "id": "a1b2", "server_rx": 1700000000.123,
+               "server_tx": 1700000000.125}
+    ack = {"type": "ack", "id": "a1b2", "server_tx": 1700000000.125}
+    return [("add", add), ("message", message), ("ack", ack)]
+
+
+def main(count=20000):
+    count = int(count)
+    print("available: %s" % ", ".join(_json.available_codecs()))
+    for name in _json.available_codecs():
+        _json.use_codec(name)
+        for kind, frame in frames():
+            b = util.dict_to_bytes(frame)
+            enc = timeit.timeit(lambda: util.dict_to_bytes(frame),
+                                number=count) / count
+            dec = timeit.timeit(lambda: util.bytes_to_dict(b),
+                                number=count) / count
+            print("%-7s %-8s encode (%s) %6.2f us  decode (%s) %6.2f us" % (
+                name, kind, _json.encoder_name, enc * 1e6,
+                _json.decoder_name, dec * 1e6))
+    _json.use_codec()
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
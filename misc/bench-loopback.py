@@ -0,0 +1,61 @@
+from __future__ import print_function
+import sys, time
+from twisted.internet import task, defer
+from twisted.internet.defer import inlineCallbacks
+from wormhole import transit
+
+# Run this as 'python misc/bench-loopback.py [MB]' to compare a same-host
+# transfer over the loopback TCP stack with one over a Unix-domain socket.
+
+RECORD = b"x" * 256 * 1024
+
+
+@inlineCallbacks
+def one_run(reactor, megabytes, same_host):
+    s = transit.TransitSender(None)
+    r = transit.TransitReceiver(None)
+    s.set_transit_key(b"k" * 32)
+    r.set_transit_key(b"k" * 32)
+    if same_host:
+        # otherwise the receiver doesn't offer its Unix socket
+        r.add_connection_abilities(s.get_connection_abilities())
+    shints = yield s.get_connection_hints()
+    rhints = yield r.get_connection_hints()
+    s.add_connection_hints(rhints)
+    r.add_connection_hints(shints)
+    x, y = yield defer.gatherResults([s.connect(), r.connect()], True)
+
+    count = megabytes * 1024 * 1024 // len(RECORD)
+    start = time.time()
+    done = defer.Deferred()
+    received = [0]
+
+    def _got(record):
+        received[0] += 1
+        if received[0] == count:
+            done.callback(None)
+        else:
+            y.receive_record().addCallback(_got)
+
+    y.receive_record().addCallback(_got)
+    for i in range(count):
+        x.send_record(RECORD)
+    yield done
+    elapsed = time.time() - start
+    description = x.describe()
+    x.close()
+    y.close()
+    defer.returnValue((description, elapsed))
+
+
+@inlineCallbacks
+def main(reactor, megabytes="256"):
+    megabytes = int(megabytes)
+    for same_host in [False, True]:
+        description, elapsed = yield one_run(reactor, megabytes, same_host)
+        print("%-40s %6.2fs  %8.1f MB/s" % (description, elapsed,
+                                             megabytes / elapsed))
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
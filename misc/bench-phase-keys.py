@@ -0,0 +1,56 @@
+from __future__ import print_function, unicode_literals
+import os, sys, timeit
+from wormhole._key import (PhaseKeys, decrypt_data, derive_phase_key,
+                           encrypt_data)
+
+# Run this as 'python misc/bench-phase-keys.py [PHASES] [SIZE]' to compare
+# the ways we encrypt and decrypt PHASES (default 10000) numbered phases of
+# SIZE (default 100) bytes each: deriving a fresh key and SecretBox for every
+# message (what Send and Receive used to do), a PhaseKeys schedule one
+# message at a time, and its batch API.
+
+
+def main(phases="10000", size="100"):
+    phases, size = int(phases), int(size)
+    key = os.urandom(32)
+    side = "abcdef0123"
+    plaintext = os.urandom(size)
+    messages = [("%d" % i, plaintext) for i in range(phases)]
+
+    def old_encrypt():
+        return [encrypt_data(derive_phase_key(key, side, phase), p)
+                for (phase, p) in messages]
+
+    def new_encrypt():
+        pk = PhaseKeys(key)
+        return [pk.encrypt(side, phase, p) for (phase, p) in messages]
+
+    def new_encrypt_many():
+        return PhaseKeys(key).encrypt_many(side, messages)
+
+    received = list(zip([phase for (phase, p) in messages], old_encrypt()))
+
+    def old_decrypt():
+        return [decrypt_data(derive_phase_key(key, side, phase), e)
+                for (phase, e) in received]
+
+    def new_decrypt():
+        pk = PhaseKeys(key)
+        return [pk.decrypt(side, phase, e) for (phase, e) in received]
+
+    def new_decrypt_many():
+        return PhaseKeys(key).decrypt_many(side, received)
+
+    for name, f in [("encrypt, old", old_encrypt),
+                    ("encrypt, PhaseKeys", new_encrypt),
+                    ("encrypt_many", new_encrypt_many),
+                    ("decrypt, old", old_decrypt),
+                    ("decrypt, PhaseKeys", new_decrypt),
+                    ("decrypt_many", new_decrypt_many),
+                    ]:
+        elapsed = min(timeit.repeat(f, number=1, repeat=3))
+        print("%-20s %7.1f us/message" % (name, elapsed / phases * 1e6))
+
+
+if __name__ == "__main__":
+    main(*sys.argv[1:])
@@ -0,0 +1,86 @@
+from __future__ import print_function
+import random, sys, time
+from twisted.application import internet
+from twisted.internet import defer, endpoints, task
+from twisted.internet.defer import inlineCallbacks
+from twisted.protocols import portforward
+from wormhole_mailbox_server.database import (create_channel_db,
+                                               create_usage_db)
+from wormhole_mailbox_server.server import make_server
+from wormhole_mailbox_server.web import make_web_server
+from wormhole import _rendezvous, wormhole
+
+# Run this as 'python misc/bench-reconnect.py [DROPS] [LOSS]' to measure how
+# long the rendezvous connection takes to come back after it drops. It runs
+# a local mailbox server behind a proxy that hangs up on a fraction LOSS
+# (default 0.3) of new connections, to simulate a lossy network, and
+# compares Twisted's default retry policy with ours.
+
+APPID = u"lothar.com/bench-reconnect"
+
+
+class LossyProxyFactory(portforward.ProxyFactory):
+    loss = 0.0
+
+    def buildProtocol(self, addr):
+        p = portforward.ProxyFactory.buildProtocol(self, addr)
+        if random.random() < self.loss:
+            # accept, then hang up before the WebSocket handshake
+            p.connectionMade = lambda: p.transport.abortConnection()
+        return p
+
+
+@inlineCallbacks
+def poll_until(reactor, predicate):
+    while not predicate():
+        yield task.deferLater(reactor, 0.001, lambda: None)
+
+
+@inlineCallbacks
+def one_run(reactor, url, policy, drops, proxy, loss):
+    # a failed first connection is fatal, so only start losing afterwards
+    proxy.loss = 0.0
+    w = wormhole.create(APPID, url, reactor, retry_policy=policy)
+    w.allocate_code()
+    yield w.get_code()
+    proxy.loss = loss
+    rc = w._boss._RC
+    times = []
+    for i in range(drops):
+        yield poll_until(reactor, lambda: rc._ws)
+        start = time.time()
+        rc._ws.transport.abortConnection()
+        yield poll_until(reactor, lambda: not rc._ws)
+        yield poll_until(reactor, lambda: rc._ws)
+        times.append(time.time() - start)
+    try:
+        yield w.close()
+    except Exception:
+        pass  # LonelyError: nobody else joined
+    defer.returnValue(sorted(times))
+
+
+@inlineCallbacks
+def main(reactor, drops="20", loss="0.3"):
+    drops = int(drops)
+    db = create_channel_db(":memory:")
+    server = make_server(db, usage_db=create_usage_db(":memory:"))
+    site = make_web_server(server, log_requests=False)
+    ep = endpoints.TCP4ServerEndpoint(reactor, 0, interface="127.0.0.1")
+    lp = yield ep.listen(site)
+    f = LossyProxyFactory("127.0.0.1", lp.getHost().port)
+    ep = endpoints.TCP4ServerEndpoint(reactor, 0, interface="127.0.0.1")
+    proxy = yield ep.listen(f)
+    url = u"ws://127.0.0.1:%d/v1" % proxy.getHost().port
+
+    policies = [("twisted default", internet.backoffPolicy()),
+                ("fast + jitter", _rendezvous.retry_policy())]
+    for name, policy in policies:
+        times = yield one_run(reactor, url, policy, drops, f,
+                              float(loss))
+        print("%-16s mean %6.3fs  median %6.3fs  max %6.3fs" % (
+            name, sum(times) / len(times), times[len(times) // 2], times[-1]))
+
+
+if __name__ == "__main__":
+    task.react(main, sys.argv[1:])
@@ -1,4 +1,6 @@
+from ._rendezvous import RendezvousPool
 from ._rlcompleter import input_with_completion
-from .wormhole import create, __version__
+from .wormhole import create, from_serialized, __version__
 
-__all__ = ["create", "input_with_completion", "__version__"]
+__all__ = ["create", "from_serialized", "input_with_completion",
+           "RendezvousPool", "__version__"]
@@ -24,9 +24,13 @@ from ._rendezvous import RendezvousConnector
 from ._send import Send
 from ._terminator import Terminator
 from ._wordlist import PGPWordList
-from .errors import (LonelyError, OnlyOneCodeError, ServerError, WelcomeError,
-                     WrongPasswordError, _UnknownPhaseError)
-from .util import bytes_to_dict
+from .errors import (LonelyError, NotSerializableError, OnlyOneCodeError,
+                     ServerError, WelcomeError, WrongPasswordError,
+                     _UnknownPhaseError)
+from .util import bytes_to_dict, bytes_to_hexstr, hexstr_to_bytes
+
+# versions of the chunked-message format we can reassemble
+CHUNK_VERSIONS = ["1"]
 
 
 @attrs
@@ -44,9 +48,14 @@ class Boss(object):
     _journal = attrib(validator=provides(_interfaces.IJournal))
     _tor = attrib(validator=optional(provides(_interfaces.ITorManager)))
     _timing = attrib(validator=provides(_interfaces.ITiming))
+    _retry_policy = attrib(default=None)
+    _rendezvous_pool = attrib(default=None)
     m = MethodicalMachine()
     set_trace = getattr(m, "_setTrace",
                         lambda self, f: None)  # pragma: no cover
+    # messages larger than this are sent in pieces, if the peer can
+    # reassemble them
+    CHUNK_SIZE = 64 * 1024
 
     def __attrs_post_init__(self):
         self._build_workers()
@@ -61,8 +70,10 @@ class Boss(object):
         self._R = Receive(self._side, self._timing)
         self._RC = RendezvousConnector(self._url, self._appid, self._side,
                                        self._reactor, self._journal, self._tor,
-                                       self._timing, self._client_version)
-        self._L = Lister(self._timing)
+                                       self._timing, self._client_version,
+                                       self._retry_policy,
+                                       self._rendezvous_pool)
+        self._L = Lister(self._timing, self._reactor)
         self._A = Allocator(self._timing)
         self._I = Input(self._timing)
         self._C = Code(self._timing)
@@ -89,6 +100,9 @@ class Boss(object):
         self._next_tx_phase = 0
         self._next_rx_phase = 0
         self._rx_phases = {}  # phase -> plaintext
+        self._rx_chunks = {}  # phase -> {index: plaintext}
+        self._their_versions = None
+        self._held_sends = []  # (phase, plaintext), until we see versions
 
         self._next_rx_dilate_seqnum = 0
         self._rx_dilate_seqnums = {}  # seqnum -> plaintext
@@ -147,28 +161,104 @@ class Boss(object):
             if machine == "I":
                 self._I.set_debug(t)
 
-    # def serialize(self):
-    #     raise NotImplemented
+    # Only a wormhole that has its code and is not yet closing can be
+    # serialized. The saved form is JSON-safe (bytes are hex-encoded), and
+    # leaves the rendezvous connection out: a restored Boss reconnects, and
+    # the Nameplate and Mailbox machines re-claim/re-open and re-send
+    # anything the server hadn't acknowledged, just like after a reconnect.
+    @m.serializer()
+    def serialize(self, state):
+        if state not in ("S1_lonely", "S2_happy"):
+            raise NotSerializableError("wormhole is in state %s" % state)
+        if (self._D._manager is not None or self._next_rx_dilate_seqnum
+                or self._rx_dilate_seqnums):
+            raise NotSerializableError("wormhole has started dilation")
+
+        def hexdict(d):
+            return dict(("%d" % k, bytes_to_hexstr(v)) for k, v in d.items())
+
+        return {
+            "state": state,
+            "side": self._side,
+            "url": self._url,
+            "appid": self._appid,
+            "versions": self._versions,
+            "client_version": list(self._client_version),
+            "next_tx_phase": self._next_tx_phase,
+            "next_rx_phase": self._next_rx_phase,
+            "rx_phases": hexdict(self._rx_phases),
+            "rx_chunks": dict(("%d" % phase, hexdict(chunks))
+                              for phase, chunks in self._rx_chunks.items()),
+            "their_versions": self._their_versions,
+            "held_sends": [[phase, bytes_to_hexstr(plaintext)]
+                           for (phase, plaintext) in self._held_sends],
+            "nameplate": self._N.serialize(),
+            "mailbox": self._M.serialize(),
+            "key": self._K.serialize(),
+            "send": self._S.serialize(),
+            "receive": self._R.serialize(),
+            "order": self._O.serialize(),
+            "terminator": self._T.serialize(),
+        }
+
+    @classmethod
+    def from_serialized(klass, W, data, reactor, eventual_queue, cooperator,
+                        journal, tor, timing, retry_policy=None,
+                        rendezvous_pool=None):
+        b = klass(W, data["side"], data["url"], data["appid"],
+                  data["versions"], tuple(data["client_version"]), reactor,
+                  eventual_queue, cooperator, journal, tor, timing,
+                  retry_policy, rendezvous_pool)
+        b.restore(data)
+        return b
+
+    @m.unserializer()
+    def restore(self, data):
+        def unhexdict(d):
+            return dict((int(k), hexstr_to_bytes(v)) for k, v in d.items())
+
+        self._did_start_code = True
+        self._next_tx_phase = data["next_tx_phase"]
+        self._next_rx_phase = data["next_rx_phase"]
+        self._rx_phases = unhexdict(data["rx_phases"])
+        self._rx_chunks = dict((int(phase), unhexdict(chunks))
+                               for phase, chunks in data["rx_chunks"].items())
+        self._their_versions = data["their_versions"]
+        self._held_sends = [(phase, hexstr_to_bytes(plaintext))
+                            for (phase, plaintext) in data["held_sends"]]
+        self._N.restore(data["nameplate"])
+        self._M.restore(data["mailbox"])
+        self._K.restore(data["key"])
+        self._S.restore(data["send"])
+        self._R.restore(data["receive"])
+        self._O.restore(data["order"])
+        self._T.restore(data["terminator"])
+        # let a later w.dilate() work as if we'd never been away
+        if self._R._key is not None:
+            self._D.got_key(self._R._key)
+        if self._their_versions is not None:
+            self._D.got_wormhole_versions(self._their_versions)
+        return data["state"]
 
     # and these are the state-machine transition functions, which don't take
     # args
-    @m.state(initial=True)
+    @m.state(initial=True, serialized="S0_empty")
     def S0_empty(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S1_lonely")
     def S1_lonely(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S2_happy")
     def S2_happy(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S3_closing")
     def S3_closing(self):
         pass  # pragma: no cover
 
-    @m.state(terminal=True)
+    @m.state(terminal=True, serialized="S4_closed")
     def S4_closed(self):
         pass  # pragma: no cover
 
@@ -205,8 +295,10 @@ class Boss(object):
         self._did_start_code = True
         self._C.set_code(code)
 
-    def dilate(self, transit_relay_location=None, no_listen=False):
-        return self._D.dilate(transit_relay_location, no_listen=no_listen)  # fires with endpoints
+    def dilate(self, transit_relay_location=None, no_listen=False,
+               listen_ports=None):
+        return self._D.dilate(transit_relay_location, no_listen=no_listen,
+                              listen_ports=listen_ports)  # fires with endpoints
 
     @m.input()
     def send(self, plaintext):
@@ -268,17 +360,31 @@ class Boss(object):
         assert isinstance(phase, type("")), type(phase)
         assert isinstance(plaintext, type(b"")), type(plaintext)
         d_mo = re.search(r'^dilate-(\d+)$', phase)
+        c_mo = re.search(r'^(\d+)\.(\d+)/(\d+)$', phase)
         if phase == "version":
             self._got_version(plaintext)
         elif d_mo:
             self._got_dilate(int(d_mo.group(1)), plaintext)
         elif re.search(r'^\d+$', phase):
             self._got_phase(int(phase), plaintext)
+        elif c_mo:
+            self._got_chunk(int(c_mo.group(1)), int(c_mo.group(2)),
+                            int(c_mo.group(3)), plaintext)
         else:
             # Ignore unrecognized phases, for forwards-compatibility. Use
             # log.err so tests will catch surprises.
             log.err(_UnknownPhaseError("received unknown phase '%s'" % phase))
 
+    def _got_chunk(self, phase, index, count, plaintext):
+        # piece together a message that was sent in chunks, then deliver it
+        # like any other phase
+        chunks = self._rx_chunks.setdefault(phase, {})
+        if index < count:
+            chunks[index] = plaintext
+        if len(chunks) == count:
+            del self._rx_chunks[phase]
+            self._got_phase(phase, b"".join(chunks[i] for i in range(count)))
+
     @m.input()
     def _got_version(self, plaintext):
         pass
@@ -317,13 +423,35 @@ class Boss(object):
         # but this part is app-to-app
         app_versions = self._their_versions.get("app_versions", {})
         self._W.got_versions(app_versions)
+        held, self._held_sends = self._held_sends, []
+        for (phase, plaintext) in held:
+            self._send_phase(phase, plaintext)
 
     @m.output()
     def S_send(self, plaintext):
         assert isinstance(plaintext, type(b"")), type(plaintext)
         phase = self._next_tx_phase
         self._next_tx_phase += 1
-        self._S.send("%d" % phase, plaintext)
+        if len(plaintext) > self.CHUNK_SIZE and self._their_versions is None:
+            # we don't know yet whether they can reassemble chunks. Later
+            # phases can go ahead: they won't be delivered before this one.
+            self._held_sends.append((phase, plaintext))
+            return
+        self._send_phase(phase, plaintext)
+
+    def _send_phase(self, phase, plaintext):
+        size = self.CHUNK_SIZE
+        if len(plaintext) <= size:
+            self._S.send("%d" % phase, plaintext)
+            return
+        their_chunk_versions = self._their_versions.get("can-chunk", [])
+        if not set(CHUNK_VERSIONS) & set(their_chunk_versions):
+            self._S.send("%d" % phase, plaintext)
+            return
+        count = (len(plaintext) + size - 1) // size
+        for i in range(count):
+            chunk = plaintext[i * size:(i + 1) * size]
+            self._S.send("%d.%d/%d" % (phase, i, count), chunk)
 
     @m.output()
     def close_unwelcome(self, welcome_error):
@@ -5,16 +5,14 @@ from attr import attrs, attrib
 from attr.validators import instance_of, provides, optional
 from automat import MethodicalMachine
 from zope.interface import implementer
-from twisted.internet.task import deferLater
-from twisted.internet.defer import DeferredList, CancelledError
-from twisted.internet.endpoints import serverFromString
+from twisted.internet.defer import Deferred, DeferredList, CancelledError
 from twisted.internet.protocol import ClientFactory, ServerFactory
 from twisted.internet.address import HostnameAddress, IPv4Address, IPv6Address
 from twisted.internet.error import ConnectingCancelledError, ConnectionRefusedError, DNSLookupError
 from twisted.python import log
 from .. import ipaddrs  # TODO: move into _dilation/
 from .._interfaces import IDilationConnector, IDilationManager
-from ..timing import DebugTiming
+from ..timing import NullTiming
 from ..observer import EmptyableSet
 from ..util import HKDF, to_unicode
 from .connection import DilatedConnectionProtocol, KCM
@@ -22,7 +20,7 @@ from .roles import LEADER
 
 from .._hints import (DirectTCPV1Hint, TorTCPV1Hint, RelayV1Hint,
                       parse_hint_argv, describe_hint_obj, endpoint_from_hint_obj,
-                      encode_hint)
+                      encode_hint, is_ipv6_hint, happy_eyeballs_order)
 from ._noise import NoiseConnection
 
 
@@ -84,11 +82,14 @@ class Connector(object):
     _side = attrib(validator=instance_of(type(u"")))
     # was self._side = bytes_to_hexstr(os.urandom(8)) # unicode
     _role = attrib()
+    _listen_ports = attrib(default=None)
 
     m = MethodicalMachine()
     set_trace = getattr(m, "_setTrace", lambda self, f: None)  # pragma: no cover
 
     RELAY_DELAY = 2.0
+    # mixed IPv6/IPv4 direct hints are tried this far apart, IPv6 first
+    ATTEMPT_DELAY = 0.25
 
     def __attrs_post_init__(self):
         if self._transit_relay_location:
@@ -100,11 +101,15 @@ class Connector(object):
             self._transit_relays = []
         self._listeners = set()  # IListeningPorts that can be stopped
         self._pending_connectors = set()  # Deferreds that can be cancelled
+        self._delayed_relays = []  # IDelayedCalls for fast failover
+        self._delayed_direct = []  # IDelayedCalls for happy eyeballs
+        self._direct_attempts = 0
+        self._direct_failures = 0
         self._pending_connections = EmptyableSet(
             _eventual_queue=self._eventual_queue)  # Protocols to be stopped
         self._contenders = set()  # viable connections
         self._winning_connection = None
-        self._timing = self._timing or DebugTiming()
+        self._timing = self._timing or NullTiming()
         self._timing.add("transit")
 
     # this describes what our Connector can do, for the initial advertisement
@@ -246,6 +251,8 @@ class Connector(object):
         # help GC by forgetting references to things that reference us
         self._listeners.clear()
         self._pending_connectors.clear()
+        self._delayed_relays[:] = []
+        self._delayed_direct[:] = []
         self._pending_connections.clear()
         self._winning_connection = None
 
@@ -289,10 +296,10 @@ class Connector(object):
         return addresses
 
     def _start_listener(self, addresses):
-        # TODO: listen on a fixed port, if possible, for NAT/p2p benefits, also
-        # to make firewall configs easier
-        # TODO: retain listening port between connection generations?
-        ep = serverFromString(self._reactor, "tcp:0")
+        # each generation tries to reuse the last one's port, for the
+        # benefit of NAT mappings and firewall rules
+        port = ipaddrs.choose_listen_port(self._listen_ports)
+        ep = ipaddrs.DualStackServerEndpoint(self._reactor, port)
         f = InboundConnectionFactory(self)
         d = ep.listen(f)
 
@@ -309,8 +316,21 @@ class Connector(object):
     def _schedule_connection(self, delay, h, is_relay):
         ep = endpoint_from_hint_obj(h, self._tor, self._reactor)
         desc = describe_hint_obj(h, is_relay, self._tor)
-        d = deferLater(self._reactor, delay,
-                       self._connect, ep, desc, is_relay)
+
+        # like deferLater(), but we keep the timer so _direct_failed() can
+        # move it forward
+        def _cancel(_):
+            if t.active():
+                t.cancel()
+        d = Deferred(_cancel)
+        t = self._reactor.callLater(delay, d.callback, None)
+        d.addCallback(lambda _: self._connect(ep, desc, is_relay))
+        if is_relay:
+            self._delayed_relays.append(t)
+        else:
+            self._delayed_direct.append(t)
+            self._direct_attempts += 1
+            d.addErrback(self._direct_failed)
         d.addErrback(lambda f: f.trap(ConnectingCancelledError,
                                       ConnectionRefusedError,
                                       CancelledError,
@@ -322,6 +342,23 @@ class Connector(object):
         d.addErrback(log.err)
         self._pending_connectors.add(d)
 
+    def _direct_failed(self, f):
+        # Fast failover: once every direct connection we've tried has failed
+        # (e.g. "connection refused"), there's nothing left to prefer over
+        # the relays, so start any that are still waiting out RELAY_DELAY.
+        if not f.check(CancelledError, ConnectingCancelledError):
+            self._direct_failures += 1
+            # and don't make the next happy-eyeballs attempt wait its turn
+            for t in self._delayed_direct:
+                if t.active():
+                    t.reset(0)
+                    break
+            if self._direct_failures == self._direct_attempts:
+                for t in self._delayed_relays:
+                    if t.active():
+                        t.reset(0)
+        return f
+
     def _use_hints(self, hints):
         # first, pull out all the relays, we'll connect to them later
         relays = []
@@ -335,10 +372,16 @@ class Connector(object):
         made_direct = False
         priorities = sorted(set(direct.keys()), reverse=True)
         for p in priorities:
-            for h in direct[p]:
-                if isinstance(h, TorTCPV1Hint) and not self._tor:
-                    continue
-                self._schedule_connection(delay, h, is_relay=False)
+            hs = [h for h in direct[p]
+                  if self._tor or not isinstance(h, TorTCPV1Hint)]
+            stagger = 0.0
+            if len(set(is_ipv6_hint(h) for h in hs)) > 1:
+                # happy eyeballs: alternate IPv6 and IPv4, IPv6 first, and
+                # give each attempt a head start over the next
+                hs = happy_eyeballs_order(hs)
+                stagger = self.ATTEMPT_DELAY
+            for i, h in enumerate(hs):
+                self._schedule_connection(i * stagger, h, is_relay=False)
                 made_direct = True
                 # Make all direct connections immediately. Later, we'll change
                 # the add_candidate() function to look at the priority when
@@ -354,18 +397,14 @@ class Connector(object):
             # few seconds. We don't wait until direct connections have
             # failed, because many direct hints will be to unused
             # local-network IP address, which won't answer, and can take the
-            # full 30s TCP timeout to fail.
+            # full 30s TCP timeout to fail. But if they all fail quickly,
+            # _direct_failed() starts the relays early.
             #
             # If we didn't make any direct connections, or we're using
             # --no-listen, then we're probably going to have to use the
             # relay, so don't delay it at all.
             delay += self.RELAY_DELAY
 
-        # It might be nice to wire this so that a failure in the direct hints
-        # causes the relay hints to be used right away (fast failover). But
-        # none of our current use cases would take advantage of that: if we
-        # have any viable direct hints, then they're either going to succeed
-        # quickly or hang for a long time.
         for r in relays:
             for h in r.hints:
                 self._schedule_connection(delay, h, is_relay=True)
@@ -16,6 +16,7 @@ from twisted.internet.defer import Deferred
 from twisted.internet.interfaces import (IStreamClientEndpoint,
                                          IStreamServerEndpoint)
 from twisted.python import log, failure
+from .. import ipaddrs
 from .._interfaces import IDilator, IDilationManager, ISend, ITerminator
 from ..util import dict_to_bytes, bytes_to_dict, bytes_to_hexstr
 from ..observer import OneShotObserver
@@ -115,6 +116,7 @@ class Manager(object):
     _cooperator = attrib(repr=False)
     # TODO: can this validator work when the parameter is optional?
     _no_listen = attrib(validator=instance_of(bool), default=False)
+    _listen_ports = attrib(default=None)  # list of acceptable ports
 
     _dilation_key = None
     _tor = None  # TODO
@@ -464,6 +466,10 @@ class Manager(object):
     def _start_connecting(self):
         assert self._my_role is not None
         assert self._dilation_key is not None
+        if self._made_first_connection:
+            # we're reconnecting, perhaps because the network changed, so
+            # don't offer the addresses we cached for the last generation
+            ipaddrs.forget_addresses()
         self._connector = Connector(self._dilation_key,
                                     self._transit_relay_location,
                                     self,
@@ -471,7 +477,8 @@ class Manager(object):
                                     self._no_listen, self._tor,
                                     self._timing,
                                     self._my_side,  # needed for relay handshake
-                                    self._my_role)
+                                    self._my_role,
+                                    self._listen_ports)
         if self._debug_stall_connector:
             # unit tests use this hook to send messages while we know we
             # don't have a connection
@@ -591,7 +598,8 @@ class Dilator(object):
         self._T = ITerminator(terminator)
 
     # this is the primary entry point, called when w.dilate() is invoked
-    def dilate(self, transit_relay_location=None, no_listen=False):
+    def dilate(self, transit_relay_location=None, no_listen=False,
+               listen_ports=None):
         if not self._manager:
             # build the manager right away, and tell it later when the
             # VERSIONS message arrives, and also when the dilation_key is set
@@ -599,7 +607,7 @@ class Dilator(object):
             m = Manager(self._S, my_dilation_side,
                         transit_relay_location,
                         self._reactor, self._eventual_queue,
-                        self._cooperator, no_listen)
+                        self._cooperator, no_listen, listen_ports)
             self._manager = m
             if self._pending_dilation_key is not None:
                 m.got_dilation_key(self._pending_dilation_key)
@@ -3,7 +3,8 @@ import sys
 import re
 import six
 from collections import namedtuple
-from twisted.internet.endpoints import TCP4ClientEndpoint, TCP6ClientEndpoint, HostnameEndpoint
+from twisted.internet.endpoints import (TCP4ClientEndpoint, TCP6ClientEndpoint,
+                                        HostnameEndpoint, UNIXClientEndpoint)
 from twisted.internet.abstract import isIPAddress, isIPv6Address
 from twisted.python import log
 
@@ -24,6 +25,9 @@ TorTCPV1Hint = namedtuple("TorTCPV1Hint", ["hostname", "port", "priority"])
 # one, make the TCP connection, send the relay handshake, then complete the
 # rest of the V1 protocol. Only one hint per relay is useful.
 RelayV1Hint = namedtuple("RelayV1Hint", ["hints"])
+# UnixV1Hint is a Unix-domain socket on the same host (it is only offered
+# to peers that say they are on the same host), then the V1 protocol.
+UnixV1Hint = namedtuple("UnixV1Hint", ["path", "priority"])
 
 def describe_hint_obj(hint, relay, tor):
     prefix = "tor->" if tor else "->"
@@ -33,6 +37,8 @@ def describe_hint_obj(hint, relay, tor):
         return prefix + "tcp:%s:%d" % (hint.hostname, hint.port)
     elif isinstance(hint, TorTCPV1Hint):
         return prefix + "tor:%s:%d" % (hint.hostname, hint.port)
+    elif isinstance(hint, UnixV1Hint):
+        return prefix + "unix:%s" % (hint.path, )
     else:
         return prefix + str(hint)
 
@@ -89,6 +95,8 @@ def endpoint_from_hint_obj(hint, tor, reactor):
         if isIPv6Address(hint.hostname):
             return TCP6ClientEndpoint(reactor, hint.hostname, hint.port)
         return HostnameEndpoint(reactor, hint.hostname, hint.port)
+    if isinstance(hint, UnixV1Hint):
+        return UNIXClientEndpoint(reactor, hint.path)
     return None
 
 def parse_tcp_v1_hint(hint):  # hint_struct -> hint_obj
@@ -110,6 +118,27 @@ def parse_tcp_v1_hint(hint):  # hint_struct -> hint_obj
     else:
         return TorTCPV1Hint(hint["hostname"], hint["port"], priority)
 
+def is_ipv6_hint(hint):
+    return (isinstance(hint, DirectTCPV1Hint) and
+            isIPv6Address(hint.hostname))
+
+def happy_eyeballs_order(hints):
+    # Alternate between IPv6 and IPv4 (and hostname) hints, IPv6 first, as
+    # RFC 8305 suggests, keeping the original order within each family.
+    v6 = [h for h in hints if is_ipv6_hint(h)]
+    other = [h for h in hints if not is_ipv6_hint(h)]
+    ordered = []
+    for i in range(max(len(v6), len(other))):
+        ordered.extend(v6[i:i + 1])
+        ordered.extend(other[i:i + 1])
+    return ordered
+
+def parse_unix_v1_hint(hint):  # hint_struct -> hint_obj
+    if not ("path" in hint and isinstance(hint["path"], type(""))):
+        log.msg("invalid path in hint: %r" % (hint, ))
+        return None
+    return UnixV1Hint(hint["path"], hint.get("priority", 0.0))
+
 def parse_hint(hint_struct):
     hint_type = hint_struct.get("type", "")
     if hint_type == "relay-v1":
@@ -117,6 +146,8 @@ def parse_hint(hint_struct):
         rhints = filter(lambda h: h,  # drop None (unrecognized)
                         [parse_tcp_v1_hint(rh) for rh in hint_struct["hints"]])
         return RelayV1Hint(list(rhints))
+    if hint_type == "unix-v1":
+        return parse_unix_v1_hint(hint_struct)
     return parse_tcp_v1_hint(hint_struct)
 
 
@@ -141,4 +172,9 @@ def encode_hint(h):
                 "hostname": h.hostname,
                 "port": h.port,  # integer
                 }
+    elif isinstance(h, UnixV1Hint):
+        return {"type": "unix-v1",
+                "priority": h.priority,
+                "path": h.path,
+                }
     raise ValueError("unknown hint type", h)
@@ -0,0 +1,152 @@
+from __future__ import absolute_import, print_function, unicode_literals
+
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# Every websocket frame and every transfer control message goes through
+# util.dict_to_bytes/bytes_to_dict, so use a faster JSON library when one is
+# installed. Peers, servers, and journals may compare or hash what we
+# produce, so each library is only used in the directions where it gives
+# exactly what the stdlib json module would, which we check at import time:
+# orjson only decodes (its output is more compact), and ujson encodes too if
+# it escapes strings the same way.
+
+
+def _json_dumps(obj):
+    return json.dumps(obj)
+
+
+def _json_loads(b):
+    return json.loads(b.decode("utf-8"))
+
+
+def _any_float(obj, test):
+    if isinstance(obj, float):
+        return test(obj)
+    if isinstance(obj, dict):
+        obj = obj.values()
+    elif not isinstance(obj, (list, tuple)):
+        return False
+    for value in obj:
+        if (isinstance(value, (float, dict, list, tuple))
+                and _any_float(value, test)):
+            return True
+    return False
+
+
+def _is_float(f):
+    return True
+
+
+def _is_huge_integer(f):
+    # orjson quietly turns integers too big for 64 bits into floats, which
+    # look like this. Real floats that are this big are rare enough that we
+    # can afford to decode them twice.
+    return abs(f) >= 2.0 ** 63 and f.is_integer()
+
+
+def _orjson_loads(b):
+    try:
+        obj = orjson.loads(b)
+    except ValueError:
+        # orjson is stricter (NaN, lone surrogates): let the stdlib decide,
+        # and raise its usual exception if it is really broken
+        return _json_loads(b)
+    if _any_float(obj, _is_huge_integer):
+        return _json_loads(b)
+    return obj
+
+
+def _ujson_dumps(obj):
+    # ujson formats some floats differently (1.5e-7, not 1.5e-07). Our
+    # messages rarely have any, so let the stdlib handle those that do.
+    if _any_float(obj, _is_float):
+        return _json_dumps(obj)
+    try:
+        return ujson.dumps(obj, ensure_ascii=True, escape_forward_slashes=False,
+                           separators=(", ", ": "))
+    except (TypeError, ValueError, OverflowError):
+        return _json_dumps(obj)
+
+
+def _ujson_loads(b):
+    try:
+        return ujson.loads(b)
+    except ValueError:
+        return _json_loads(b)
+
+
+# a few things that libraries have historically done differently
+_SAMPLES = [
+    {"a": 1, "b": [True, False, None], "c": {}, "d": []},
+    {"e": "x/y\n\t\u0000\u001f\u00e9\u2028\U0001f600\"\\", "f": ""},
+    {"g": 0.1, "h": 1e+20, "i": -0.0, "j": 1.5e-7, "k": 2 ** 63 - 1},
+]
+
+
+def _encodes_like_json(dumps):
+    try:
+        return all(dumps(sample) == json.dumps(sample) for sample in _SAMPLES)
+    except Exception:
+        return False
+
+
+def _decodes_like_json(loads):
+    try:
+        return all(loads(json.dumps(sample).encode("utf-8")) == sample
+                   for sample in _SAMPLES)
+    except Exception:
+        return False
+
+
+_ENCODERS = {"json": _json_dumps}
+_DECODERS = {"json": _json_loads}
+if ujson and _encodes_like_json(_ujson_dumps):
+    _ENCODERS["ujson"] = _ujson_dumps
+if ujson and _decodes_like_json(_ujson_loads):
+    _DECODERS["ujson"] = _ujson_loads
+if orjson and _decodes_like_json(_orjson_loads):
+    _DECODERS["orjson"] = _orjson_loads
+# fastest last
+_PREFERENCE = ["json", "ujson", "orjson"]
+
+
+def available_codecs():
+    """Return the names of the JSON libraries that can be used here, always
+    including the stdlib's "json"."""
+    return [name for name in _PREFERENCE
+            if name in _ENCODERS or name in _DECODERS]
+
+
+dumps = _json_dumps  # obj -> unicode
+loads = _json_loads  # utf-8 bytes -> obj
+encoder_name = decoder_name = "json"
+
+
+def use_codec(name=None):
+    """Choose the JSON library: "json", "ujson", "orjson", or None to pick
+    the fastest one available. A library that can't reproduce the stdlib's
+    output exactly (orjson, or some versions of ujson) only decodes, and is
+    paired with the fastest encoder that can."""
+    global dumps, loads, encoder_name, decoder_name
+    if name is None:
+        name = available_codecs()[-1]
+    if name not in available_codecs():
+        raise ValueError("JSON codec %r is not available" % (name, ))
+    encoders = [n for n in _PREFERENCE if n in _ENCODERS]
+    encoder_name = name if name in _ENCODERS else encoders[-1]
+    decoder_name = name if name in _DECODERS else "json"
+    dumps = _ENCODERS[encoder_name]
+    loads = _DECODERS[decoder_name]
+
+
+use_codec()
@@ -1,11 +1,13 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+from collections import OrderedDict
 from hashlib import sha256
 
 import six
 from attr import attrib, attrs
 from attr.validators import instance_of, provides
 from automat import MethodicalMachine
+from hkdf import Hkdf
 from nacl import utils
 from nacl.exceptions import CryptoError
 from nacl.secret import SecretBox
@@ -17,7 +19,8 @@ from .util import (bytes_to_dict, bytes_to_hexstr, dict_to_bytes,
                    hexstr_to_bytes, to_bytes, HKDF)
 
 CryptoError
-__all__ = ["derive_key", "derive_phase_key", "CryptoError", "Key"]
+__all__ = ["derive_key", "derive_phase_key", "PhaseKeys", "CryptoError",
+           "Key"]
 
 
 def derive_key(key, purpose, length=SecretBox.KEY_SIZE):
@@ -58,6 +61,64 @@ def encrypt_data(key, plaintext):
     return box.encrypt(plaintext, nonce)
 
 
+class PhaseKeys(object):
+    """Encrypts and decrypts phases with a single shared key, like
+    derive_phase_key() plus encrypt_data()/decrypt_data(), but doing the
+    per-key work (the HKDF extract step, hashing each side) only once."""
+    # a phase is rarely used more than once per side, so only keep a few
+    MAX_BOXES = 64
+
+    def __init__(self, key):
+        assert isinstance(key, type(b"")), type(key)
+        self._hkdf = Hkdf(None, key)
+        self._side_hashes = {}  # side -> sha256(side)
+        self._boxes = OrderedDict()  # (side, phase) -> SecretBox, LRU
+
+    def phase_key(self, side, phase):
+        assert isinstance(side, type("")), type(side)
+        assert isinstance(phase, type("")), type(phase)
+        side_hash = self._side_hashes.get(side)
+        if side_hash is None:
+            side_hash = sha256(side.encode("ascii")).digest()
+            self._side_hashes[side] = side_hash
+        purpose = (b"wormhole:phase:" + side_hash +
+                   sha256(phase.encode("ascii")).digest())
+        return self._hkdf.expand(purpose, SecretBox.KEY_SIZE)
+
+    def _box(self, side, phase):
+        box = self._boxes.pop((side, phase), None)
+        if box is None:
+            box = SecretBox(self.phase_key(side, phase))
+        self._boxes[(side, phase)] = box
+        if len(self._boxes) > self.MAX_BOXES:
+            self._boxes.popitem(last=False)
+        return box
+
+    def encrypt(self, side, phase, plaintext):
+        assert isinstance(plaintext, type(b"")), type(plaintext)
+        nonce = utils.random(SecretBox.NONCE_SIZE)
+        return self._box(side, phase).encrypt(plaintext, nonce)
+
+    def decrypt(self, side, phase, encrypted):
+        assert isinstance(encrypted, type(b"")), type(encrypted)
+        return self._box(side, phase).decrypt(encrypted)
+
+    def encrypt_many(self, side, messages):
+        # messages is a list of (phase, plaintext). One call to the RNG
+        # provides all the nonces.
+        size = SecretBox.NONCE_SIZE
+        nonces = utils.random(size * len(messages))
+        return [self._box(side, phase).encrypt(plaintext,
+                                               nonces[i * size:(i + 1) * size])
+                for i, (phase, plaintext) in enumerate(messages)]
+
+    def decrypt_many(self, side, messages):
+        # messages is a list of (phase, encrypted). Raises CryptoError if any
+        # of them fail.
+        return [self.decrypt(side, phase, encrypted)
+                for (phase, encrypted) in messages]
+
+
 # the Key we expose to callers (Boss, Ordering) is responsible for sorting
 # the two messages (got_code and got_pake), then delivering them to
 # _SortedKey in the right order.
@@ -82,19 +143,35 @@ class Key(object):
     def wire(self, boss, mailbox, receive):
         self._SK.wire(boss, mailbox, receive)
 
-    @m.state(initial=True)
+    @m.serializer()
+    def serialize(self, state):
+        pake = getattr(self, "_pake", None)
+        return {
+            "state": state,
+            "pake": bytes_to_hexstr(pake) if pake is not None else None,
+            "sorted": self._SK.serialize(),
+        }
+
+    @m.unserializer()
+    def restore(self, data):
+        if data["pake"] is not None:
+            self._pake = hexstr_to_bytes(data["pake"])
+        self._SK.restore(data["sorted"])
+        return data["state"]
+
+    @m.state(initial=True, serialized="S00")
     def S00(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S01")
     def S01(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S10")
     def S10(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S11")
     def S11(self):
         pass  # pragma: no cover
 
@@ -145,19 +222,34 @@ class _SortedKey(object):
         self._M = _interfaces.IMailbox(mailbox)
         self._R = _interfaces.IReceive(receive)
 
-    @m.state(initial=True)
+    @m.serializer()
+    def serialize(self, state):
+        data = {"state": state}
+        # only a half-finished SPAKE2 exchange has anything worth keeping
+        if state == "S1_know_code":
+            data["spake2"] = bytes_to_hexstr(self._sp.serialize())
+        return data
+
+    @m.unserializer()
+    def restore(self, data):
+        if "spake2" in data:
+            self._sp = SPAKE2_Symmetric.from_serialized(
+                hexstr_to_bytes(data["spake2"]))
+        return data["state"]
+
+    @m.state(initial=True, serialized="S0_know_nothing")
     def S0_know_nothing(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S1_know_code")
     def S1_know_code(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S2_know_key")
     def S2_know_key(self):
         pass  # pragma: no cover
 
-    @m.state(terminal=True)
+    @m.state(terminal=True, serialized="S3_scared")
     def S3_scared(self):
         pass  # pragma: no cover
 
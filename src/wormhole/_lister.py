@@ -12,14 +12,36 @@ from . import _interfaces
 @implementer(_interfaces.ILister)
 class Lister(object):
     _timing = attrib(validator=provides(_interfaces.ITiming))
+    # without a clock we don't cache, and every refresh asks the server
+    _reactor = attrib(default=None)
     m = MethodicalMachine()
     set_trace = getattr(m, "_setTrace",
                         lambda self, f: None)  # pragma: no cover
+    # a refresh within this many seconds of the last answer is satisfied
+    # from the cache, without asking the server
+    CACHE_TTL = 5.0
+
+    def __attrs_post_init__(self):
+        self._cached = None  # set of nameplate ids, from the last answer
+        self._cached_at = None
 
     def wire(self, rendezvous_connector, input):
         self._RC = _interfaces.IRendezvousConnector(rendezvous_connector)
         self._I = _interfaces.IInput(input)
 
+    # Tab-completion refreshes on every keypress, and on a busy server the
+    # full list is large, so we remember the last answer. A fresh one is
+    # handed out right away. A stale one is handed out too, so completion
+    # never waits on the server, while we ask for a new list in the
+    # background (which is delivered when it arrives).
+    def refresh(self):
+        if self._reactor is None or self._cached is None:
+            self._refresh()
+            return
+        self._I.got_nameplates(self._cached)
+        if self._reactor.seconds() - self._cached_at >= self.CACHE_TTL:
+            self._refresh()
+
     # Ideally, each API request would spawn a new "list_nameplates" message
     # to the server, so the response would be maximally fresh, but that would
     # require correlating server request+response messages, and the protocol
@@ -54,7 +76,7 @@ class Lister(object):
         pass
 
     @m.input()
-    def refresh(self):
+    def _refresh(self):
         pass
 
     @m.input()
@@ -70,24 +92,27 @@ class Lister(object):
         # We get a set of nameplate ids. There may be more attributes in the
         # future: change RendezvousConnector._response_handle_nameplates to
         # get them
+        if self._reactor is not None:
+            self._cached = all_nameplates
+            self._cached_at = self._reactor.seconds()
         self._I.got_nameplates(all_nameplates)
 
     S0A_idle_disconnected.upon(connected, enter=S0B_idle_connected, outputs=[])
     S0B_idle_connected.upon(lost, enter=S0A_idle_disconnected, outputs=[])
 
     S0A_idle_disconnected.upon(
-        refresh, enter=S1A_wanting_disconnected, outputs=[])
+        _refresh, enter=S1A_wanting_disconnected, outputs=[])
     S1A_wanting_disconnected.upon(
-        refresh, enter=S1A_wanting_disconnected, outputs=[])
+        _refresh, enter=S1A_wanting_disconnected, outputs=[])
     S1A_wanting_disconnected.upon(
         connected, enter=S1B_wanting_connected, outputs=[RC_tx_list])
     S0B_idle_connected.upon(
-        refresh, enter=S1B_wanting_connected, outputs=[RC_tx_list])
+        _refresh, enter=S1B_wanting_connected, outputs=[RC_tx_list])
     S0B_idle_connected.upon(
         rx_nameplates, enter=S0B_idle_connected, outputs=[I_got_nameplates])
     S1B_wanting_connected.upon(
         lost, enter=S1A_wanting_disconnected, outputs=[])
     S1B_wanting_connected.upon(
-        refresh, enter=S1B_wanting_connected, outputs=[RC_tx_list])
+        _refresh, enter=S1B_wanting_connected, outputs=[RC_tx_list])
     S1B_wanting_connected.upon(
         rx_nameplates, enter=S0B_idle_connected, outputs=[I_got_nameplates])
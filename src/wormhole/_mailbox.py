@@ -1,11 +1,14 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+from collections import OrderedDict
+
 from attr import attrib, attrs
 from attr.validators import instance_of
 from automat import MethodicalMachine
 from zope.interface import implementer
 
 from . import _interfaces
+from .util import bytes_to_hexstr, hexstr_to_bytes
 
 
 @attrs
@@ -15,10 +18,15 @@ class Mailbox(object):
     m = MethodicalMachine()
     set_trace = getattr(m, "_setTrace",
                         lambda self, f: None)  # pragma: no cover
+    # we stop sending once this many bytes are waiting for the server to ack
+    # them (but always send at least one message), so a large message that
+    # was sent in chunks doesn't sit in front of everything else
+    MAX_IN_FLIGHT = 256 * 1024
 
     def __attrs_post_init__(self):
         self._mailbox = None
-        self._pending_outbound = {}
+        self._pending_outbound = OrderedDict()
+        self._in_flight = {}  # phase -> size, sent on this connection
         self._processed = set()
 
     def wire(self, nameplate, rendezvous_connector, ordering, terminator):
@@ -27,41 +35,68 @@ class Mailbox(object):
         self._O = _interfaces.IOrder(ordering)
         self._T = _interfaces.ITerminator(terminator)
 
+    @m.serializer()
+    def serialize(self, state):
+        if state.endswith("B"):
+            state = state[:-1] + "A"
+        # nothing is in flight once we're disconnected
+        outbound = [[phase, bytes_to_hexstr(body)]
+                    for phase, body in self._pending_outbound.items()]
+        return {
+            "state": state,
+            "mailbox": self._mailbox,
+            "pending_outbound": outbound,
+            "processed": sorted(self._processed),
+            "mood": getattr(self, "_mood", None),
+        }
+
+    @m.unserializer()
+    def restore(self, data):
+        self._mailbox = data["mailbox"]
+        self._pending_outbound = OrderedDict(
+            (phase, hexstr_to_bytes(body))
+            for phase, body in data["pending_outbound"])
+        self._in_flight = {}
+        self._processed = set(data["processed"])
+        if data["mood"] is not None:
+            self._mood = data["mood"]
+        return data["state"]
+
     # all -A states: not connected
     # all -B states: yes connected
     # B states serialize as A, so they deserialize as unconnected
 
     # S0: know nothing
-    @m.state(initial=True)
+    @m.state(initial=True, serialized="S0A")
     def S0A(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S0B")
     def S0B(self):
         pass  # pragma: no cover
 
     # S1: mailbox known, not opened
-    @m.state()
+    @m.state(serialized="S1A")
     def S1A(self):
         pass  # pragma: no cover
 
     # S2: mailbox known, opened
     # We've definitely tried to open the mailbox at least once, but it must
     # be re-opened with each connection, because open() is also subscribe()
-    @m.state()
+    @m.state(serialized="S2A")
     def S2A(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S2B")
     def S2B(self):
         pass  # pragma: no cover
 
     # S3: closing
-    @m.state()
+    @m.state(serialized="S3A")
     def S3A(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S3B")
     def S3B(self):
         pass  # pragma: no cover
 
@@ -70,7 +105,7 @@ class Mailbox(object):
     # def S4A(self): pass
     # @m.state()
     # def S4B(self): pass
-    @m.state(terminal=True)
+    @m.state(terminal=True, serialized="S4")
     def S4(self):
         pass  # pragma: no cover
 
@@ -117,6 +152,12 @@ class Mailbox(object):
     def rx_closed(self):
         pass
 
+    # the server has our message, so if we reconnect, re-opening the
+    # mailbox is enough to get it echoed back
+    @m.input()
+    def rx_acked(self, phase):
+        pass
+
     # from Send or Key
     @m.input()
     def add_message(self, phase, body):
@@ -148,14 +189,25 @@ class Mailbox(object):
         self._drain()
 
     def _drain(self):
+        self._in_flight.clear()
+        self._send_more()
+
+    def _send_more(self):
+        in_flight = sum(self._in_flight.values())
         for phase, body in self._pending_outbound.items():
+            if phase in self._in_flight:
+                continue
+            if self._in_flight and in_flight + len(body) > self.MAX_IN_FLIGHT:
+                break
+            self._in_flight[phase] = len(body)
+            in_flight += len(body)
             self._RC.tx_add(phase, body)
 
     @m.output()
-    def RC_tx_add(self, phase, body):
+    def send_more(self, phase, body):
         assert isinstance(phase, type("")), type(phase)
         assert isinstance(body, type(b"")), type(body)
-        self._RC.tx_add(phase, body)
+        self._send_more()
 
     @m.output()
     def N_release_and_accept(self, side, phase, body):
@@ -174,7 +226,16 @@ class Mailbox(object):
 
     @m.output()
     def dequeue(self, phase, body):
+        self._dequeue(phase)
+
+    @m.output()
+    def dequeue_acked(self, phase):
+        self._dequeue(phase)
+
+    def _dequeue(self, phase):
         self._pending_outbound.pop(phase, None)
+        if self._in_flight.pop(phase, None) is not None:
+            self._send_more()
 
     @m.output()
     def record_mood(self, mood):
@@ -213,9 +274,10 @@ class Mailbox(object):
     S2A.upon(add_message, enter=S2A, outputs=[queue])
     S2A.upon(close, enter=S3A, outputs=[record_mood])
     S2B.upon(lost, enter=S2A, outputs=[])
-    S2B.upon(add_message, enter=S2B, outputs=[queue, RC_tx_add])
+    S2B.upon(add_message, enter=S2B, outputs=[queue, send_more])
     S2B.upon(rx_message_theirs, enter=S2B, outputs=[N_release_and_accept])
     S2B.upon(rx_message_ours, enter=S2B, outputs=[dequeue])
+    S2B.upon(rx_acked, enter=S2B, outputs=[dequeue_acked])
     S2B.upon(close, enter=S3B, outputs=[record_mood_and_RC_tx_close])
 
     S3A.upon(connected, enter=S3B, outputs=[RC_tx_close])
@@ -224,6 +286,7 @@ class Mailbox(object):
     S3B.upon(add_message, enter=S3B, outputs=[])
     S3B.upon(rx_message_theirs, enter=S3B, outputs=[])
     S3B.upon(rx_message_ours, enter=S3B, outputs=[])
+    S3B.upon(rx_acked, enter=S3B, outputs=[])
     S3B.upon(close, enter=S3B, outputs=[])
 
     S4A.upon(connected, enter=S4B, outputs=[])
@@ -231,4 +294,5 @@ class Mailbox(object):
     S4.upon(add_message, enter=S4, outputs=[])
     S4.upon(rx_message_theirs, enter=S4, outputs=[])
     S4.upon(rx_message_ours, enter=S4, outputs=[])
+    S4.upon(rx_acked, enter=S4, outputs=[])
     S4.upon(close, enter=S4, outputs=[])
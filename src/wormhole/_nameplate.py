@@ -31,48 +31,59 @@ class Nameplate(object):
         self._RC = _interfaces.IRendezvousConnector(rendezvous_connector)
         self._T = _interfaces.ITerminator(terminator)
 
+    @m.serializer()
+    def serialize(self, state):
+        if state.endswith("B"):
+            state = state[:-1] + "A"
+        return {"state": state, "nameplate": self._nameplate}
+
+    @m.unserializer()
+    def restore(self, data):
+        self._nameplate = data["nameplate"]
+        return data["state"]
+
     # all -A states: not connected
     # all -B states: yes connected
     # B states serialize as A, so they deserialize as unconnected
 
     # S0: know nothing
-    @m.state(initial=True)
+    @m.state(initial=True, serialized="S0A")
     def S0A(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S0B")
     def S0B(self):
         pass  # pragma: no cover
 
     # S1: nameplate known, never claimed
-    @m.state()
+    @m.state(serialized="S1A")
     def S1A(self):
         pass  # pragma: no cover
 
     # S2: nameplate known, maybe claimed
-    @m.state()
+    @m.state(serialized="S2A")
     def S2A(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S2B")
     def S2B(self):
         pass  # pragma: no cover
 
     # S3: nameplate claimed
-    @m.state()
+    @m.state(serialized="S3A")
     def S3A(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S3B")
     def S3B(self):
         pass  # pragma: no cover
 
     # S4: maybe released
-    @m.state()
+    @m.state(serialized="S4A")
     def S4A(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S4B")
     def S4B(self):
         pass  # pragma: no cover
 
@@ -82,7 +93,7 @@ class Nameplate(object):
     # def S5A(self): pass
     # @m.state()
     # def S5B(self): pass
-    @m.state()
+    @m.state(serialized="S5")
     def S5(self):
         pass  # pragma: no cover
 
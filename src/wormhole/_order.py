@@ -6,6 +6,7 @@ from automat import MethodicalMachine
 from zope.interface import implementer
 
 from . import _interfaces
+from .util import bytes_to_hexstr, hexstr_to_bytes
 
 
 @attrs
@@ -25,11 +26,25 @@ class Order(object):
         self._K = _interfaces.IKey(key)
         self._R = _interfaces.IReceive(receive)
 
-    @m.state(initial=True)
+    @m.serializer()
+    def serialize(self, state):
+        return {
+            "state": state,
+            "queue": [[side, phase, bytes_to_hexstr(body)]
+                      for (side, phase, body) in self._queue],
+        }
+
+    @m.unserializer()
+    def restore(self, data):
+        self._queue = [(side, phase, hexstr_to_bytes(body))
+                       for (side, phase, body) in data["queue"]]
+        return data["state"]
+
+    @m.state(initial=True, serialized="S0_no_pake")
     def S0_no_pake(self):
         pass  # pragma: no cover
 
-    @m.state(terminal=True)
+    @m.state(terminal=True, serialized="S1_yes_pake")
     def S1_yes_pake(self):
         pass  # pragma: no cover
 
@@ -6,7 +6,8 @@ from automat import MethodicalMachine
 from zope.interface import implementer
 
 from . import _interfaces
-from ._key import CryptoError, decrypt_data, derive_key, derive_phase_key
+from ._key import CryptoError, PhaseKeys, derive_key
+from .util import bytes_to_hexstr, hexstr_to_bytes
 
 
 @attrs
@@ -25,19 +26,34 @@ class Receive(object):
         self._B = _interfaces.IBoss(boss)
         self._S = _interfaces.ISend(send)
 
-    @m.state(initial=True)
+    @m.serializer()
+    def serialize(self, state):
+        key = self._key
+        return {
+            "state": state,
+            "key": bytes_to_hexstr(key) if key is not None else None,
+        }
+
+    @m.unserializer()
+    def restore(self, data):
+        if data["key"] is not None:
+            self._key = hexstr_to_bytes(data["key"])
+            self._phase_keys = PhaseKeys(self._key)
+        return data["state"]
+
+    @m.state(initial=True, serialized="S0_unknown_key")
     def S0_unknown_key(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S1_unverified_key")
     def S1_unverified_key(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S2_verified_key")
     def S2_verified_key(self):
         pass  # pragma: no cover
 
-    @m.state(terminal=True)
+    @m.state(terminal=True, serialized="S3_scared")
     def S3_scared(self):
         pass  # pragma: no cover
 
@@ -47,9 +63,8 @@ class Receive(object):
         assert isinstance(phase, type("")), type(phase)
         assert isinstance(body, type(b"")), type(body)
         assert self._key
-        data_key = derive_phase_key(self._key, side, phase)
         try:
-            plaintext = decrypt_data(data_key, body)
+            plaintext = self._phase_keys.decrypt(side, phase, body)
         except CryptoError:
             self.got_message_bad()
             return
@@ -71,6 +86,7 @@ class Receive(object):
     @m.output()
     def record_key(self, key):
         self._key = key
+        self._phase_keys = PhaseKeys(key)
 
     @m.output()
     def S_got_verified_key(self, phase, plaintext):
@@ -1,19 +1,43 @@
 from __future__ import print_function, absolute_import, unicode_literals
 import os
+import random
+from collections import OrderedDict, deque
 from six.moves.urllib_parse import urlparse
 from attr import attrs, attrib
 from attr.validators import provides, instance_of, optional
 from zope.interface import implementer
 from twisted.python import log
-from twisted.internet import defer, endpoints, task
+from twisted.internet import defer, endpoints, error, protocol, task
+from twisted.internet.interfaces import IStreamClientEndpoint
 from twisted.application import internet
 from autobahn.twisted import websocket
 from . import _interfaces, errors
 from .util import (bytes_to_hexstr, hexstr_to_bytes, bytes_to_dict,
-                   dict_to_bytes)
+                   dict_to_bytes, bytes_to_b64str, b64str_to_bytes)
+
+
+def retry_policy(initial_delay=0.1, factor=2.0, max_delay=60.0, jitter=0.5,
+                 _random=random.random):
+    """Return a retryPolicy for our ClientService. It waits initial_delay
+    before the first attempt to reconnect, and factor times longer before
+    each one after that, up to max_delay. Each delay is stretched by a
+    random fraction (up to jitter) of itself, so that clients which lost
+    the same server don't all come back at the same moment."""
+
+    def policy(attempt):
+        # attempt counts from 1. Clamp the exponent so a client that stays
+        # disconnected for days can't overflow the float.
+        delay = initial_delay * factor**min(attempt - 1, 100)
+        delay = min(delay, max_delay)
+        return delay * (1 + jitter * _random())
+
+    return policy
 
 
 class WSClient(websocket.WebSocketClientProtocol):
+    _race = None  # the _Race we are in, until the server welcomes us
+    _session = None  # what our ClientService sees, once we've won
+
     def onConnect(self, response):
         # this fires during WebSocket negotiation, and isn't very useful
         # unless you want to modify the protocol settings
@@ -24,10 +48,22 @@ class WSClient(websocket.WebSocketClientProtocol):
         # this fires when the WebSocket is ready to go. No arguments
         # print("onOpen", args)
         # self.wormhole_open = True
+        if self._race:
+            return  # we might lose, so wait for the welcome
+        self._RC.ws_open(self)
+
+    def won(self, welcome):
+        # we were the first replica to say hello
+        self._race = None
         self._RC.ws_open(self)
+        self.onMessage(welcome, False)
 
     def onMessage(self, payload, isBinary):
         assert not isBinary
+        if self._race:
+            # the server sends a welcome as soon as we connect
+            self._race.welcomed(self, payload)
+            return
         try:
             self._RC.ws_message(payload)
         except Exception:
@@ -38,6 +74,9 @@ class WSClient(websocket.WebSocketClientProtocol):
 
     def onClose(self, wasClean, code, reason):
         # print("onClose")
+        if self._race:
+            self._race.closed(self, reason)
+            return
         self._RC.ws_close(wasClean, code, reason)
         # if self.wormhole_open:
         #     self.wormhole._ws_closed(wasClean, code, reason)
@@ -46,6 +85,11 @@ class WSClient(websocket.WebSocketClientProtocol):
         #     # finishing WebSocket negotiation (onOpen): errback
         #     self.factory.d.errback(error.ConnectError(reason))
 
+    def connectionLost(self, reason):
+        websocket.WebSocketClientProtocol.connectionLost(self, reason)
+        if self._session:
+            self._session.connectionLost(reason)
+
 
 class WSFactory(websocket.WebSocketClientFactory):
     protocol = WSClient
@@ -61,6 +105,270 @@ class WSFactory(websocket.WebSocketClientFactory):
         return proto
 
 
+# When we're given several mailbox URLs (replicas of the same server), our
+# ClientService connects to a _Replicas endpoint, which connects to all of
+# them, each a little after the last (or as soon as the one before it
+# fails), and uses whichever one sends its welcome message first.
+
+
+class _Session(protocol.Protocol):
+    # This is what our ClientService sees of the WSClient that won a _Race.
+    # The WSClient passes its connectionLost() along, so the ClientService
+    # knows when to reconnect.
+    pass
+
+
+class _CandidateFactory(protocol.Factory):
+    def __init__(self, ws_factory, race, replica):
+        self._ws_factory = ws_factory
+        self._race = race
+        self._replica = replica
+
+    def buildProtocol(self, addr):
+        proto = self._ws_factory.buildProtocol(addr)
+        proto._race = self._race
+        proto._replica = self._replica
+        return proto
+
+
+@implementer(IStreamClientEndpoint)
+class _Replicas(object):
+    def __init__(self, reactor, replicas, delay):
+        self._reactor = reactor
+        self._replicas = replicas  # list of (url, WSFactory, endpoint)
+        self._delay = delay
+        self._winner = None  # index of the replica that won last time
+
+    def connect(self, factory):
+        order = list(range(len(self._replicas)))
+        if self._winner is not None:
+            # we're reconnecting, so the one that dropped us goes last
+            order = order[self._winner + 1:] + order[:self._winner + 1]
+        return _Race(self, factory, order).start()
+
+
+class _Race(object):
+    def __init__(self, replicas, factory, order):
+        self._replicas = replicas
+        self._factory = factory
+        self._waiting = deque(order)
+        self._connecting = {}  # replica -> Deferred from endpoint.connect
+        self._candidates = {}  # replica -> WSClient waiting for a welcome
+        self._timer = None
+        self._done = False
+        self._d = defer.Deferred(self._cancel)
+
+    def start(self):
+        self._next()
+        return self._d
+
+    def _next(self):
+        self._timer = None
+        i = self._waiting.popleft()
+        url, ws_factory, ep = self._replicas._replicas[i]
+        d = ep.connect(_CandidateFactory(ws_factory, self, i))
+        self._connecting[i] = d
+        d.addCallbacks(self._connected, self._failed,
+                       callbackArgs=(i, ), errbackArgs=(i, ))
+        if self._waiting:
+            self._timer = self._replicas._reactor.callLater(
+                self._replicas._delay, self._next)
+
+    def _connected(self, proto, i):
+        del self._connecting[i]
+        self._candidates[i] = proto
+
+    def _failed(self, f, i):
+        del self._connecting[i]
+        self._lost(f.value)
+
+    def closed(self, proto, reason):
+        self._candidates.pop(proto._replica, None)
+        self._lost(reason)
+
+    def _lost(self, reason):
+        if self._done:
+            return
+        if self._waiting:
+            # don't wait for the timer
+            self._timer.cancel()
+            self._next()
+        elif not self._connecting and not self._candidates:
+            self._done = True
+            # like a single server, fail with whatever went wrong last
+            if not isinstance(reason, Exception):
+                reason = error.ConnectError(string=reason)
+            self._d.errback(reason)
+
+    def welcomed(self, proto, welcome):
+        if self._done:
+            return
+        self._done = True
+        i = proto._replica
+        del self._candidates[i]
+        self._stop_others()
+        self._replicas._winner = i
+        log.msg("using mailbox server %s" % self._replicas._replicas[i][0])
+        session = self._factory.buildProtocol(proto.transport.getPeer())
+        session.makeConnection(proto.transport)
+        proto._session = session
+        self._d.callback(session)
+        proto.won(welcome)
+
+    def _stop_others(self):
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+        self._waiting.clear()
+        for d in list(self._connecting.values()):
+            d.cancel()
+        for proto in list(self._candidates.values()):
+            proto.transport.abortConnection()
+
+    def _cancel(self, d):
+        # our ClientService is shutting down
+        self._done = True
+        self._stop_others()
+
+
+class RendezvousPool(object):
+    """Wormholes created with the same pool (by passing rendezvous_pool= to
+    wormhole.create) share one WebSocket to their mailbox server, if the
+    server says it can do that ("multiplex-v1" in its welcome message).
+    Otherwise each wormhole gets its own connection, as usual."""
+
+    def __init__(self):
+        self._connections = {}  # (url, tor) -> _SharedConnection
+
+    def _channel(self, rc):
+        key = (rc._url, rc._tor)
+        if key not in self._connections:
+            self._connections[key] = _SharedConnection(self, key, rc)
+        return _Channel(self._connections[key], rc)
+
+    def _forget(self, key):
+        del self._connections[key]
+
+
+class _SharedConnection(object):
+    # One ClientService and WebSocket, with a _Channel for each wormhole
+    # using it. Each channel binds separately, and is named by its side. The
+    # server copies the channel into every response, which is how we route
+    # them.
+
+    def __init__(self, pool, key, rc):
+        self._pool = pool
+        self._key = key
+        self._reactor = rc._reactor
+        self._channels = OrderedDict()  # side -> _Channel, oldest first
+        self._ws = None
+        self._welcome = None  # the welcome payload, on this connection
+        self._multiplex = None  # whether the server can share, once we know
+        # the first wormhole's settings serve for all of them
+        self._connector = rc._make_connector(self)
+        self._running = False
+
+    def whenConnected(self, failAfterFailures=None):
+        return self._connector.whenConnected(
+            failAfterFailures=failAfterFailures)
+
+    def attach(self, channel):
+        self._channels[channel.side] = channel
+        if not self._running:
+            self._running = True
+            self._connector.startService()
+        elif self._multiplex is False:
+            del self._channels[channel.side]
+            channel.go_solo()
+        elif self._welcome is not None:
+            # not from inside Boss.start()
+            self._reactor.callLater(0, self._open, channel)
+
+    def detach(self, channel):
+        if self._channels.get(channel.side) is not channel:
+            return defer.succeed(None)
+        del self._channels[channel.side]
+        if self._multiplex and channel.rc._ws is channel:
+            # let the server forget this channel
+            channel.rc._tx("unbind")
+        if self._channels:
+            return defer.succeed(None)
+        self._pool._forget(self._key)
+        return defer.maybeDeferred(self._connector.stopService)
+
+    def _open(self, channel):
+        if self._channels.get(channel.side) is channel and self._ws:
+            channel.rc.ws_message(self._welcome)
+            channel.rc.ws_open(channel)
+
+    # from our WSClient
+    def ws_open(self, proto):
+        # nobody can bind until the welcome says whether they all can
+        self._ws = proto
+
+    def ws_message(self, payload):
+        if self._welcome is None:
+            self._welcome = payload
+            welcome = bytes_to_dict(payload).get("welcome", {})
+            self._multiplex = "multiplex-v1" in welcome
+            channels = list(self._channels.values())
+            if not self._multiplex:
+                # the oldest wormhole keeps this connection, and the rest
+                # get their own
+                for channel in channels[1:]:
+                    del self._channels[channel.side]
+                    channel.go_solo()
+                channels = channels[:1]
+            for channel in channels:
+                self._open(channel)
+            return
+        if not self._multiplex:
+            for channel in list(self._channels.values()):
+                channel.rc.ws_message(payload)
+            return
+        msg = bytes_to_dict(payload)
+        side = msg.get("channel") or msg.get("orig", {}).get("channel")
+        channel = self._channels.get(side)
+        if channel:
+            channel.rc.ws_message(payload)
+        # otherwise it's for a wormhole that has already gone
+
+    def ws_close(self, wasClean, code, reason):
+        self._ws = None
+        self._welcome = None
+        for channel in list(self._channels.values()):
+            channel.rc.ws_close(wasClean, code, reason)
+
+
+class _Channel(object):
+    # This stands in for a RendezvousConnector's ClientService, and (once
+    # the shared connection is open) for its WSClient.
+
+    def __init__(self, shared, rc):
+        self._shared = shared
+        self.rc = rc
+        self.side = rc._side
+        self._solo = None  # our own ClientService, if the server can't share
+
+    def whenConnected(self, failAfterFailures=None):
+        return self._shared.whenConnected(failAfterFailures)
+
+    def startService(self):
+        self._shared.attach(self)
+
+    def stopService(self):
+        if self._solo:
+            return self._solo.stopService()
+        return self._shared.detach(self)
+
+    def go_solo(self):
+        self._solo = self.rc._make_connector(self.rc)
+        self._solo.startService()
+
+    def sendMessage(self, payload, isBinary):
+        self._shared._ws.sendMessage(payload, isBinary)
+
+
 @attrs
 @implementer(_interfaces.IRendezvousConnector)
 class RendezvousConnector(object):
@@ -72,6 +380,17 @@ class RendezvousConnector(object):
     _tor = attrib(validator=optional(provides(_interfaces.ITorManager)))
     _timing = attrib(validator=provides(_interfaces.ITiming))
     _client_version = attrib(validator=instance_of(tuple))
+    _retry_policy = attrib(default=None)
+    _pool = attrib(default=None)
+    # Message bodies are hex unless the server's welcome says it can do
+    # better, and we asked for it in our bind.
+    BODY_ENCODINGS = ["base64"]
+    # if the server can take several adds in one frame, we send the ones
+    # from each reactor turn together
+    BATCH_ADDS = True
+    # with several mailbox replicas, we connect to the next one if the last
+    # hasn't welcomed us after this long
+    REPLICA_DELAY = 0.5
 
     def __attrs_post_init__(self):
         self._have_made_a_successful_connection = False
@@ -79,10 +398,24 @@ class RendezvousConnector(object):
 
         self._trace = None
         self._ws = None
-        f = WSFactory(self, self._url)
-        f.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
-        ep = self._make_endpoint(self._url)
-        self._connector = internet.ClientService(ep, f)
+        # a caller's own timing object may not say whether it is enabled:
+        # give it every event, as we always used to
+        self._record_timing = getattr(self._timing, "enabled", True)
+        if self._pool:
+            # share a WebSocket with other wormholes, if the server can
+            self._connector = self._pool._channel(self)
+        else:
+            self._connector = self._make_connector(self)
+        self._unacked_adds = {}  # msgid -> phase, for this connection
+        self._unacked_ids = set()  # every msgid not yet acked, ditto
+        self._base64 = False  # for bodies, on this connection
+        self._batching = False  # on this connection
+        self._pending_adds = []  # (phase, body), until the end of this turn
+        # if the server can send just the changes since our last list
+        self._list_deltas = False
+        self._nameplates = None  # set of ids, as of _nameplates_version
+        self._nameplates_version = None
+        self._flush_call = None
         faf = None if self._have_made_a_successful_connection else 1
         d = self._connector.whenConnected(failAfterFailures=faf)
         # if the initial connection fails, signal an error and shut down. do
@@ -92,6 +425,23 @@ class RendezvousConnector(object):
         d.addErrback(self._initial_connection_failed)
         self._debug_record_inbound_f = None
 
+    def _make_connector(self, owner):
+        # owner hears ws_open/ws_message/ws_close from the WebSocket
+        # a comma-separated list of URLs are replicas of the same server
+        urls = [url.strip() for url in self._url.split(",") if url.strip()]
+        replicas = []
+        for url in urls:
+            f = WSFactory(owner, url)
+            f.setProtocolOptions(autoPingInterval=60, autoPingTimeout=600)
+            replicas.append((url, f, self._make_endpoint(url)))
+        if len(replicas) > 1:
+            ep = _Replicas(self._reactor, replicas, self.REPLICA_DELAY)
+            f = protocol.Factory.forProtocol(_Session)
+        else:
+            url, f, ep = replicas[0]
+        return internet.ClientService(
+            ep, f, retryPolicy=self._retry_policy or retry_policy())
+
     def set_trace(self, f):
         self._trace = f
 
@@ -132,7 +482,36 @@ class RendezvousConnector(object):
     def tx_add(self, phase, body):
         assert isinstance(phase, type("")), type(phase)
         assert isinstance(body, type(b"")), type(body)
-        self._tx("add", phase=phase, body=bytes_to_hexstr(body))
+        if self._batching:
+            self._pending_adds.append((phase, body))
+            if not self._flush_call:
+                self._flush_call = self._reactor.callLater(0,
+                                                           self._flush_adds)
+            return
+        msgid = self._tx("add", phase=phase, body=self._encode_body(body))
+        # once the server acks this, we need not send it again if we have to
+        # reconnect
+        self._unacked_adds[msgid] = phase
+
+    def _flush_adds(self):
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        adds, self._pending_adds = self._pending_adds, []
+        if len(adds) == 1:
+            (phase, body) = adds[0]
+            msgid = self._tx("add", phase=phase, body=self._encode_body(body))
+            self._unacked_adds[msgid] = phase
+        elif adds:
+            messages = []
+            for (phase, body) in adds:
+                msg = dict(type="add", phase=phase,
+                           body=self._encode_body(body), id=self._new_id())
+                if self._pool:
+                    msg["channel"] = self._side
+                messages.append(msg)
+                self._unacked_adds[msg["id"]] = phase
+            self._tx("batch", messages=messages)
 
     def tx_release(self, nameplate):
         self._tx("release", nameplate=nameplate)
@@ -152,7 +531,10 @@ class RendezvousConnector(object):
 
     # from Lister
     def tx_list(self):
-        self._tx("list")
+        if self._list_deltas and self._nameplates_version is not None:
+            self._tx("list", since=self._nameplates_version)
+        else:
+            self._tx("list")
 
     # from Code
     def tx_allocate(self):
@@ -179,7 +561,8 @@ class RendezvousConnector(object):
                 "bind",
                 appid=self._appid,
                 side=self._side,
-                client_version=self._client_version)
+                client_version=self._client_version,
+                **{"body-encodings-v1": self.BODY_ENCODINGS})
             self._N.connected()
             self._M.connected()
             self._L.connected()
@@ -191,14 +574,16 @@ class RendezvousConnector(object):
 
     def ws_message(self, payload):
         msg = bytes_to_dict(payload)
-        if msg["type"] != "ack":
+        if msg["type"] != "ack" and self._trace:
             self._debug("R.rx(%s %s%s)" % (
                 msg["type"],
                 msg.get("phase", ""),
                 "[mine]" if msg.get("side", "") == self._side else "",
             ))
 
-        self._timing.add("ws_receive", _side=self._side, message=msg)
+        # this runs for every frame, so don't build events nobody will read
+        if self._record_timing:
+            self._timing.add("ws_receive", _side=self._side, message=msg)
         if self._debug_record_inbound_f:
             self._debug_record_inbound_f(msg)
         mtype = msg["type"]
@@ -220,6 +605,17 @@ class RendezvousConnector(object):
         self._debug("R.lost")
         was_open = bool(self._ws)
         self._ws = None
+        self._unacked_adds.clear()
+        self._unacked_ids.clear()
+        self._base64 = False
+        # the Mailbox will send these again, on the next connection
+        self._batching = False
+        self._pending_adds[:] = []
+        self._list_deltas = False
+        self._nameplates = self._nameplates_version = None
+        if self._flush_call and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
         # when Autobahn connects to a non-websocket server, it gets a
         # CLOSE_STATUS_CODE_ABNORMAL_CLOSE, and delivers onClose() without
         # ever calling onOpen first. This confuses our state machines, so
@@ -252,27 +648,46 @@ class RendezvousConnector(object):
     def _stopped(self, res):
         self._T.stoppedRC()
 
-    def _tx(self, mtype, **kwargs):
-        assert self._ws
+    def _new_id(self):
         # msgid is used by misc/dump-timing.py to correlate our sends with
         # their receives, and vice versa. They are also correlated with the
-        # ACKs we get back from the server (which we otherwise ignore). There
-        # are so few messages, 16 bits is enough to be mostly-unique.
-        kwargs["id"] = bytes_to_hexstr(os.urandom(2))
+        # ACKs we get back from the server. There are so few messages, 16
+        # bits is enough to be mostly-unique, but a message still waiting for
+        # its ack must not share an id with a newer one, or we could take
+        # its ack for an add that the server hasn't seen.
+        while True:
+            msgid = bytes_to_hexstr(os.urandom(2))
+            if msgid not in self._unacked_ids:
+                self._unacked_ids.add(msgid)
+                return msgid
+
+    def _tx(self, mtype, **kwargs):
+        assert self._ws
+        if self._pending_adds and mtype != "batch":
+            # anything else we send must follow the adds before it
+            self._flush_adds()
+        kwargs["id"] = self._new_id()
         kwargs["type"] = mtype
-        self._debug("R.tx(%s %s)" % (mtype.upper(), kwargs.get("phase", "")))
+        if self._pool:
+            # so a shared connection knows who this is from (a server that
+            # doesn't share connections ignores it)
+            kwargs["channel"] = self._side
+        if self._trace:
+            self._debug("R.tx(%s %s)" % (mtype.upper(),
+                                         kwargs.get("phase", "")))
         payload = dict_to_bytes(kwargs)
-        self._timing.add("ws_send", _side=self._side, **kwargs)
+        if self._record_timing:
+            self._timing.add("ws_send", _side=self._side, **kwargs)
         self._ws.sendMessage(payload, False)
+        return kwargs["id"]
 
     def _response_handle_allocated(self, msg):
         nameplate = msg["nameplate"]
         assert isinstance(nameplate, type("")), type(nameplate)
         self._A.rx_allocated(nameplate)
 
-    def _response_handle_nameplates(self, msg):
+    def _nameplate_ids(self, nameplates):
         # we get list of {id: ID}, with maybe more attributes in the future
-        nameplates = msg["nameplates"]
         assert isinstance(nameplates, list), type(nameplates)
         nids = set()
         for n in nameplates:
@@ -280,11 +695,35 @@ class RendezvousConnector(object):
             nameplate_id = n["id"]
             assert isinstance(nameplate_id, type("")), type(nameplate_id)
             nids.add(nameplate_id)
+        return nids
+
+    def _response_handle_nameplates(self, msg):
+        if "nameplates" in msg:
+            nids = self._nameplate_ids(msg["nameplates"])
+        else:
+            # a delta against a list we got earlier on this connection
+            if (self._nameplates is None
+                    or msg.get("since") != self._nameplates_version):
+                # not one we can apply: start over with the whole list
+                self._nameplates_version = None
+                self.tx_list()
+                return
+            nids = ((self._nameplates
+                     - self._nameplate_ids(msg.get("removed", [])))
+                    | self._nameplate_ids(msg.get("added", [])))
+        if self._list_deltas and "version" in msg:
+            self._nameplates = nids
+            self._nameplates_version = msg["version"]
         # deliver a set of nameplate ids
-        self._L.rx_nameplates(nids)
+        self._L.rx_nameplates(set(nids))
 
     def _response_handle_ack(self, msg):
-        pass
+        # the server acks each message before it handles it, and an add it
+        # can't handle gets an error (which is fatal) as well
+        self._unacked_ids.discard(msg.get("id"))
+        phase = self._unacked_adds.pop(msg.get("id"), None)
+        if phase is not None:
+            self._M.rx_acked(phase)
 
     def _response_handle_error(self, msg):
         # the server sent us a type=error. Most cases are due to our mistakes
@@ -296,6 +735,11 @@ class RendezvousConnector(object):
         self._B.rx_error(err, orig)
 
     def _response_handle_welcome(self, msg):
+        encodings = msg["welcome"].get("body-encodings-v1", [])
+        self._base64 = ("base64" in encodings and
+                        "base64" in self.BODY_ENCODINGS)
+        self._batching = "batch-v1" in msg["welcome"] and self.BATCH_ADDS
+        self._list_deltas = "nameplates-since-v1" in msg["welcome"]
         self._B.rx_welcome(msg["welcome"])
 
     def _response_handle_claimed(self, msg):
@@ -307,9 +751,19 @@ class RendezvousConnector(object):
         side = msg["side"]
         phase = msg["phase"]
         assert isinstance(phase, type("")), type(phase)
-        body = hexstr_to_bytes(msg["body"])  # bytes
+        body = self._decode_body(msg["body"])  # bytes
         self._M.rx_message(side, phase, body)
 
+    def _encode_body(self, body):
+        if self._base64:
+            return bytes_to_b64str(body)
+        return bytes_to_hexstr(body)
+
+    def _decode_body(self, body):
+        if self._base64:
+            return b64str_to_bytes(body)
+        return hexstr_to_bytes(body)
+
     def _response_handle_released(self, msg):
         self._N.rx_released()
 
@@ -6,7 +6,8 @@ from automat import MethodicalMachine
 from zope.interface import implementer
 
 from . import _interfaces
-from ._key import derive_phase_key, encrypt_data
+from ._key import PhaseKeys
+from .util import bytes_to_hexstr, hexstr_to_bytes
 
 
 @attrs
@@ -24,11 +25,30 @@ class Send(object):
     def wire(self, mailbox):
         self._M = _interfaces.IMailbox(mailbox)
 
-    @m.state(initial=True)
+    @m.serializer()
+    def serialize(self, state):
+        key = getattr(self, "_key", None)
+        return {
+            "state": state,
+            "key": bytes_to_hexstr(key) if key is not None else None,
+            "queue": [[phase, bytes_to_hexstr(plaintext)]
+                      for (phase, plaintext) in self._queue],
+        }
+
+    @m.unserializer()
+    def restore(self, data):
+        if data["key"] is not None:
+            self._key = hexstr_to_bytes(data["key"])
+            self._phase_keys = PhaseKeys(self._key)
+        self._queue = [(phase, hexstr_to_bytes(plaintext))
+                       for (phase, plaintext) in data["queue"]]
+        return data["state"]
+
+    @m.state(initial=True, serialized="S0_no_key")
     def S0_no_key(self):
         pass  # pragma: no cover
 
-    @m.state(terminal=True)
+    @m.state(terminal=True, serialized="S1_verified_key")
     def S1_verified_key(self):
         pass  # pragma: no cover
 
@@ -51,12 +71,14 @@ class Send(object):
     @m.output()
     def record_key(self, key):
         self._key = key
+        self._phase_keys = PhaseKeys(key)
 
     @m.output()
     def drain(self, key):
         del key
-        for (phase, plaintext) in self._queue:
-            self._encrypt_and_send(phase, plaintext)
+        encrypted = self._phase_keys.encrypt_many(self._side, self._queue)
+        for ((phase, plaintext), body) in zip(self._queue, encrypted):
+            self._M.add_message(phase, body)
         self._queue[:] = []
 
     @m.output()
@@ -67,8 +89,7 @@ class Send(object):
 
     def _encrypt_and_send(self, phase, plaintext):
         assert self._key
-        data_key = derive_phase_key(self._key, self._side, phase)
-        encrypted = encrypt_data(data_key, plaintext)
+        encrypted = self._phase_keys.encrypt(self._side, phase, plaintext)
         self._M.add_message(phase, encrypted)
 
     S0_no_key.upon(send, enter=S0_no_key, outputs=[queue])
@@ -22,6 +22,15 @@ class Terminator(object):
         self._M = _interfaces.IMailbox(mailbox)
         self._D = _interfaces.IDilator(dilator)
 
+    @m.serializer()
+    def serialize(self, state):
+        return {"state": state, "mood": self._mood}
+
+    @m.unserializer()
+    def restore(self, data):
+        self._mood = data["mood"]
+        return data["state"]
+
     # 2*2-1+1 main states:
     # (nm, m, n, d): nameplate and/or mailbox is active
     # (o, ""): open (not-yet-closing), or trying to close
@@ -34,46 +43,46 @@ class Terminator(object):
     # We start in Snmo (non-closing). When both nameplate and mailboxes are
     # done, and we're closing, then we stop the RendezvousConnector
 
-    @m.state(initial=True)
+    @m.state(initial=True, serialized="Snmo")
     def Snmo(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="Smo")
     def Smo(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="Sno")
     def Sno(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S0o")
     def S0o(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="Snm")
     def Snm(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="Sm")
     def Sm(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="Sn")
     def Sn(self):
         pass  # pragma: no cover
 
     # @m.state()
     # def S0(self): pass # unused
 
-    @m.state()
+    @m.state(serialized="S_stoppingRC")
     def S_stoppingRC(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S_stoppingD")
     def S_stoppingD(self):
         pass  # pragma: no cover
 
-    @m.state()
+    @m.state(serialized="S_stopped")
     def S_stopped(self, terminal=True):
         pass  # pragma: no cover
 
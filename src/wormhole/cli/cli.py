@@ -14,12 +14,12 @@ from twisted.internet.task import react  # noqa: E402
 from twisted.python.failure import Failure  # noqa: E402
 
 from . import public_relay  # noqa: E402
-from .. import __version__  # noqa: E402
+from .. import __version__, ipaddrs  # noqa: E402
 from ..errors import (KeyFormatError, NoTorError,  # noqa: E402
                       ServerConnectionError,
                       TransferError, UnsendableFileError, WelcomeError,
                       WrongPasswordError)
-from ..timing import DebugTiming  # noqa: E402
+from ..timing import DebugTiming, NullTiming  # noqa: E402
 
 top_import_finish = time.time()
 
@@ -33,7 +33,7 @@ class Config(object):
         # This only holds attributes which are *not* set by CLI arguments.
         # Everything else comes from Click decorators, so we can be sure
         # we're exercising the defaults.
-        self.timing = DebugTiming()
+        self.timing = NullTiming()
         self.cwd = os.getcwd()
         self.stdout = stdout
         self.stderr = stderr
@@ -49,6 +49,15 @@ def _compose(*decorators):
     return decorate
 
 
+def _parse_listen_port(ctx, param, value):
+    if value is None:
+        return None
+    try:
+        return ipaddrs.parse_port_range(value)
+    except ValueError as e:
+        raise click.BadParameter(str(e))
+
+
 ALIASES = {
     "tx": "send",
     "rx": "receive",
@@ -70,15 +79,15 @@ class AliasedGroup(click.Group):
     "--relay-url",
     default=public_relay.RENDEZVOUS_RELAY,
     envvar='WORMHOLE_RELAY_URL',
-    metavar="URL",
-    help="rendezvous relay to use",
+    metavar="URL[,URL..]",
+    help="rendezvous relay to use (or several replicas of one)",
 )
 @click.option(
     "--transit-helper",
     default=public_relay.TRANSIT_RELAY,
     envvar='WORMHOLE_TRANSIT_HELPER',
-    metavar="tcp:HOST:PORT",
-    help="transit relay to use",
+    metavar="tcp:HOST:PORT[,tcp:HOST:PORT..]",
+    help="transit relay to use (given several, the closest is preferred)",
 )
 @click.option(
     "--dump-timing",
@@ -105,6 +114,8 @@ def wormhole(context, dump_timing, transit_helper, relay_url, appid):
     cfg.relay_url = relay_url
     cfg.transit_helper = transit_helper
     cfg.dump_timing = dump_timing
+    if dump_timing:
+        cfg.timing = DebugTiming()
 
 
 @inlineCallbacks
@@ -185,6 +196,14 @@ CommonArgs = _compose(
         default=True,
         help="(debug) don't open a listening socket for Transit",
     ),
+    click.option(
+        "--listen-port",
+        metavar="PORT[-PORT]",
+        default=None,
+        callback=_parse_listen_port,
+        help=("listen for Transit on this port, or the first free one in "
+              "this range (e.g. one your router forwards)"),
+    ),
 )
 
 TorArgs = _compose(
@@ -236,6 +255,13 @@ def help(context, **kwargs):
     default=False,
     is_flag=True,
     help="Don't raise an error if a file can't be read.")
+@click.option(
+    "--streams",
+    default=1,
+    type=int,
+    metavar="N",
+    help="stripe the transfer across N parallel connections",
+)
 @click.argument("what", required=False, type=click.Path(path_type=type(u"")))
 @click.pass_obj
 def send(cfg, **kwargs):
@@ -12,13 +12,16 @@ from humanize import naturalsize
 from tqdm import tqdm
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThread
 from twisted.python import log
 from wormhole import __version__, create, input_with_completion
 
+from .._rlcompleter import warn_readline
 from ..errors import TransferError
-from ..transit import TransitReceiver
+from ..transit import MAX_STREAMS, TransitReceiver
 from ..util import (bytes_to_dict, bytes_to_hexstr, dict_to_bytes,
-                    estimate_free_space)
+                    estimate_free_space, sha256_file, sha256_tree)
 from .welcome import handle_welcome
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
@@ -59,6 +62,8 @@ class Receiver:
         self._reactor = reactor
         self._tor = None
         self._transit_receiver = None
+        self._transit_connect_d = None
+        self._late_hints_d = None
 
     def _msg(self, *args, **kwargs):
         print(*args, file=self.args.stderr, **kwargs)
@@ -102,6 +107,7 @@ class Receiver:
         # (which might be an error)
         @inlineCallbacks
         def _good(res):
+            self._abandon_transit()
             yield w.close()  # wait for ack
             returnValue(res)
 
@@ -110,6 +116,7 @@ class Receiver:
         # as the original one)
         @inlineCallbacks
         def _bad(f):
+            self._abandon_transit()
             try:
                 yield w.close()  # might be an error too
             except Exception:
@@ -231,19 +238,26 @@ class Receiver:
     @inlineCallbacks
     def _parse_transit(self, sender_transit, w):
         if self._transit_receiver:
-            # TODO: accept multiple messages, add the additional hints to the
-            # existing TransitReceiver
+            # later messages carry hints that the sender discovered late
+            self._transit_receiver.add_connection_hints(
+                sender_transit.get("hints-v1", []),
+                more=bool(sender_transit.get("more-hints-v1")))
             return
         yield self._build_transit(w, sender_transit)
 
     @inlineCallbacks
     def _build_transit(self, w, sender_transit):
+        # the sender may want to stripe the file across several connections
+        streams = max(1, min(int(sender_transit.get("streams-v1", 1)),
+                             MAX_STREAMS))
         tr = TransitReceiver(
             self.args.transit_helper,
             no_listen=(not self.args.listen),
             tor=self._tor,
             reactor=self._reactor,
-            timing=self.args.timing)
+            timing=self.args.timing,
+            streams=streams,
+            listen_ports=self.args.listen_port)
         self._transit_receiver = tr
         # When I made it possible to override APPID with a CLI argument
         # (issue #113), I forgot to also change this w.derive_key() (issue
@@ -254,15 +268,56 @@ class Receiver:
                                    tr.TRANSIT_KEY_LENGTH)
         tr.set_transit_key(transit_key)
 
-        tr.add_connection_hints(sender_transit.get("hints-v1", []))
+        # if the sender is on this host, our hints will include a Unix socket
+        tr.add_connection_abilities(sender_transit.get("abilities-v1", []))
+        tr.add_connection_hints(sender_transit.get("hints-v1", []),
+                                more=bool(sender_transit.get("more-hints-v1")))
         receiver_abilities = tr.get_connection_abilities()
-        receiver_hints = yield tr.get_connection_hints()
+        # If the sender accepts late hints, send the relay hints (which we
+        # already know) right away, and the direct hints in a second message
+        # once our listener is running, instead of making the sender wait
+        # for both.
+        trickle = bool(sender_transit.get("trickle-v1") and
+                       self.args.listen and not self._tor)
+        if trickle:
+            yield tr.probe_relays()
+            receiver_hints = tr.get_relay_connection_hints()
+        else:
+            receiver_hints = yield tr.get_connection_hints()
         receiver_transit = {
             "abilities-v1": receiver_abilities,
             "hints-v1": receiver_hints,
         }
+        if trickle:
+            receiver_transit["more-hints-v1"] = True
+        if streams > 1:
+            receiver_transit["streams-v1"] = streams
+        early = bool(sender_transit.get("early-connect-v1"))
+        if early:
+            receiver_transit["early-connect-v1"] = True
         self._send_data({u"transit": receiver_transit}, w)
-        # TODO: send more hints as the TransitReceiver produces them
+        if trickle:
+            # let the first message go out before we look for addresses
+            d = deferLater(self._reactor, 0, tr.get_direct_connection_hints)
+            d.addErrback(self._late_hints_failed)
+            d.addCallback(self._send_late_hints, w)
+            self._late_hints_d = d
+
+        if early:
+            # The sender will start connecting as soon as it sees our hints,
+            # rather than waiting for our answer, so we can do the TCP
+            # connect, the relay handshake, and the direct/relay race while
+            # the user is still deciding whether to accept the offer. We
+            # hold the winning connection until _establish_transit() wants
+            # it, or _abandon_transit() closes it.
+            self._transit_connect_d = tr.connect()
+
+    def _late_hints_failed(self, f):
+        log.err(f, "unable to get direct connection hints")
+        return []  # but still tell the sender that we're done
+
+    def _send_late_hints(self, hints, w):
+        self._send_data({u"transit": {"hints-v1": hints}}, w)
 
     @inlineCallbacks
     def _parse_offer(self, them_d, w):
@@ -270,16 +325,20 @@ class Receiver:
             self._handle_text(them_d, w)
             returnValue(None)
         # transit will be created by this point, but not connected
+        already_have = yield self._already_have(them_d, w)
+        if already_have:
+            self._send_data({"answer": {"file_ack": "already-have"}}, w)
+            returnValue(None)
         if "file" in them_d:
-            f = self._handle_file(them_d)
-            self._send_permission(w)
+            f = yield self._handle_file(them_d)
+            yield self._send_permission(w)
             rp = yield self._establish_transit()
             datahash = yield self._transfer_data(rp, f)
             self._write_file(f)
             yield self._close_transit(rp, datahash)
         elif "directory" in them_d:
-            f = self._handle_directory(them_d)
-            self._send_permission(w)
+            f = yield self._handle_directory(them_d)
+            yield self._send_permission(w)
             rp = yield self._establish_transit()
             datahash = yield self._transfer_data(rp, f)
             self._write_directory(f)
@@ -295,6 +354,7 @@ class Receiver:
         print(them_d["message"], file=self.args.stdout)
         self._send_data({"answer": {"message_ack": "ok"}}, w)
 
+    @inlineCallbacks
     def _handle_file(self, them_d):
         file_data = them_d["file"]
         self.abs_destname = self._decide_destname("file",
@@ -309,10 +369,11 @@ class Receiver:
         self._msg(u"Receiving file (%s) into: %s" %
                   (naturalsize(self.xfersize),
                    os.path.basename(self.abs_destname)))
-        self._ask_permission()
+        yield self._ask_permission()
         tmp_destname = self.abs_destname + ".tmp"
-        return open(tmp_destname, "wb")
+        returnValue(open(tmp_destname, "wb"))
 
+    @inlineCallbacks
     def _handle_directory(self, them_d):
         file_data = them_d["directory"]
         zipmode = file_data["mode"]
@@ -335,7 +396,7 @@ class Receiver:
                    os.path.basename(self.abs_destname)))
         self._msg(u"%d files, %s (uncompressed)" %
                   (file_data["numfiles"], naturalsize(file_data["numbytes"])))
-        self._ask_permission()
+        yield self._ask_permission()
         f = tempfile.SpooledTemporaryFile()
         # workaround for https://bugs.python.org/issue26175 (STF doesn't
         # fully implement IOBase abstract class), which breaks the new
@@ -343,15 +404,99 @@ class Receiver:
         if not hasattr(f, "seekable"):
             # AFAICT all the filetypes that STF wraps can seek
             f.seekable = lambda: True
-        return f
+        returnValue(f)
 
-    def _decide_destname(self, mode, destname):
+    @inlineCallbacks
+    def _already_have(self, them_d, w):
+        # Newer senders will send a "sha256" digest of what they offer if we
+        # ask (or include it in the offer). If the target already exists
+        # with identical contents, we can skip the transit transfer
+        # entirely.
+        if "file" in them_d:
+            mode, data, name = "file", them_d["file"], "filename"
+        elif "directory" in them_d:
+            mode, data, name = "directory", them_d["directory"], "dirname"
+        else:
+            returnValue(False)
+        expected = data.get("sha256")
+        if name not in data:
+            returnValue(False)
+        if not expected and not data.get("sha256-on-request"):
+            returnValue(False)
+        destname, abs_destname = self._abs_destname(data[name])
+        # Something of a different size can't match, and is cheap to rule
+        # out, so only ask for (or check) a digest if the size is right.
+        if mode == "file":
+            if (not os.path.isfile(abs_destname) or
+                    os.path.getsize(abs_destname) != data.get("filesize")):
+                returnValue(False)
+        else:
+            if not os.path.isdir(abs_destname):
+                returnValue(False)
+            size = yield deferToThread(self._directory_size, abs_destname)
+            if size != (data.get("numfiles"), data.get("numbytes")):
+                returnValue(False)
+        if not expected:
+            expected = yield self._request_sha256(w)
+            if not expected:
+                returnValue(False)
+        with self.args.timing.add("check existing", mode=mode) as t:
+            # hashing a big file takes a while, so keep the wormhole (and
+            # any early transit connection) going meanwhile
+            if mode == "file":
+                existing = yield deferToThread(sha256_file, abs_destname)
+            else:
+                existing = yield deferToThread(self._sha256_directory,
+                                               abs_destname)
+            t.detail(match=(existing == expected))
+        if existing != expected:
+            returnValue(False)
+        self._msg(u"Already have identical %s '%s', skipping transfer" %
+                  (mode, destname))
+        returnValue(True)
+
+    @inlineCallbacks
+    def _request_sha256(self, w):
+        self._send_data({"sha256-request": True}, w)
+        while True:
+            them_d = yield self._get_data(w)
+            if u"transit" in them_d:
+                yield self._parse_transit(them_d[u"transit"], w)
+            if u"sha256" in them_d:
+                returnValue(them_d[u"sha256"])
+
+    def _directory_size(self, abs_dirname):
+        # as counted by cmd_send for "numfiles" and "numbytes"
+        num_files = 0
+        num_bytes = 0
+        for path, dirs, files in os.walk(abs_dirname):
+            for fn in files:
+                num_bytes += os.stat(os.path.join(path, fn)).st_size
+                num_files += 1
+        return num_files, num_bytes
+
+    def _sha256_directory(self, abs_dirname):
+        # must match the digest cmd_send builds for the directory it zipped
+        file_hashes = []
+        for path, dirs, files in os.walk(abs_dirname):
+            for fn in files:
+                localfilename = os.path.join(path, fn)
+                relpath = os.path.relpath(localfilename, abs_dirname)
+                file_hashes.append((relpath.replace(os.sep, "/"),
+                                    sha256_file(localfilename)))
+        return sha256_tree(file_hashes)
+
+    def _abs_destname(self, destname):
         # the basename() is intended to protect us against
         # "~/.ssh/authorized_keys" and other attacks
         destname = os.path.basename(destname)
         if self.args.output_file:
             destname = self.args.output_file  # override
         abs_destname = os.path.abspath(os.path.join(self.args.cwd, destname))
+        return destname, abs_destname
+
+    def _decide_destname(self, mode, destname):
+        destname, abs_destname = self._abs_destname(destname)
 
         # get confirmation from the user before writing to the local directory
         if os.path.exists(abs_destname):
@@ -371,10 +516,11 @@ class Receiver:
         if os.path.isdir(path):
             shutil.rmtree(path)
 
+    @inlineCallbacks
     def _ask_permission(self):
         with self.args.timing.add("permission", waiting="user") as t:
             while True and not self.args.accept_file:
-                ok = six.moves.input("ok? (Y/n): ")
+                ok = yield self._input("ok? (Y/n): ")
                 if ok.lower().startswith("y") or len(ok) == 0:
                     if os.path.exists(self.abs_destname):
                         self._remove_existing(self.abs_destname)
@@ -384,15 +530,45 @@ class Receiver:
                 raise TransferRejectedError()
             t.detail(answer="yes")
 
+    @inlineCallbacks
+    def _input(self, prompt):
+        # input() blocks, so run it in a thread: this keeps the reactor (and
+        # any early transit connection) running while the user decides
+        t = self._reactor.addSystemEventTrigger("before", "shutdown",
+                                                warn_readline)
+        try:
+            answer = yield deferToThread(six.moves.input, prompt)
+        finally:
+            self._reactor.removeSystemEventTrigger(t)
+        returnValue(answer)
+
+    @inlineCallbacks
     def _send_permission(self, w):
+        # the sender stops reading messages once it sees our answer, so our
+        # trickled hints must go out first
+        d, self._late_hints_d = self._late_hints_d, None
+        if d is not None:
+            yield d
         self._send_data({"answer": {"file_ack": "ok"}}, w)
 
     @inlineCallbacks
     def _establish_transit(self):
-        record_pipe = yield self._transit_receiver.connect()
+        d, self._transit_connect_d = self._transit_connect_d, None
+        if d is None:
+            d = self._transit_receiver.connect()
+        record_pipe = yield d
         self.args.timing.add("transit connected")
         returnValue(record_pipe)
 
+    def _abandon_transit(self):
+        # drop an early transit connection that we no longer need, because
+        # the offer was rejected, already satisfied, or something failed
+        d, self._transit_connect_d = self._transit_connect_d, None
+        if d is not None:
+            d.addCallbacks(lambda record_pipe: record_pipe.close(),
+                           lambda f: None)
+            d.cancel()
+
     @inlineCallbacks
     def _transfer_data(self, record_pipe, f):
         # now receive the rest of the owl
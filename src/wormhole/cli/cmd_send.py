@@ -13,13 +13,15 @@ from humanize import naturalsize
 from tqdm import tqdm
 from twisted.internet import reactor
 from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.internet.threads import deferToThread
 from twisted.protocols import basic
 from twisted.python import log
 from wormhole import __version__, create
 
 from ..errors import TransferError, UnsendableFileError
-from ..transit import TransitSender
-from ..util import bytes_to_dict, bytes_to_hexstr, dict_to_bytes
+from ..transit import MAX_STREAMS, TransitSender
+from ..util import (bytes_to_dict, bytes_to_hexstr, dict_to_bytes,
+                    sha256_file, sha256_tree)
 from .welcome import handle_welcome
 
 APPID = u"lothar.com/wormhole/text-or-file-xfer"
@@ -45,7 +47,13 @@ class Sender:
         self._tor = None
         self._timing = args.timing
         self._fd_to_send = None
+        # what the receiver can ask us to hash: a file's path, or the
+        # (name, path) of each file in a directory
+        self._offered_file = None
+        self._offered_files = None
         self._transit_sender = None
+        self._early_transit = False
+        self._transit_connect_d = None
 
     @inlineCallbacks
     def go(self):
@@ -75,6 +83,7 @@ class Sender:
         # (which might be an error)
         @inlineCallbacks
         def _good(res):
+            self._abandon_transit()
             yield w.close()  # wait for ack
             returnValue(res)
 
@@ -83,6 +92,7 @@ class Sender:
         # as the original one)
         @inlineCallbacks
         def _bad(f):
+            self._abandon_transit()
             try:
                 yield w.close()  # might be an error too
             except Exception:
@@ -183,7 +193,9 @@ class Sender:
                 no_listen=(not args.listen),
                 tor=self._tor,
                 reactor=self._reactor,
-                timing=self._timing)
+                timing=self._timing,
+                streams=args.streams,
+                listen_ports=args.listen_port)
             self._transit_sender = ts
 
             # for now, send this before the main offer
@@ -192,7 +204,17 @@ class Sender:
             sender_transit = {
                 "abilities-v1": sender_abilities,
                 "hints-v1": sender_hints,
+                # we will connect as soon as we see the receiver's hints
+                # (if they say they'll do the same), instead of waiting
+                # for their answer
+                "early-connect-v1": True,
+                # the receiver may send more hints in later messages
+                "trickle-v1": True,
             }
+            streams = min(args.streams, MAX_STREAMS)
+            if streams > 1:
+                # the receiver says how many of these it will accept
+                sender_transit["streams-v1"] = streams
             self._send_data({u"transit": sender_transit}, w)
 
             # When I made it possible to override APPID with a CLI argument
@@ -223,6 +245,10 @@ class Sender:
             if u"transit" in them_d:
                 recognized = True
                 yield self._handle_transit(them_d[u"transit"])
+            if u"sha256-request" in them_d:
+                recognized = True
+                digest = yield self._hash_offer()
+                self._send_data({u"sha256": digest}, w)
             if u"answer" in them_d:
                 recognized = True
                 if not want_answer:
@@ -233,6 +259,25 @@ class Sender:
             if not recognized:
                 log.msg("unrecognized message %r" % (them_d, ))
 
+    @inlineCallbacks
+    def _hash_offer(self):
+        # only file and directory offers say "sha256-on-request"
+        if self._offered_file is None and self._offered_files is None:
+            returnValue(None)
+        print(u"Receiver may already have this, comparing..",
+              file=self._args.stderr)
+        with self._timing.add("hash"):
+            # a big file takes a while, so keep the wormhole (and any early
+            # transit connection) going meanwhile
+            digest = yield deferToThread(self._digest_offered_files)
+        returnValue(digest)
+
+    def _digest_offered_files(self):
+        if self._offered_file is not None:
+            return sha256_file(self._offered_file)
+        return sha256_tree((name, sha256_file(path))
+                           for (name, path) in self._offered_files)
+
     def _check_verifier(self, w, verifier_bytes):
         verifier = bytes_to_hexstr(verifier_bytes)
         while True:
@@ -247,7 +292,32 @@ class Sender:
 
     def _handle_transit(self, receiver_transit):
         ts = self._transit_sender
-        ts.add_connection_hints(receiver_transit.get("hints-v1", []))
+        if u"abilities-v1" in receiver_transit:
+            # this is their first transit message, and it says how many
+            # streams they will accept (just one, if they don't know about
+            # striping). Later ones only carry hints.
+            ts.set_streams(receiver_transit.get("streams-v1", 1))
+        ts.add_connection_hints(receiver_transit.get("hints-v1", []),
+                                more=bool(receiver_transit.get("more-hints-v1")))
+        if receiver_transit.get("early-connect-v1") and not self._early_transit:
+            # The receiver is connecting now too, while their user decides
+            # whether to accept, so start the race right away. If they
+            # accept, _send_file() will use the winner without waiting.
+            self._early_transit = True
+            self._transit_connect_d = ts.connect()
+
+    def _connect_transit(self):
+        d, self._transit_connect_d = self._transit_connect_d, None
+        if d is None:
+            d = self._transit_sender.connect()
+        return d
+
+    def _abandon_transit(self):
+        d, self._transit_connect_d = self._transit_connect_d, None
+        if d is not None:
+            d.addCallbacks(lambda record_pipe: record_pipe.close(),
+                           lambda f: None)
+            d.cancel()
 
     def _build_offer(self):
         offer = {}
@@ -323,7 +393,13 @@ class Sender:
             offer["file"] = {
                 "filename": basename,
                 "filesize": filesize,
+                # the receiver may ask for our digest (with
+                # "sha256-request") if it already has a file of this name
+                # and size, and answer "already-have" if it matches. We
+                # don't hash up front: most of the time it won't ask.
+                "sha256-on-request": True,
             }
+            self._offered_file = what
             print(
                 u"Sending %s file named '%s'" % (naturalsize(filesize),
                                                  basename),
@@ -344,6 +420,7 @@ class Sender:
                 fd_to_send.seekable = lambda: True
             num_files = 0
             num_bytes = 0
+            offered_files = []
             tostrip = len(what.split(os.sep))
             with zipfile.ZipFile(
                     fd_to_send,
@@ -362,6 +439,9 @@ class Sender:
                             zf.write(localfilename, archivename)
                             num_bytes += os.stat(localfilename).st_size
                             num_files += 1
+                            offered_files.append(
+                                (archivename.replace(os.sep, "/"),
+                                 localfilename))
                         except OSError as e:
                             errmsg = u"{}: {}".format(fn, e.strerror)
                             if self._args.ignore_unsendable_files:
@@ -379,7 +459,11 @@ class Sender:
                 "zipsize": filesize,
                 "numbytes": num_bytes,
                 "numfiles": num_files,
+                # as for files, but the receiver checks numfiles and
+                # numbytes first
+                "sha256-on-request": True,
             }
+            self._offered_files = offered_files
             print(
                 u"Sending directory (%s compressed) named '%s'" %
                 (naturalsize(filesize), basename),
@@ -412,7 +496,16 @@ class Sender:
                 returnValue(None)  # terminates this function
             raise TransferError("error sending text: %r" % (them_answer, ))
 
-        if them_answer.get("file_ack") != "ok":
+        file_ack = them_answer.get("file_ack")
+        if file_ack == "already-have":
+            # the receiver matched our "sha256" against a local copy, so
+            # there is nothing to transfer
+            self._timing.add("already-have")
+            print(
+                u"Receiver already has this content. Transfer complete.",
+                file=self._args.stderr)
+            returnValue(None)
+        if file_ack != "ok":
             raise TransferError("ambiguous response from remote, "
                                 "transfer abandoned: %s" % (them_answer, ))
 
@@ -420,13 +513,11 @@ class Sender:
 
     @inlineCallbacks
     def _send_file(self):
-        ts = self._transit_sender
-
         self._fd_to_send.seek(0, 2)
         filesize = self._fd_to_send.tell()
         self._fd_to_send.seek(0, 0)
 
-        record_pipe = yield ts.connect()
+        record_pipe = yield self._connect_transit()
         self._timing.add("transit connected")
         # record_pipe should implement IConsumer, chunks are just records
         stderr = self._args.stderr
@@ -112,6 +112,11 @@ class AlreadyInputNameplateError(WormholeError):
     had already committed to a different one."""
 
 
+class NotSerializableError(WormholeError):
+    """w.serialize() was called on a wormhole that doesn't have its code yet,
+    is closing, or has started dilation."""
+
+
 class WormholeClosed(Exception):
     """Deferred-returning API calls errback with WormholeClosed if the
     wormhole was already closed, or if it closes before a real result can be
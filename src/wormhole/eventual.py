@@ -1,6 +1,8 @@
 # inspired-by/adapted-from Foolscap's eventual.py, which Glyph wrote for me
 # years ago.
 
+from collections import deque
+
 from twisted.internet.defer import Deferred
 from twisted.internet.interfaces import IReactorTime
 from twisted.python import log
@@ -10,7 +12,7 @@ class EventualQueue(object):
     def __init__(self, clock):
         # pass clock=reactor unless you're testing
         self._clock = IReactorTime(clock)
-        self._calls = []
+        self._calls = deque()
         self._flush_d = None
         self._timer = None
 
@@ -25,8 +27,11 @@ class EventualQueue(object):
         return d
 
     def _turn(self):
-        while self._calls:
-            (f, args, kwargs) = self._calls.pop(0)
+        # calls queued by these calls run in this same turn (flush() relies
+        # on that), so keep popping until the queue is empty
+        calls = self._calls
+        while calls:
+            (f, args, kwargs) = calls.popleft()
             try:
                 f(*args, **kwargs)
             except Exception:
@@ -1,13 +1,22 @@
 # no unicode_literals
 # Find all of our ip addresses. From tahoe's src/allmydata/util/iputil.py
 
+import ctypes
 import errno
+import hashlib
 import os
 import re
+import socket
 import subprocess
+import time
 from sys import platform
 
+from twisted.internet import defer, interfaces
+from twisted.internet.endpoints import TCP4ServerEndpoint
+from twisted.python import log
 from twisted.python.procutils import which
+from twisted.python.runtime import platformType
+from zope.interface import implementer
 
 # Wow, I'm really amazed at home much mileage we've gotten out of calling
 # the external route.exe program on windows...  It appears to work on all
@@ -23,18 +32,116 @@ _win32_commands = (('route.exe', ('print', ), _win32_re), )
 _addr_re = re.compile(
     r'^\s*inet [a-zA-Z]*:?(?P<address>\d+\.\d+\.\d+\.\d+)[\s/].+$',
     flags=re.M | re.I | re.S)
+# 'ip addr' says "inet6 2001:db8::1/64", Linux ifconfig says "inet6 addr:
+# 2001:db8::1/64", and BSD ifconfig says "inet6 2001:db8::1 prefixlen 64".
+_addr6_re = re.compile(
+    r'^\s*inet6 (?:addr:\s*)?(?P<address>[0-9a-fA-F:]+)(?:%\S+)?[\s/].+$',
+    flags=re.M | re.I | re.S)
+_unix_res = (_addr_re, _addr6_re)
 _unix_commands = (
-    ('/bin/ip', ('addr', ), _addr_re),
-    ('/sbin/ip', ('addr', ), _addr_re),
-    ('/sbin/ifconfig', ('-a', ), _addr_re),
-    ('/usr/sbin/ifconfig', ('-a', ), _addr_re),
-    ('/usr/etc/ifconfig', ('-a', ), _addr_re),
-    ('ifconfig', ('-a', ), _addr_re),
-    ('/sbin/ifconfig', (), _addr_re),
+    ('/bin/ip', ('addr', ), _unix_res),
+    ('/sbin/ip', ('addr', ), _unix_res),
+    ('/sbin/ifconfig', ('-a', ), _unix_res),
+    ('/usr/sbin/ifconfig', ('-a', ), _unix_res),
+    ('/usr/etc/ifconfig', ('-a', ), _unix_res),
+    ('ifconfig', ('-a', ), _unix_res),
+    ('/sbin/ifconfig', (), _unix_res),
 )
 
 
+# Asking the kernel directly, with getifaddrs(3), saves forking 'ip' or
+# 'ifconfig' (tens of milliseconds) every time we build hints. Only the
+# leading fields of 'struct ifaddrs' are declared, since we never allocate
+# one ourselves.
+class _ifaddrs(ctypes.Structure):
+    pass
+
+
+_ifaddrs._fields_ = [
+    ("ifa_next", ctypes.POINTER(_ifaddrs)),
+    ("ifa_name", ctypes.c_char_p),
+    ("ifa_flags", ctypes.c_uint),
+    ("ifa_addr", ctypes.c_void_p),
+]
+_IFF_UP = 0x1
+
+
+def _sockaddr_to_address(sa):
+    # Linux starts a sockaddr with a 16-bit family, the BSDs (and macOS)
+    # with an 8-bit length and then an 8-bit family.
+    raw = ctypes.string_at(sa, 2)
+    if platform.startswith("linux"):
+        family = ctypes.c_ushort.from_buffer_copy(raw).value
+    else:
+        family = ord(raw[1:2])
+    if family == socket.AF_INET:
+        # sockaddr_in: family, port, then the 4-byte address
+        return socket.inet_ntop(socket.AF_INET, ctypes.string_at(sa, 8)[4:])
+    if family == socket.AF_INET6:
+        # sockaddr_in6: family, port, flowinfo, then the 16-byte address
+        return socket.inet_ntop(socket.AF_INET6,
+                                ctypes.string_at(sa, 24)[8:])
+    return None
+
+
+def _interface_addresses():
+    """Return the addresses of all interfaces that are up, or None if
+    getifaddrs() isn't available here (e.g. on Windows)."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        getifaddrs = libc.getifaddrs
+        freeifaddrs = libc.freeifaddrs
+    except (OSError, TypeError, AttributeError):
+        return None
+    if not hasattr(socket, "inet_ntop"):
+        return None
+    head = ctypes.POINTER(_ifaddrs)()
+    if getifaddrs(ctypes.byref(head)) != 0:
+        return None
+    addresses = []
+    try:
+        ifa = head
+        while ifa:
+            entry = ifa.contents
+            if entry.ifa_addr and entry.ifa_flags & _IFF_UP:
+                addr = _sockaddr_to_address(entry.ifa_addr)
+                if addr and _usable(addr) and addr not in addresses:
+                    addresses.append(addr)
+            ifa = entry.ifa_next
+    finally:
+        freeifaddrs(head)
+    return addresses
+
+
+# Transit and each dilation generation all want our addresses, which rarely
+# change within a few seconds, so we remember them for a little while.
+CACHE_TIME = 10.0
+_cached = None  # (when, addresses)
+
+
+def forget_addresses():
+    """Make the next find_addresses() look again, e.g. because a dilated
+    connection was lost and the network may have changed."""
+    global _cached
+    _cached = None
+
+
 def find_addresses():
+    global _cached
+    now = time.time()
+    if _cached is None or not (0 <= now - _cached[0] < CACHE_TIME):
+        _cached = (now, _find_addresses())
+    return list(_cached[1])
+
+
+def _find_addresses():
+    addresses = _interface_addresses()
+    if addresses:
+        return addresses
+    return _query_commands()
+
+
+def _query_commands():
     # originally by Greg Smith, hacked by Zooko and then Daira
 
     # We don't reach here for cygwin.
@@ -65,7 +172,45 @@ def find_addresses():
     return ["127.0.0.1"]
 
 
-def _query(path, args, regex):
+# Linux gives each boot a random ID, which every container running on that
+# kernel shares. Elsewhere we fall back to the machine ID, then the hostname.
+_host_id_files = (
+    '/proc/sys/kernel/random/boot_id',
+    '/etc/machine-id',
+    '/var/lib/dbus/machine-id',
+)
+
+
+def find_host_id():
+    raw = None
+    for path in _host_id_files:
+        try:
+            with open(path) as f:
+                raw = f.read().strip()
+        except (IOError, OSError):
+            continue
+        if raw:
+            break
+    if not raw:
+        raw = socket.gethostname()
+    # only say whether two hosts match, not what the raw ID is
+    return hashlib.sha256(b'magic-wormhole host id:' +
+                          raw.encode('utf-8')).hexdigest()
+
+
+def _usable(addr):
+    # Loopback is handled by 127.0.0.1, and link-local IPv6 addresses are
+    # useless to our peer without knowing which interface they're on.
+    if ':' not in addr:
+        return True
+    addr = addr.lower()
+    if addr in ('::', '::1'):
+        return False
+    return not (addr.startswith('fe8') or addr.startswith('fe9') or
+                addr.startswith('fea') or addr.startswith('feb'))
+
+
+def _query(path, args, regexes):
     env = {'LANG': 'en_US.UTF-8'}
     trial = 0
     while True:
@@ -84,13 +229,123 @@ def _query(path, args, regex):
                 continue
             raise
 
+    if not isinstance(regexes, tuple):
+        regexes = (regexes, )
     addresses = []
     outputsplit = output.split('\n')
     for outline in outputsplit:
-        m = regex.match(outline)
-        if m:
-            addr = m.group('address')
-            if addr not in addresses:
-                addresses.append(addr)
+        for regex in regexes:
+            m = regex.match(outline)
+            if m:
+                addr = m.group('address')
+                if _usable(addr) and addr not in addresses:
+                    addresses.append(addr)
 
     return addresses
+
+
+def _dual_stack_socket(port):
+    s = socket.socket(socket.AF_INET6, socket.SOCK_STREAM)
+    try:
+        # accept IPv4 too, as v4-mapped addresses
+        s.setsockopt(socket.IPPROTO_IPV6, socket.IPV6_V6ONLY, 0)
+        if platformType == "posix" and platform != "cygwin":
+            s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        s.bind(("::", port))
+        s.listen(50)
+        s.setblocking(False)
+    except Exception:
+        s.close()
+        raise
+    return s
+
+
+def _probe_port(port):
+    """Listen on 'port' (0 means any) for a moment, the way we'd really
+    listen later. Return the port number, or None if it's taken."""
+    try:
+        s = _dual_stack_socket(port)
+    except (socket.error, AttributeError):
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        try:
+            if platformType == "posix" and platform != "cygwin":
+                s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            s.bind(("", port))
+            s.listen(1)
+        except socket.error:
+            s.close()
+            return None
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+
+def parse_port_range(spec):
+    """Turn '4000' or '4000-4010' into a list of TCP port numbers."""
+    try:
+        if "-" in spec:
+            first, last = [int(p) for p in spec.split("-", 1)]
+        else:
+            first = last = int(spec)
+    except ValueError:
+        raise ValueError("port range should look like '4000' or "
+                         "'4000-4010', not %r" % (spec, ))
+    if not (0 < first <= last < 65536):
+        raise ValueError("bad port range %r" % (spec, ))
+    return list(range(first, last + 1))
+
+
+# The last port from an application's chosen range that we listened on, for
+# this whole process. Reusing it for the next transfer (or dilation
+# generation) means that a port forward or firewall rule made for it stays
+# useful.
+_last_port = None
+
+
+def choose_listen_port(ports=None):
+    """Return a TCP port we can listen on right now. With no 'ports', that's
+    whatever the kernel gives us. Otherwise it's the one of 'ports' we used
+    last, if it's still free, else the first free one of them, else a
+    random one."""
+    global _last_port
+    if not ports:
+        return _probe_port(0)
+    candidates = list(ports)
+    if _last_port in ports:
+        candidates.insert(0, _last_port)
+    for port in candidates:
+        if _probe_port(port):
+            _last_port = port
+            return port
+    log.msg("none of our listening ports (%d-%d) are free, using "
+            "a random one" % (ports[0], ports[-1]))
+    return _probe_port(0)
+
+
+@implementer(interfaces.IStreamServerEndpoint)
+class DualStackServerEndpoint(object):
+    """Listen on a TCP port for both IPv6 and IPv4 with a single socket,
+    so our direct hints can include both kinds of address. Where that isn't
+    possible (no IPv6, or a reactor that can't adopt sockets), listen on
+    IPv4 alone, like before."""
+
+    def __init__(self, reactor, port):
+        self._reactor = reactor
+        self._port = port
+
+    def listen(self, factory):
+        if (socket.has_ipv6 and
+                interfaces.IReactorSocket.providedBy(self._reactor)):
+            try:
+                s = _dual_stack_socket(self._port)
+            except (socket.error, AttributeError):
+                pass  # e.g. no IPv6 here, or no IPV6_V6ONLY
+            else:
+                try:
+                    return defer.succeed(self._reactor.adoptStreamPort(
+                        s.fileno(), socket.AF_INET6, factory))
+                except Exception:
+                    return defer.fail()
+                finally:
+                    s.close()  # the reactor has its own copy
+        return TCP4ServerEndpoint(self._reactor, self._port).listen(factory)
@@ -1,6 +1,8 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import contextlib
+import json
+import os
 
 from zope.interface import implementer
 
@@ -42,3 +44,134 @@ class ImmediateJournal(object):
     @contextlib.contextmanager
     def process(self):
         yield
+
+
+def _read_log(path):
+    # Returns the complete records in a log (as bytes), and the last of them
+    # (or None). A final record without its newline was only partly written
+    # when we crashed: it was never committed, so nothing that depended upon
+    # it was released, and we leave it out.
+    try:
+        with open(path, "rb") as f:
+            data = f.read()
+    except IOError:
+        return b"", None
+    data = data[:data.rfind(b"\n") + 1]
+    if not data:
+        return data, None
+    return data, data[data.rfind(b"\n", 0, len(data) - 1) + 1:]
+
+
+def load_checkpoint(path):
+    """Return the last complete checkpoint recorded in a
+    GroupCommitJournal's log file, or None if there isn't one. An incomplete
+    final record, torn by a crash, is ignored."""
+    last = _read_log(path)[1]
+    if last is None:
+        return None
+    return json.loads(last.decode("utf-8"))
+
+
+@implementer(IJournal)
+class GroupCommitJournal(object):
+    """Like Journal, but durable, and cheaper than an fsync per message.
+
+    Each process() block appends the checkpoint from get_checkpoint() (any
+    JSON-serializable object) to a write-ahead log at 'path'. The log is
+    fsynced at most once every 'commit_interval' seconds, covering every
+    checkpoint written since the last one. Outbound messages are held until
+    the fsync that covers their checkpoint, so they are still never released
+    before the state that produced them is safe on disk. A commit_interval
+    of 0 fsyncs at the end of every process() block.
+
+    When the log grows past 'max_log_size' bytes, the next commit replaces
+    it with one holding just the latest checkpoint. Use load_checkpoint() to
+    read it back at startup.
+    """
+
+    def __init__(self, path, get_checkpoint, reactor, commit_interval=0.005,
+                 max_log_size=1024 * 1024):
+        self._path = path
+        self._get_checkpoint = get_checkpoint
+        self._reactor = reactor
+        self._commit_interval = commit_interval
+        self._max_log_size = max_log_size
+        complete, self._last_record = _read_log(path)
+        self._f = open(path, "ab")
+        if self._f.tell() > len(complete):
+            # cut off a record torn by a crash, so the next one starts on a
+            # line of its own
+            self._f.truncate(len(complete))
+            os.fsync(self._f.fileno())
+        self._log_size = len(complete)
+        self._outbound_queue = []
+        self._processing = False
+        self._uncommitted = []  # outbound calls waiting for the next fsync
+        self._commit_call = None
+
+    def queue_outbound(self, fn, *args, **kwargs):
+        assert self._processing
+        self._outbound_queue.append((fn, args, kwargs))
+
+    @contextlib.contextmanager
+    def process(self):
+        assert not self._processing
+        assert not self._outbound_queue
+        self._processing = True
+        yield  # process inbound messages, change state, queue outbound
+        record = json.dumps(self._get_checkpoint()).encode("utf-8") + b"\n"
+        self._f.write(record)
+        self._log_size += len(record)
+        self._last_record = record
+        self._uncommitted.extend(self._outbound_queue)
+        self._outbound_queue[:] = []
+        self._processing = False
+        if not self._commit_interval:
+            self.commit()
+        elif not self._commit_call:
+            self._commit_call = self._reactor.callLater(
+                self._commit_interval, self.commit)
+
+    def commit(self):
+        """Make every recorded checkpoint durable now, then release the
+        outbound messages they were holding."""
+        if self._commit_call:
+            if self._commit_call.active():
+                self._commit_call.cancel()
+            self._commit_call = None
+        if (self._log_size > self._max_log_size
+                and self._last_record is not None):
+            self._compact()
+        else:
+            self._f.flush()
+            os.fsync(self._f.fileno())
+        released, self._uncommitted = self._uncommitted, []
+        for (fn, args, kwargs) in released:
+            fn(*args, **kwargs)
+
+    def _compact(self):
+        # write the latest checkpoint to a new file, then atomically replace
+        # the log with it
+        self._f.close()
+        tmp = self._path + ".tmp"
+        with open(tmp, "wb") as f:
+            f.write(self._last_record)
+            f.flush()
+            os.fsync(f.fileno())
+        getattr(os, "replace", os.rename)(tmp, self._path)
+        if hasattr(os, "O_DIRECTORY"):
+            # and make the rename itself durable
+            fd = os.open(os.path.dirname(os.path.abspath(self._path)),
+                         os.O_RDONLY | os.O_DIRECTORY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self._f = open(self._path, "ab")
+        self._log_size = len(self._last_record)
+
+    def close(self):
+        if self._f.closed:
+            return
+        self.commit()
+        self._f.close()
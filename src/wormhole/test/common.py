@@ -7,11 +7,15 @@ from twisted.python import log
 import mock
 from wormhole_mailbox_server.database import create_channel_db, create_usage_db
 from wormhole_mailbox_server.server import make_server
+from wormhole_mailbox_server.server_websocket import (WebSocketServer,
+                                                      WebSocketServerFactory)
 from wormhole_mailbox_server.web import make_web_server
 from wormhole_transit_relay.transit_server import Transit
 
 from ..cli import cli
 from ..transit import allocate_tcp_port
+from ..util import (b64str_to_bytes, bytes_to_b64str, bytes_to_dict,
+                    bytes_to_hexstr, dict_to_bytes, hexstr_to_bytes)
 
 
 class MyInternetService(service.Service, object):
@@ -45,7 +49,82 @@ class MyInternetService(service.Service, object):
         return self._port_d
 
 
+class Base64WebSocketServer(WebSocketServer):
+    # a mailbox server that offers base64 message bodies, translating them
+    # to and from the hex that the real one stores
+    def __init__(self):
+        WebSocketServer.__init__(self)
+        self._base64 = False
+
+    def onOpen(self):
+        welcome = dict(self.factory.server.get_welcome())
+        welcome["body-encodings-v1"] = ["base64"]
+        self.send("welcome", welcome=welcome)
+
+    def handle_bind(self, msg, server_rx):
+        WebSocketServer.handle_bind(self, msg, server_rx)
+        self._base64 = "base64" in msg.get("body-encodings-v1", [])
+
+    def handle_add(self, msg, server_rx):
+        if self._base64 and "body" in msg:
+            body = bytes_to_hexstr(b64str_to_bytes(msg["body"]))
+            msg = dict(msg, body=body)
+        WebSocketServer.handle_add(self, msg, server_rx)
+
+    def send(self, mtype, **kwargs):
+        if mtype == "message" and self._base64:
+            kwargs["body"] = bytes_to_b64str(hexstr_to_bytes(kwargs["body"]))
+        WebSocketServer.send(self, mtype, **kwargs)
+
+
+class BatchWebSocketServer(WebSocketServer):
+    # a mailbox server that takes several messages in one "batch" frame, and
+    # handles each of them as if it had arrived by itself
+    def onOpen(self):
+        welcome = dict(self.factory.server.get_welcome())
+        welcome["batch-v1"] = {}
+        self.send("welcome", welcome=welcome)
+
+    def onMessage(self, payload, isBinary):
+        msg = bytes_to_dict(payload)
+        if msg.get("type") != "batch":
+            return WebSocketServer.onMessage(self, payload, isBinary)
+        self.send("ack", id=msg.get("id"))
+        for inner in msg.get("messages", []):
+            WebSocketServer.onMessage(self, dict_to_bytes(inner), isBinary)
+
+
+class DeltaListWebSocketServer(WebSocketServer):
+    # a mailbox server that can answer a "list" with just the nameplates
+    # that changed since an earlier answer on this connection
+    def onOpen(self):
+        self._lists = {}  # version -> set of nameplate ids
+        welcome = dict(self.factory.server.get_welcome())
+        welcome["nameplates-since-v1"] = {}
+        self.send("welcome", welcome=welcome)
+
+    def onMessage(self, payload, isBinary):
+        msg = bytes_to_dict(payload)
+        if msg.get("type") != "list" or not self._app:
+            return WebSocketServer.onMessage(self, payload, isBinary)
+        self.send("ack", id=msg.get("id"))
+        nids = set(self._app.get_nameplate_ids())
+        version = "%d" % len(self._lists)
+        self._lists[version] = nids
+        old = self._lists.get(msg.get("since"))
+        if old is None:
+            self.send("nameplates", version=version,
+                      nameplates=[{"id": nid} for nid in sorted(nids)])
+        else:
+            self.send("nameplates", version=version, since=msg["since"],
+                      added=[{"id": nid} for nid in sorted(nids - old)],
+                      removed=[{"id": nid} for nid in sorted(old - nids)])
+
+
 class ServerBase:
+    # set this to serve a different WebSocketServer subclass
+    websocket_protocol = None
+
     @defer.inlineCallbacks
     def setUp(self):
         yield self._setup_relay(None)
@@ -64,7 +143,14 @@ class ServerBase:
             signal_error=error,
             usage_db=self._usage_db)
         ep = endpoints.TCP4ServerEndpoint(reactor, 0, interface="127.0.0.1")
-        site = make_web_server(self._rendezvous, log_requests=False)
+        if self.websocket_protocol:
+            class Factory(WebSocketServerFactory):
+                protocol = self.websocket_protocol
+            with mock.patch("wormhole_mailbox_server.web."
+                            "WebSocketServerFactory", Factory):
+                site = make_web_server(self._rendezvous, log_requests=False)
+        else:
+            site = make_web_server(self._rendezvous, log_requests=False)
         # self._lp = yield ep.listen(site)
         s = MyInternetService(ep, site)
         s.setServiceParent(self.sp)
@@ -6,6 +6,7 @@ from twisted.trial import unittest
 from twisted.internet.task import Clock
 from twisted.internet.defer import Deferred
 from twisted.internet.address import IPv4Address, IPv6Address, HostnameAddress
+from twisted.internet.error import ConnectionRefusedError
 from ...eventual import EventualQueue
 from ..._interfaces import IDilationManager, IDilationConnector
 from ..._hints import DirectTCPV1Hint, RelayV1Hint, TorTCPV1Hint
@@ -71,7 +72,8 @@ class Inbound(unittest.TestCase):
         self.assertEqual(c.mock_calls, [mock.call.build_protocol(addr, "<-tcp:1.2.3.4:55")])
         self.assertIdentical(p.factory, f)
 
-def make_connector(listen=True, tor=False, relay=None, role=roles.LEADER):
+def make_connector(listen=True, tor=False, relay=None, role=roles.LEADER,
+                   listen_ports=None):
     class Holder:
         pass
     h = Holder()
@@ -89,7 +91,7 @@ def make_connector(listen=True, tor=False, relay=None, role=roles.LEADER):
     h.side = u"abcd1234abcd5678"
     h.role = role
     c = Connector(h.dilation_key, h.relay, h.manager, h.reactor, h.eq,
-                  not listen, h.tor, timing, h.side, h.role)
+                  not listen, h.tor, timing, h.side, h.role, listen_ports)
     return c, h
 
 class TestConnector(unittest.TestCase):
@@ -208,10 +210,13 @@ class TestConnector(unittest.TestCase):
         ep = mock.Mock()
         d = Deferred()
         ep.listen = mock.Mock(return_value=d)
-        with mock.patch("wormhole._dilation.connector.serverFromString",
-                        return_value=ep) as sfs:
+        with mock.patch("wormhole.ipaddrs.DualStackServerEndpoint",
+                        return_value=ep) as dsse, \
+                mock.patch("wormhole.ipaddrs.choose_listen_port",
+                           return_value=66) as clp:
             c._start_listener(["1.2.3.4", "5.6.7.8"])
-        self.assertEqual(sfs.mock_calls, [mock.call(h.reactor, "tcp:0")])
+        self.assertEqual(clp.mock_calls, [mock.call(None)])
+        self.assertEqual(dsse.mock_calls, [mock.call(h.reactor, 66)])
         lp = mock.Mock()
         host = mock.Mock()
         host.port = 66
@@ -230,6 +235,19 @@ class TestConnector(unittest.TestCase):
                                                  },
                                                 ])])
 
+    def test_start_listen_ports(self):
+        c, h = make_connector(listen=True, role=roles.LEADER,
+                              listen_ports=[4000, 4001])
+        ep = mock.Mock()
+        ep.listen = mock.Mock(return_value=Deferred())
+        with mock.patch("wormhole.ipaddrs.DualStackServerEndpoint",
+                        return_value=ep) as dsse, \
+                mock.patch("wormhole.ipaddrs.choose_listen_port",
+                           return_value=4001) as clp:
+            c._start_listener(["1.2.3.4"])
+        self.assertEqual(clp.mock_calls, [mock.call([4000, 4001])])
+        self.assertEqual(dsse.mock_calls, [mock.call(h.reactor, 4001)])
+
     def test_schedule_connection_no_relay(self):
         c, h = make_connector(listen=True, role=roles.LEADER)
         hint = DirectTCPV1Hint("foo", 55, 0.0)
@@ -309,6 +327,104 @@ class TestConnector(unittest.TestCase):
                           mock.call(c.RELAY_DELAY, hint3.hints[0], is_relay=True),
                           ])
 
+    def test_fast_failover(self):
+        # if all the direct connections fail quickly, the relay is started
+        # right away instead of waiting for RELAY_DELAY
+        c, h = make_connector(listen=True, relay=None, role=roles.LEADER)
+        c._start_listener = mock.Mock()
+        c.start()
+        hint1 = DirectTCPV1Hint("foo", 55, 0.0)
+        hint2 = DirectTCPV1Hint("bar", 55, 0.0)
+        hint3 = RelayV1Hint([DirectTCPV1Hint("relay", 55, 0.0)])
+        eps = {}
+
+        def _efho(hint, tor, reactor):
+            eps[hint.hostname] = ep = mock.Mock()
+            ep.connect = mock.Mock(return_value=Deferred())
+            return ep
+        with mock.patch("wormhole._dilation.connector.endpoint_from_hint_obj",
+                        side_effect=_efho):
+            c.got_hints([hint1, hint2, hint3])
+        h.clock.advance(0)
+        self.assertEqual(eps["relay"].connect.mock_calls, [])
+
+        eps["foo"].connect.return_value.errback(ConnectionRefusedError())
+        h.clock.advance(0)
+        self.assertEqual(eps["relay"].connect.mock_calls, [])
+
+        eps["bar"].connect.return_value.errback(ConnectionRefusedError())
+        h.clock.advance(0)
+        self.assertEqual(len(eps["relay"].connect.mock_calls), 1)
+        self.assertEqual(h.clock.getDelayedCalls(), [])
+
+    def test_no_fast_failover_when_hanging(self):
+        c, h = make_connector(listen=True, relay=None, role=roles.LEADER)
+        c._start_listener = mock.Mock()
+        c.start()
+        hint1 = DirectTCPV1Hint("foo", 55, 0.0)
+        hint2 = RelayV1Hint([DirectTCPV1Hint("relay", 55, 0.0)])
+        eps = {}
+
+        def _efho(hint, tor, reactor):
+            eps[hint.hostname] = ep = mock.Mock()
+            ep.connect = mock.Mock(return_value=Deferred())
+            return ep
+        with mock.patch("wormhole._dilation.connector.endpoint_from_hint_obj",
+                        side_effect=_efho):
+            c.got_hints([hint1, hint2])
+        h.clock.advance(c.RELAY_DELAY - 0.5)
+        self.assertEqual(eps["relay"].connect.mock_calls, [])
+        h.clock.advance(1.0)
+        self.assertEqual(len(eps["relay"].connect.mock_calls), 1)
+
+        # cancelling the pending connections doesn't trigger anything
+        c.stop()
+        self.assertEqual(h.clock.getDelayedCalls(), [])
+
+    def test_happy_eyeballs_delay(self):
+        # mixed IPv6/IPv4 hints are interleaved, IPv6 first, and staggered
+        c, h = make_connector(listen=True, relay=None, role=roles.LEADER)
+        c._schedule_connection = mock.Mock()
+        c._start_listener = mock.Mock()
+        c.start()
+        hint1 = DirectTCPV1Hint("1.2.3.4", 55, 0.0)
+        hint2 = DirectTCPV1Hint("5.6.7.8", 55, 0.0)
+        hint3 = DirectTCPV1Hint("2001:db8::1", 55, 0.0)
+        c.got_hints([hint1, hint2, hint3])
+        self.assertEqual(c._schedule_connection.mock_calls,
+                         [mock.call(0.0, hint3, is_relay=False),
+                          mock.call(c.ATTEMPT_DELAY, hint1, is_relay=False),
+                          mock.call(2 * c.ATTEMPT_DELAY, hint2,
+                                    is_relay=False),
+                          ])
+
+    def test_happy_eyeballs_failure(self):
+        # when the IPv6 attempt fails, the IPv4 one starts right away
+        c, h = make_connector(listen=True, relay=None, role=roles.LEADER)
+        c._start_listener = mock.Mock()
+        c.start()
+        hint1 = DirectTCPV1Hint("1.2.3.4", 55, 0.0)
+        hint2 = DirectTCPV1Hint("2001:db8::1", 55, 0.0)
+        eps = {}
+
+        def _efho(hint, tor, reactor):
+            eps[hint.hostname] = ep = mock.Mock()
+            ep.connect = mock.Mock(return_value=Deferred())
+            return ep
+        with mock.patch("wormhole._dilation.connector.endpoint_from_hint_obj",
+                        side_effect=_efho):
+            c.got_hints([hint1, hint2])
+        h.clock.advance(0)
+        self.assertEqual(len(eps["2001:db8::1"].connect.mock_calls), 1)
+        self.assertEqual(eps["1.2.3.4"].connect.mock_calls, [])
+
+        eps["2001:db8::1"].connect.return_value.errback(
+            ConnectionRefusedError())
+        h.clock.advance(0)
+        self.assertEqual(len(eps["1.2.3.4"].connect.mock_calls), 1)
+        c.stop()
+        self.assertEqual(h.clock.getDelayedCalls(), [])
+
     def test_initial_relay(self):
         c, h = make_connector(listen=False, relay="tcp:foo:55", role=roles.LEADER)
         c._schedule_connection = mock.Mock()
@@ -60,7 +60,8 @@ class TestDilator(unittest.TestCase):
         self.assertIdentical(eps1, eps)
         self.assertIdentical(eps1, eps2)
         self.assertEqual(mm.mock_calls, [mock.call(h.send, side, None,
-                                                   h.reactor, h.eq, h.coop, False)])
+                                                   h.reactor, h.eq, h.coop, False,
+                                                   None)])
 
         self.assertEqual(m.mock_calls, [mock.call.get_endpoints(),
                                         mock.call.get_endpoints()])
@@ -167,7 +168,8 @@ class TestDilator(unittest.TestCase):
                             return_value=side):
             dil.dilate(transit_relay_location)
         self.assertEqual(mm.mock_calls, [mock.call(h.send, side, transit_relay_location,
-                                                   h.reactor, h.eq, h.coop, False)])
+                                                   h.reactor, h.eq, h.coop, False,
+                                                   None)])
 
 LEADER = "ff3456abcdef"
 FOLLOWER = "123456abcdef"
@@ -256,15 +258,18 @@ class TestManager(unittest.TestCase):
         c = mock.Mock()
         connector = mock.Mock(return_value=c)
         with mock.patch("wormhole._dilation.manager.Connector", connector):
-            # receiving this PLEASE triggers creation of the Connector
-            m.rx_PLEASE({"side": FOLLOWER})
+            with mock.patch("wormhole.ipaddrs.forget_addresses") as fa:
+                # receiving this PLEASE triggers creation of the Connector
+                m.rx_PLEASE({"side": FOLLOWER})
         self.assertEqual(h.send.mock_calls, [])
+        # the first generation can use addresses we found earlier
+        self.assertEqual(fa.mock_calls, [])
         self.assertEqual(connector.mock_calls, [
             mock.call(b"\x00" * 32, None, m, h.reactor, h.eq,
                       False,  # no_listen
                       None,  # tor
                       None,  # timing
-                      LEADER, roles.LEADER),
+                      LEADER, roles.LEADER, None),
             ])
         self.assertEqual(c.mock_calls, [mock.call.start()])
         clear_mock_calls(connector, c)
@@ -413,15 +418,18 @@ class TestManager(unittest.TestCase):
         c2 = mock.Mock()
         connector2 = mock.Mock(return_value=c2)
         with mock.patch("wormhole._dilation.manager.Connector", connector2):
-            # this triggers creation of a new Connector
-            m.rx_RECONNECTING()
+            with mock.patch("wormhole.ipaddrs.forget_addresses") as fa:
+                # this triggers creation of a new Connector
+                m.rx_RECONNECTING()
         self.assertEqual(h.send.mock_calls, [])
+        # which looks for our addresses afresh
+        self.assertEqual(fa.mock_calls, [mock.call()])
         self.assertEqual(connector2.mock_calls, [
             mock.call(b"\x00" * 32, None, m, h.reactor, h.eq,
                       False,  # no_listen
                       None,  # tor
                       None,  # timing
-                      LEADER, roles.LEADER),
+                      LEADER, roles.LEADER, None),
             ])
         self.assertEqual(c2.mock_calls, [mock.call.start()])
         clear_mock_calls(connector2, c2)
@@ -460,7 +468,7 @@ class TestManager(unittest.TestCase):
                       False,  # no_listen
                       None,  # tor
                       None,  # timing
-                      FOLLOWER, roles.FOLLOWER),
+                      FOLLOWER, roles.FOLLOWER, None),
             ])
         self.assertEqual(c.mock_calls, [mock.call.start()])
         clear_mock_calls(connector, c)
@@ -498,7 +506,7 @@ class TestManager(unittest.TestCase):
                       False,  # no_listen
                       None,  # tor
                       None,  # timing
-                      FOLLOWER, roles.FOLLOWER),
+                      FOLLOWER, roles.FOLLOWER, None),
             ])
         self.assertEqual(c2.mock_calls, [mock.call.start()])
         clear_mock_calls(connector2, c2)
@@ -515,7 +523,7 @@ class TestManager(unittest.TestCase):
                       False,  # no_listen
                       None,  # tor
                       None,  # timing
-                      FOLLOWER, roles.FOLLOWER),
+                      FOLLOWER, roles.FOLLOWER, None),
             ])
         self.assertEqual(c3.mock_calls, [mock.call.start()])
         clear_mock_calls(c2, connector3, c3)
@@ -537,7 +545,7 @@ class TestManager(unittest.TestCase):
                       False,  # no_listen
                       None,  # tor
                       None,  # timing
-                      FOLLOWER, roles.FOLLOWER),
+                      FOLLOWER, roles.FOLLOWER, None),
             ])
         self.assertEqual(c4.mock_calls, [mock.call.start()])
         clear_mock_calls(c3, connector4, c4)
@@ -4,8 +4,11 @@ import sys
 from twisted.trial import unittest
 
 import mock
+from click.testing import CliRunner
 
+from ..cli import cli
 from ..cli.public_relay import RENDEZVOUS_RELAY, TRANSIT_RELAY
+from ..timing import DebugTiming, NullTiming
 from .common import config
 
 
@@ -18,6 +21,7 @@ class Send(unittest.TestCase):
         self.assertEqual(cfg.dump_timing, None)
         self.assertEqual(cfg.hide_progress, False)
         self.assertEqual(cfg.listen, True)
+        self.assertEqual(cfg.listen_port, None)
         self.assertEqual(cfg.appid, None)
         self.assertEqual(cfg.relay_url, RENDEZVOUS_RELAY)
         self.assertEqual(cfg.transit_helper, TRANSIT_RELAY)
@@ -25,6 +29,7 @@ class Send(unittest.TestCase):
         self.assertEqual(cfg.tor, False)
         self.assertEqual(cfg.verify, False)
         self.assertEqual(cfg.zeromode, False)
+        self.assertIsInstance(cfg.timing, NullTiming)
 
     def test_appid(self):
         cfg = config("--appid", "xyz", "send", "--text", "hi")
@@ -46,6 +51,16 @@ class Send(unittest.TestCase):
         cfg = config("send", "--no-listen", "fn")
         self.assertEqual(cfg.listen, False)
 
+    def test_listen_port(self):
+        cfg = config("send", "--listen-port", "4000", "fn")
+        self.assertEqual(cfg.listen_port, [4000])
+
+    def test_bad_listen_port(self):
+        r = CliRunner()
+        res = r.invoke(cli.wormhole, ["send", "--listen-port", "x", "fn"])
+        self.assertEqual(res.exit_code, 2)
+        self.assertIn("port range should look like", res.output)
+
     def test_code(self):
         cfg = config("send", "--code", "1-abc", "fn")
         self.assertEqual(cfg.code, u"1-abc")
@@ -57,6 +72,7 @@ class Send(unittest.TestCase):
     def test_dump_timing(self):
         cfg = config("--dump-timing", "tx.json", "send", "fn")
         self.assertEqual(cfg.dump_timing, "tx.json")
+        self.assertIsInstance(cfg.timing, DebugTiming)
 
     def test_hide_progress(self):
         cfg = config("send", "--hide-progress", "fn")
@@ -108,6 +124,7 @@ class Receive(unittest.TestCase):
         self.assertEqual(cfg.dump_timing, None)
         self.assertEqual(cfg.hide_progress, False)
         self.assertEqual(cfg.listen, True)
+        self.assertEqual(cfg.listen_port, None)
         self.assertEqual(cfg.only_text, False)
         self.assertEqual(cfg.output_file, None)
         self.assertEqual(cfg.appid, None)
@@ -127,6 +144,10 @@ class Receive(unittest.TestCase):
         cfg = config("receive", "--no-listen")
         self.assertEqual(cfg.listen, False)
 
+    def test_listen_port(self):
+        cfg = config("receive", "--listen-port", "4000-4002")
+        self.assertEqual(cfg.listen_port, [4000, 4001, 4002])
+
     def test_code(self):
         cfg = config("receive", "1-abc")
         self.assertEqual(cfg.code, u"1-abc")
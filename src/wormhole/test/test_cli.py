@@ -1,5 +1,6 @@
 from __future__ import print_function
 
+import hashlib
 import io
 import os
 import re
@@ -11,7 +12,7 @@ from textwrap import dedent, fill
 import six
 from click.testing import CliRunner
 from humanize import naturalsize
-from twisted.internet import endpoints, reactor
+from twisted.internet import defer, endpoints, reactor, task
 from twisted.internet.defer import gatherResults, inlineCallbacks, returnValue
 from twisted.internet.error import ConnectionRefusedError
 from twisted.internet.utils import getProcessOutputAndValue
@@ -26,6 +27,7 @@ from .._interfaces import ITorManager
 from ..cli import cli, cmd_receive, cmd_send, welcome
 from ..errors import (ServerConnectionError, TransferError,
                       UnsendableFileError, WelcomeError, WrongPasswordError)
+from ..util import sha256_tree
 from .common import ServerBase, config
 
 
@@ -74,6 +76,9 @@ class OfferData(unittest.TestCase):
         self.assertNotIn("directory", d)
         self.assertEqual(d["file"]["filesize"], len(message))
         self.assertEqual(d["file"]["filename"], filename)
+        # the digest is only computed if the receiver asks for it
+        self.assertNotIn("sha256", d["file"])
+        self.assertEqual(d["file"]["sha256-on-request"], True)
         self.assertEqual(fd_to_send.tell(), 0)
         self.assertEqual(fd_to_send.read(), message)
 
@@ -137,7 +142,8 @@ class OfferData(unittest.TestCase):
         self.cfg.what = send_dir_arg
         self.cfg.cwd = parent_dir
 
-        d, fd_to_send = build_offer(self.cfg)
+        s = cmd_send.Sender(self.cfg, None)
+        d, fd_to_send = s._build_offer()
 
         self.assertNotIn("message", d)
         self.assertNotIn("file", d)
@@ -147,6 +153,14 @@ class OfferData(unittest.TestCase):
         self.assertEqual(d["directory"]["numfiles"], 5)
         self.assertIn("numbytes", d["directory"])
         self.assertIsInstance(d["directory"]["numbytes"], six.integer_types)
+        expected_hashes = [
+            (p, hashlib.sha256(("%s ponies\n" % p).encode("ascii")).hexdigest())
+            for p in ponies]
+        # the digest is only computed if the receiver asks for it
+        self.assertNotIn("sha256", d["directory"])
+        self.assertEqual(d["directory"]["sha256-on-request"], True)
+        self.assertEqual(s._digest_offered_files(),
+                         sha256_tree(expected_hashes))
 
         self.assertEqual(fd_to_send.tell(), 0)
         zdata = fd_to_send.read()
@@ -942,6 +956,381 @@ class PregeneratedCode(ServerBase, ScriptsBase, unittest.TestCase):
         return self._do_test_fail("directory", "toobig")
 
 
+class AlreadyHave(ServerBase, unittest.TestCase):
+    @inlineCallbacks
+    def _do_test(self, mode, same=True, existing="different\n"):
+        send_cfg = config("send")
+        recv_cfg = config("receive")
+
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.listen = False
+            cfg.code = u"1-abc"
+            cfg.stdout = io.StringIO()
+            cfg.stderr = io.StringIO()
+
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        recv_cfg.accept_file = True
+
+        # build the same content on both sides
+        for d in [send_dir, receive_dir]:
+            if mode == "file":
+                with open(os.path.join(d, "testfile"), "w") as f:
+                    f.write("test message\n")
+            else:
+                os.mkdir(os.path.join(d, "testdir"))
+                os.mkdir(os.path.join(d, "testdir", "sub"))
+                for i in range(3):
+                    path = os.path.join(d, "testdir", "sub", str(i))
+                    with open(path, "w") as f:
+                        f.write("test message %d\n" % i)
+        name = "testfile" if mode == "file" else "testdir"
+        if not same:
+            if mode == "file":
+                path = os.path.join(receive_dir, "testfile")
+            else:
+                path = os.path.join(receive_dir, "testdir", "sub", "0")
+            with open(path, "w") as f:
+                f.write(existing)
+        send_cfg.what = name
+        send_cfg.cwd = send_dir
+        recv_cfg.cwd = receive_dir
+
+        send_d = cmd_send.send(send_cfg)
+        receive_d = cmd_receive.receive(recv_cfg)
+        if same:
+            yield gatherResults([send_d, receive_d], True)
+            self.assertIn("Receiver already has this content."
+                          " Transfer complete.\n",
+                          send_cfg.stderr.getvalue())
+            self.assertIn("Already have identical %s '%s', skipping transfer"
+                          % (mode, name), recv_cfg.stderr.getvalue())
+        else:
+            # the existing target differs, so the usual no-clobber rule
+            # applies
+            f = yield self.assertFailure(send_d, TransferError)
+            self.assertEqual(
+                str(f), "remote error, transfer abandoned: transfer rejected")
+            yield self.assertFailure(receive_d, TransferError)
+            self.assertIn("Error: refusing to overwrite existing '%s'" % name,
+                          recv_cfg.stderr.getvalue())
+        self.assertNotIn("File sent", send_cfg.stderr.getvalue())
+        # the sender only hashes what it offers if the receiver has
+        # something of the same size
+        original = "test message\n" if mode == "file" else "test message 0\n"
+        hashed = same or len(existing) == len(original)
+        self.assertEqual(
+            "Receiver may already have this, comparing.."
+            in send_cfg.stderr.getvalue(), hashed)
+
+    def test_file(self):
+        return self._do_test("file")
+
+    def test_file_different_contents(self):
+        return self._do_test("file", same=False, existing="TEST MESSAGE\n")
+
+    def test_directory(self):
+        return self._do_test("directory")
+
+    def test_file_different(self):
+        return self._do_test("file", same=False)
+
+    def test_directory_different(self):
+        return self._do_test("directory", same=False)
+
+    def test_directory_different_contents(self):
+        return self._do_test("directory", same=False,
+                             existing="TEST MESSAGE 0\n")
+
+
+class EarlyTransit(unittest.TestCase):
+    def _build(self, module, transit_class, cmd):
+        cfg = config(cmd)
+        cfg.transit_helper = ""
+        cfg.listen = False
+        cfg.stderr = io.StringIO()
+        transit = mock.Mock()
+        transit.TRANSIT_KEY_LENGTH = 32
+        transit.get_connection_abilities = mock.Mock(return_value=[])
+        transit.get_connection_hints = mock.Mock(
+            return_value=defer.succeed([]))
+        self.connect_d = defer.Deferred()
+        transit.connect = mock.Mock(return_value=self.connect_d)
+        w = mock.Mock()
+        w.derive_key = mock.Mock(return_value=b"k" * 32)
+        p = mock.patch.object(module, transit_class, return_value=transit)
+        p.start()
+        self.addCleanup(p.stop)
+        return cfg, transit, w
+
+    def _receiver(self, sender_transit):
+        cfg, transit, w = self._build(cmd_receive, "TransitReceiver",
+                                      "receive")
+        r = cmd_receive.Receiver(cfg, reactor)
+        self.successResultOf(r._build_transit(w, sender_transit))
+        sent = cmd_receive.bytes_to_dict(w.send_message.mock_calls[0][1][0])
+        return r, transit, sent["transit"]
+
+    def test_receiver_early(self):
+        r, transit, receiver_transit = self._receiver(
+            {"hints-v1": [], "early-connect-v1": True})
+        self.assertEqual(receiver_transit["early-connect-v1"], True)
+        # we start connecting before the offer is even parsed
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+
+        d = r._establish_transit()
+        self.assertNoResult(d)
+        rp = mock.Mock()
+        self.connect_d.callback(rp)
+        self.assertIdentical(self.successResultOf(d), rp)
+        # the early attempt is reused, not repeated
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+        # and once it's been used, abandoning is a no-op
+        r._abandon_transit()
+        self.assertEqual(rp.close.mock_calls, [])
+
+    def test_receiver_old_sender(self):
+        r, transit, receiver_transit = self._receiver({"hints-v1": []})
+        self.assertNotIn("early-connect-v1", receiver_transit)
+        self.assertEqual(transit.connect.mock_calls, [])
+        r._establish_transit()
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+
+    def test_receiver_abandon_connected(self):
+        r, transit, receiver_transit = self._receiver(
+            {"hints-v1": [], "early-connect-v1": True})
+        rp = mock.Mock()
+        self.connect_d.callback(rp)
+        r._abandon_transit()
+        self.assertEqual(rp.close.mock_calls, [mock.call()])
+
+    def test_receiver_abandon_pending(self):
+        r, transit, receiver_transit = self._receiver(
+            {"hints-v1": [], "early-connect-v1": True})
+        r._abandon_transit()
+        # the pending attempt was cancelled, and the error swallowed
+        self.assertEqual(self.successResultOf(self.connect_d), None)
+
+    def test_receiver_trickle(self):
+        cfg, transit, w = self._build(cmd_receive, "TransitReceiver",
+                                      "receive")
+        cfg.listen = True
+        relay_hints = [{"type": "relay-v1", "hints": []}]
+        direct_hints = [{"type": "direct-tcp-v1", "hostname": "host",
+                         "port": 1234, "priority": 0.0}]
+        transit.get_relay_connection_hints = mock.Mock(
+            return_value=relay_hints)
+        transit.get_direct_connection_hints = mock.Mock(
+            return_value=defer.succeed(direct_hints))
+        clock = task.Clock()
+        r = cmd_receive.Receiver(cfg, clock)
+        self.successResultOf(r._build_transit(
+            w, {"hints-v1": [], "early-connect-v1": True, "trickle-v1": True}))
+
+        # the relay hints go out right away, without waiting for the listener
+        self.assertEqual(len(w.send_message.mock_calls), 1)
+        sent = cmd_receive.bytes_to_dict(w.send_message.mock_calls[0][1][0])
+        self.assertEqual(sent["transit"]["hints-v1"], relay_hints)
+        self.assertEqual(sent["transit"]["more-hints-v1"], True)
+        self.assertEqual(transit.get_connection_hints.mock_calls, [])
+        self.assertEqual(transit.get_direct_connection_hints.mock_calls, [])
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+
+        # and the direct hints follow on the next turn
+        clock.advance(0)
+        self.assertEqual(len(w.send_message.mock_calls), 2)
+        sent = cmd_receive.bytes_to_dict(w.send_message.mock_calls[1][1][0])
+        self.assertEqual(sent, {"transit": {"hints-v1": direct_hints}})
+
+    def test_receiver_trickle_no_listen(self):
+        r, transit, receiver_transit = self._receiver(
+            {"hints-v1": [], "trickle-v1": True})
+        # with nothing to wait for, all our hints go in one message
+        self.assertNotIn("more-hints-v1", receiver_transit)
+        self.assertEqual(transit.get_connection_hints.mock_calls,
+                         [mock.call()])
+
+    def test_receiver_late_hints(self):
+        r, transit, receiver_transit = self._receiver(
+            {"hints-v1": [], "more-hints-v1": True})
+        self.assertEqual(transit.add_connection_hints.mock_calls,
+                         [mock.call([], more=True)])
+        self.successResultOf(r._parse_transit({"hints-v1": ["late"]}, None))
+        self.assertEqual(transit.add_connection_hints.mock_calls,
+                         [mock.call([], more=True),
+                          mock.call(["late"], more=False)])
+
+    def test_receiver_streams(self):
+        r, transit, receiver_transit = self._receiver(
+            {"hints-v1": [], "streams-v1": 99})
+        # we accept as many as we can handle, and say so
+        self.assertEqual(receiver_transit["streams-v1"],
+                         cmd_receive.MAX_STREAMS)
+        self.assertEqual(cmd_receive.TransitReceiver.mock_calls[0][2]
+                         ["streams"], cmd_receive.MAX_STREAMS)
+
+    def test_receiver_abilities(self):
+        abilities = [{"type": "unix-v1", "host": "abc"}]
+        r, transit, receiver_transit = self._receiver(
+            {"abilities-v1": abilities, "hints-v1": []})
+        # the abilities are seen before the hints are built
+        names = [c[0] for c in transit.mock_calls]
+        self.assertEqual(transit.add_connection_abilities.mock_calls,
+                         [mock.call(abilities)])
+        self.assertLess(names.index("add_connection_abilities"),
+                        names.index("get_connection_hints"))
+
+    def test_receiver_no_streams(self):
+        r, transit, receiver_transit = self._receiver({"hints-v1": []})
+        self.assertNotIn("streams-v1", receiver_transit)
+        self.assertEqual(cmd_receive.TransitReceiver.mock_calls[0][2]
+                         ["streams"], 1)
+
+    def test_receiver_listen_port(self):
+        cfg, transit, w = self._build(cmd_receive, "TransitReceiver",
+                                      "receive")
+        cfg.listen_port = [4000, 4001]
+        r = cmd_receive.Receiver(cfg, reactor)
+        self.successResultOf(r._build_transit(w, {"hints-v1": []}))
+        self.assertEqual(cmd_receive.TransitReceiver.mock_calls[0][2]
+                         ["listen_ports"], [4000, 4001])
+
+    def _sender(self):
+        cfg, transit, w = self._build(cmd_send, "TransitSender", "send")
+        s = cmd_send.Sender(cfg, reactor)
+        s._transit_sender = transit
+        return s, transit
+
+    def test_sender_early(self):
+        s, transit = self._sender()
+        s._handle_transit({"hints-v1": [], "early-connect-v1": True})
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+        # more transit messages don't start another race
+        s._handle_transit({"hints-v1": [], "early-connect-v1": True})
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+        self.assertIdentical(s._connect_transit(), self.connect_d)
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+
+    def test_sender_late_hints(self):
+        s, transit = self._sender()
+        s._handle_transit({"hints-v1": ["relay"], "more-hints-v1": True,
+                           "early-connect-v1": True})
+        s._handle_transit({"hints-v1": ["direct"]})
+        self.assertEqual(transit.add_connection_hints.mock_calls,
+                         [mock.call(["relay"], more=True),
+                          mock.call(["direct"], more=False)])
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+
+    def test_sender_old_receiver(self):
+        s, transit = self._sender()
+        s._handle_transit({"hints-v1": []})
+        self.assertEqual(transit.connect.mock_calls, [])
+        s._connect_transit()
+        self.assertEqual(transit.connect.mock_calls, [mock.call()])
+
+    def test_sender_streams(self):
+        s, transit = self._sender()
+        s._handle_transit({"abilities-v1": [], "hints-v1": [],
+                           "streams-v1": 2})
+        self.assertEqual(transit.set_streams.mock_calls, [mock.call(2)])
+        # later messages only carry hints
+        s._handle_transit({"hints-v1": []})
+        self.assertEqual(transit.set_streams.mock_calls, [mock.call(2)])
+
+    def test_sender_streams_old_receiver(self):
+        s, transit = self._sender()
+        s._handle_transit({"abilities-v1": [], "hints-v1": []})
+        self.assertEqual(transit.set_streams.mock_calls, [mock.call(1)])
+
+    def test_sender_abandon(self):
+        s, transit = self._sender()
+        s._handle_transit({"hints-v1": [], "early-connect-v1": True})
+        rp = mock.Mock()
+        self.connect_d.callback(rp)
+        s._abandon_transit()
+        self.assertEqual(rp.close.mock_calls, [mock.call()])
+
+
+class Trickle(ServerBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_sender_no_listen(self):
+        # With no relay, and a sender that doesn't listen, the receiver's
+        # trickled direct hints are the only way to connect, and the early
+        # connect() starts before they exist.
+        send_cfg = config("send")
+        recv_cfg = config("receive")
+
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.code = u"1-abc"
+            cfg.stdout = io.StringIO()
+            cfg.stderr = io.StringIO()
+        send_cfg.listen = False
+        recv_cfg.listen = True
+
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        recv_cfg.accept_file = True
+        content = b"trickled\n"
+        with open(os.path.join(send_dir, "testfile"), "wb") as f:
+            f.write(content)
+        send_cfg.what = "testfile"
+        send_cfg.cwd = send_dir
+        recv_cfg.cwd = receive_dir
+
+        yield gatherResults(
+            [cmd_send.send(send_cfg), cmd_receive.receive(recv_cfg)], True)
+
+        with open(os.path.join(receive_dir, "testfile"), "rb") as f:
+            self.assertEqual(f.read(), content)
+
+
+class Striped(ServerBase, unittest.TestCase):
+    @inlineCallbacks
+    def test_file(self):
+        send_cfg = config("send")
+        recv_cfg = config("receive")
+
+        for cfg in [send_cfg, recv_cfg]:
+            cfg.hide_progress = True
+            cfg.relay_url = self.relayurl
+            cfg.transit_helper = ""
+            cfg.listen = True
+            cfg.code = u"1-abc"
+            cfg.stdout = io.StringIO()
+            cfg.stderr = io.StringIO()
+        send_cfg.streams = 3
+
+        send_dir = self.mktemp()
+        os.mkdir(send_dir)
+        receive_dir = self.mktemp()
+        os.mkdir(receive_dir)
+        recv_cfg.accept_file = True
+        content = os.urandom(300 * 1000)
+        with open(os.path.join(send_dir, "testfile"), "wb") as f:
+            f.write(content)
+        send_cfg.what = "testfile"
+        send_cfg.cwd = send_dir
+        recv_cfg.cwd = receive_dir
+
+        yield gatherResults(
+            [cmd_send.send(send_cfg), cmd_receive.receive(recv_cfg)], True)
+
+        self.assertIn("3 streams", send_cfg.stderr.getvalue())
+        self.assertIn("3 streams", recv_cfg.stderr.getvalue())
+        with open(os.path.join(receive_dir, "testfile"), "rb") as f:
+            self.assertEqual(f.read(), content)
+
+
 class ZeroMode(ServerBase, unittest.TestCase):
     @inlineCallbacks
     def test_text(self):
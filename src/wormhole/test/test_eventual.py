@@ -35,6 +35,21 @@ class Eventual(unittest.TestCase, object):
         self.assertEqual(self.successResultOf(d2), None)
         self.assertEqual(self.successResultOf(d3), "value")
 
+    def test_order(self):
+        c = Clock()
+        eq = EventualQueue(c)
+        calls = []
+
+        def first():
+            calls.append("first")
+            # queued from inside a turn, but still run in that turn
+            eq.eventually(calls.append, "third")
+        eq.eventually(first)
+        eq.eventually(calls.append, "second")
+        c.advance(0)
+        self.assertEqual(calls, ["first", "second", "third"])
+        self.assertEqual(c.getDelayedCalls(), [])
+
     def test_error(self):
         c = Clock()
         eq = EventualQueue(c)
@@ -6,7 +6,8 @@ from twisted.internet import endpoints, reactor
 from twisted.trial import unittest
 from .._hints import (endpoint_from_hint_obj, parse_hint_argv, parse_tcp_v1_hint,
                       describe_hint_obj, parse_hint, encode_hint,
-                      DirectTCPV1Hint, TorTCPV1Hint, RelayV1Hint)
+                      parse_unix_v1_hint, is_ipv6_hint, happy_eyeballs_order,
+                      DirectTCPV1Hint, TorTCPV1Hint, RelayV1Hint, UnixV1Hint)
 
 UnknownHint = namedtuple("UnknownHint", ["stuff"])
 
@@ -22,6 +23,8 @@ class Hints(unittest.TestCase):
         # tor=None
         self.assertEqual(efho(TorTCPV1Hint("host", "port", 0)), None)
         self.assertEqual(efho(UnknownHint("foo")), None)
+        self.assertIsInstance(efho(UnixV1Hint("/tmp/sock", 1.0)),
+                              endpoints.UNIXClientEndpoint)
 
         tor = mock.Mock()
         def tor_ep(hostname, port):
@@ -37,6 +40,7 @@ class Hints(unittest.TestCase):
         self.assertEqual( efho(DirectTCPV1Hint("non-public", 1234, 0.0), tor), None)
 
         self.assertEqual(efho(UnknownHint("foo"), tor), None)
+        self.assertEqual(efho(UnixV1Hint("/tmp/sock", 1.0), tor), None)
 
     def test_comparable(self):
         h1 = DirectTCPV1Hint("hostname", "port1", 0.0)
@@ -151,6 +155,18 @@ class Hints(unittest.TestCase):
             stderr,
             "non-float priority= in TCP hint 'tcp:host:1234:priority=bad'\n")
 
+    def test_parse_unix_v1_hint(self):
+        p = parse_unix_v1_hint
+        self.assertEqual(p({"type": "unix-v1", "path": "/tmp/sock"}),
+                         UnixV1Hint("/tmp/sock", 0.0))
+        self.assertEqual(p({"type": "unix-v1", "path": "/tmp/sock",
+                            "priority": 1.0}),
+                         UnixV1Hint("/tmp/sock", 1.0))
+        self.assertEqual(p({"type": "unix-v1"}), None)
+        self.assertEqual(p({"type": "unix-v1", "path": 12}), None)
+        self.assertEqual(parse_hint({"type": "unix-v1", "path": "/tmp/sock"}),
+                         UnixV1Hint("/tmp/sock", 0.0))
+
     def test_describe_hint_obj(self):
         d = describe_hint_obj
         self.assertEqual(d(DirectTCPV1Hint("host", 1234, 0.0), False, False),
@@ -163,6 +179,8 @@ class Hints(unittest.TestCase):
                          "tor->relay:tcp:host:1234")
         self.assertEqual(d(TorTCPV1Hint("host", 1234, 0.0), False, False),
                          "->tor:host:1234")
+        self.assertEqual(d(UnixV1Hint("/tmp/sock", 1.0), False, False),
+                         "->unix:/tmp/sock")
         self.assertEqual(d(UnknownHint("stuff"), False, False),
                          "->%s" % str(UnknownHint("stuff")))
 
@@ -191,6 +209,30 @@ class Hints(unittest.TestCase):
                           "priority": 1.0,
                           "hostname": "host",
                           "port": 1234})
+        self.assertEqual(e(UnixV1Hint("/tmp/sock", 1.0)),
+                         {"type": "unix-v1",
+                          "priority": 1.0,
+                          "path": "/tmp/sock"})
         e = self.assertRaises(ValueError, e, "not a Hint")
         self.assertIn("unknown hint type", str(e))
         self.assertIn("not a Hint", str(e))
+
+    def test_is_ipv6_hint(self):
+        self.assertTrue(is_ipv6_hint(DirectTCPV1Hint("2001:db8::1", 1, 0.0)))
+        self.assertTrue(is_ipv6_hint(DirectTCPV1Hint("::1", 1, 0.0)))
+        self.assertFalse(is_ipv6_hint(DirectTCPV1Hint("1.2.3.4", 1, 0.0)))
+        self.assertFalse(is_ipv6_hint(DirectTCPV1Hint("example.org", 1, 0.0)))
+        self.assertFalse(is_ipv6_hint(TorTCPV1Hint("2001:db8::1", 1, 0.0)))
+        self.assertFalse(is_ipv6_hint(UnixV1Hint("/tmp/sock", 0.0)))
+
+    def test_happy_eyeballs_order(self):
+        v4a = DirectTCPV1Hint("1.2.3.4", 1, 0.0)
+        v4b = DirectTCPV1Hint("5.6.7.8", 1, 0.0)
+        name = DirectTCPV1Hint("example.org", 1, 0.0)
+        v6a = DirectTCPV1Hint("2001:db8::1", 1, 0.0)
+        v6b = DirectTCPV1Hint("2001:db8::2", 1, 0.0)
+        self.assertEqual(happy_eyeballs_order([v4a, v4b, name, v6a, v6b]),
+                         [v6a, v4a, v6b, v4b, name])
+        self.assertEqual(happy_eyeballs_order([v4a, v6a]), [v6a, v4a])
+        self.assertEqual(happy_eyeballs_order([v4a, v4b]), [v4a, v4b])
+        self.assertEqual(happy_eyeballs_order([]), [])
@@ -1,10 +1,14 @@
 import errno
 import os
 import re
+import socket
 import subprocess
 
+from twisted.internet import address, defer, endpoints, protocol, reactor
 from twisted.trial import unittest
 
+import mock
+
 from .. import ipaddrs
 
 DOTTED_QUAD_RE = re.compile(r"^[0-9]+\.[0-9]+\.[0-9]+\.[0-9]+$")
@@ -83,7 +87,32 @@ Persistent Routes:
   None
 """
 
+MOCK_IPADDR_V6_OUTPUT = """\
+1: lo: <LOOPBACK,UP,LOWER_UP> mtu 65536 qdisc noqueue state UNKNOWN \n\
+    inet 127.0.0.1/8 scope host lo
+    inet6 ::1/128 scope host \n\
+2: eth0: <BROADCAST,MULTICAST,UP,LOWER_UP> mtu 1500 qdisc mq state UP \n\
+    inet 192.168.0.6/24 brd 192.168.0.255 scope global eth0
+    inet6 2001:db8:1:2:d63d:7eff:fe01:b43e/64 scope global dynamic \n\
+    inet6 fe80::d63d:7eff:fe01:b43e/64 scope link \n\
+"""
+
+MOCK_BSD_IFCONFIG_V6_OUTPUT = """\
+lo0: flags=8049<UP,LOOPBACK,RUNNING,MULTICAST> mtu 16384
+\tinet6 ::1 prefixlen 128 \n\
+\tinet6 fe80::1%lo0 prefixlen 64 scopeid 0x1 \n\
+\tinet 127.0.0.1 netmask 0xff000000 \n\
+en0: flags=8863<UP,BROADCAST,SMART,RUNNING,SIMPLEX,MULTICAST> mtu 1500
+\tinet6 fe80::1c2b:3d4e:5f60:7182%en0 prefixlen 64 secured scopeid 0x4 \n\
+\tinet 192.168.0.6 netmask 0xffffff00 broadcast 192.168.0.255
+\tinet6 2001:db8:1:2::5 prefixlen 64 autoconf secured \n\
+"""
+
 UNIX_TEST_ADDRESSES = set(["127.0.0.1", "192.168.0.6", "192.168.0.2"])
+IPV6_TEST_ADDRESSES = set(["127.0.0.1", "192.168.0.6",
+                           "2001:db8:1:2:d63d:7eff:fe01:b43e"])
+BSD_IPV6_TEST_ADDRESSES = set(["127.0.0.1", "192.168.0.6",
+                               "2001:db8:1:2::5"])
 WINDOWS_TEST_ADDRESSES = set(["127.0.0.1", "10.0.2.15"])
 CYGWIN_TEST_ADDRESSES = set(["127.0.0.1"])
 
@@ -109,6 +138,9 @@ class ListAddresses(unittest.TestCase):
 
     def _test_list_mock(self, command, output, expected):
         self.first = True
+        # pretend getifaddrs() isn't available, so we run the tools
+        self.patch(ipaddrs, '_interface_addresses', lambda: None)
+        self.patch(ipaddrs, '_cached', None)
 
         def call_Popen(args,
                        bufsize=0,
@@ -156,6 +188,16 @@ class ListAddresses(unittest.TestCase):
         self._test_list_mock("ifconfig", MOCK_IFCONFIG_OUTPUT,
                              UNIX_TEST_ADDRESSES)
 
+    def test_list_mock_ip_addr_ipv6(self):
+        # global IPv6 addresses are included, loopback and link-local aren't
+        self.patch(ipaddrs, 'platform', "linux2")
+        self._test_list_mock("ip", MOCK_IPADDR_V6_OUTPUT, IPV6_TEST_ADDRESSES)
+
+    def test_list_mock_bsd_ifconfig_ipv6(self):
+        self.patch(ipaddrs, 'platform', "darwin")
+        self._test_list_mock("ifconfig", MOCK_BSD_IFCONFIG_V6_OUTPUT,
+                             BSD_IPV6_TEST_ADDRESSES)
+
     def test_list_mock_route(self):
         self.patch(ipaddrs, 'platform', "win32")
         self._test_list_mock("route.exe", MOCK_ROUTE_OUTPUT,
@@ -164,3 +206,165 @@ class ListAddresses(unittest.TestCase):
     def test_list_mock_cygwin(self):
         self.patch(ipaddrs, 'platform', "cygwin")
         self._test_list_mock(None, None, CYGWIN_TEST_ADDRESSES)
+
+
+class InterfaceAddresses(unittest.TestCase):
+    def test_interface_addresses(self):
+        addresses = ipaddrs._interface_addresses()
+        if addresses is None:
+            raise unittest.SkipTest("no getifaddrs() here")
+        self.assertIn("127.0.0.1", addresses)
+        self.assertNotIn("::1", addresses)
+        for addr in addresses:
+            self.assertTrue(ipaddrs._usable(addr), addr)
+
+    def test_fallback(self):
+        self.patch(ipaddrs, '_interface_addresses', lambda: None)
+        with mock.patch("wormhole.ipaddrs._query_commands",
+                        return_value=["127.0.0.1", "10.0.0.1"]) as qc:
+            self.assertEqual(ipaddrs._find_addresses(),
+                             ["127.0.0.1", "10.0.0.1"])
+        self.assertEqual(qc.mock_calls, [mock.call()])
+
+    def test_cache(self):
+        self.patch(ipaddrs, '_cached', None)
+        now = [1000.0]
+        self.patch(ipaddrs.time, 'time', lambda: now[0])
+        with mock.patch("wormhole.ipaddrs._find_addresses",
+                        side_effect=[["10.0.0.1"], ["10.0.0.2"],
+                                     ["10.0.0.3"]]) as fa:
+            self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.1"])
+            now[0] += ipaddrs.CACHE_TIME / 2
+            addresses = ipaddrs.find_addresses()
+            self.assertEqual(addresses, ["10.0.0.1"])
+            self.assertEqual(len(fa.mock_calls), 1)
+            # callers get their own copy
+            addresses.remove("10.0.0.1")
+            self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.1"])
+
+            now[0] += ipaddrs.CACHE_TIME
+            self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.2"])
+            ipaddrs.forget_addresses()
+            self.assertEqual(ipaddrs.find_addresses(), ["10.0.0.3"])
+        self.assertEqual(len(fa.mock_calls), 3)
+
+
+class DualStack(unittest.TestCase):
+    @defer.inlineCallbacks
+    def _connect(self, host, port):
+        ep = endpoints.TCP6ClientEndpoint if ":" in host else \
+            endpoints.TCP4ClientEndpoint
+        p = yield endpoints.connectProtocol(ep(reactor, host, port),
+                                            protocol.Protocol())
+        p.transport.loseConnection()
+
+    @defer.inlineCallbacks
+    def test_listen(self):
+        if not socket.has_ipv6:
+            raise unittest.SkipTest("no IPv6 here")
+        f = protocol.Factory.forProtocol(protocol.Protocol)
+        ep = ipaddrs.DualStackServerEndpoint(reactor, 0)
+        try:
+            lp = yield ep.listen(f)
+        except Exception as e:
+            raise unittest.SkipTest("can't listen on IPv6: %s" % (e, ))
+        self.addCleanup(lp.stopListening)
+        # one port, reachable over both IPv4 and IPv6
+        port = lp.getHost().port
+        yield self._connect("127.0.0.1", port)
+        if isinstance(lp.getHost(), address.IPv6Address):
+            yield self._connect("::1", port)
+
+    @defer.inlineCallbacks
+    def test_fallback(self):
+        # without a dual-stack socket, we still listen on IPv4
+        f = protocol.Factory.forProtocol(protocol.Protocol)
+        ep = ipaddrs.DualStackServerEndpoint(reactor, 0)
+        with mock.patch("wormhole.ipaddrs._dual_stack_socket",
+                        side_effect=socket.error("no IPv6")):
+            lp = yield ep.listen(f)
+        self.addCleanup(lp.stopListening)
+        self.assertIsInstance(lp.getHost(), address.IPv4Address)
+        yield self._connect("127.0.0.1", lp.getHost().port)
+
+
+class ListenPort(unittest.TestCase):
+    def test_parse(self):
+        p = ipaddrs.parse_port_range
+        self.assertEqual(p("4000"), [4000])
+        self.assertEqual(p("4000-4002"), [4000, 4001, 4002])
+        self.assertRaises(ValueError, p, "x")
+        self.assertRaises(ValueError, p, "4000-")
+        self.assertRaises(ValueError, p, "0")
+        self.assertRaises(ValueError, p, "4002-4000")
+        self.assertRaises(ValueError, p, "65536")
+
+    def test_random(self):
+        # without a range, we always let the kernel choose, and don't
+        # remember it
+        self.patch(ipaddrs, "_last_port", 4001)
+        probed = []
+        self.patch(ipaddrs, "_probe_port",
+                   lambda port: probed.append(port) or port or 5555)
+        self.assertEqual(ipaddrs.choose_listen_port(), 5555)
+        self.assertEqual(ipaddrs.choose_listen_port([]), 5555)
+        self.assertEqual(probed, [0, 0])
+        self.assertEqual(ipaddrs._last_port, 4001)
+
+    def test_busy(self):
+        port = ipaddrs.choose_listen_port()
+        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(s.close)
+        s.bind(("", port))
+        s.listen(1)
+        self.patch(ipaddrs, "_last_port", None)
+        self.assertNotEqual(ipaddrs.choose_listen_port([port]), port)
+
+    def test_range(self):
+        self.patch(ipaddrs, "_last_port", None)
+        busy = set([4000])
+        self.patch(ipaddrs, "_probe_port",
+                   lambda port: None if port in busy else port or 5555)
+        self.assertEqual(ipaddrs.choose_listen_port([4000, 4001, 4002]),
+                         4001)
+        # we stick with that one while it's free
+        busy.remove(4000)
+        self.assertEqual(ipaddrs.choose_listen_port([4000, 4001, 4002]),
+                         4001)
+        # but not if it's out of range
+        self.assertEqual(ipaddrs.choose_listen_port([4000]), 4000)
+        # and if they're all taken, any port will do
+        busy.update([4000, 4001, 4002])
+        self.assertEqual(ipaddrs.choose_listen_port([4000, 4001, 4002]),
+                         5555)
+
+
+class HostID(unittest.TestCase):
+    def test_stable(self):
+        h = ipaddrs.find_host_id()
+        self.assertEqual(len(h), 64)
+        self.assertEqual(ipaddrs.find_host_id(), h)
+
+    def test_files(self):
+        d = self.mktemp()
+        os.mkdir(d)
+        missing = os.path.join(d, "missing")
+        empty = os.path.join(d, "empty")
+        with open(empty, "w"):
+            pass
+        first = os.path.join(d, "first")
+        with open(first, "w") as f:
+            f.write("abc\n")
+        self.patch(ipaddrs, "_host_id_files", (missing, empty, first))
+        h1 = ipaddrs.find_host_id()
+        with open(first, "w") as f:
+            f.write("def\n")
+        self.assertNotEqual(ipaddrs.find_host_id(), h1)
+
+    def test_hostname(self):
+        self.patch(ipaddrs, "_host_id_files", ())
+        with mock.patch("socket.gethostname", return_value="host1"):
+            h1 = ipaddrs.find_host_id()
+        with mock.patch("socket.gethostname", return_value="host2"):
+            h2 = ipaddrs.find_host_id()
+        self.assertNotEqual(h1, h2)
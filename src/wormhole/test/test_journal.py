@@ -1,7 +1,10 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
+from twisted.internet import task
 from twisted.trial import unittest
 
+import mock
+
 from .. import journal
 from .._interfaces import IJournal
 
@@ -29,3 +32,111 @@ class Journal(unittest.TestCase):
             j.queue_outbound(events.append, "message2")
             self.assertEqual(events, ["message1", "message2"])
         self.assertEqual(events, ["message1", "message2"])
+
+
+class GroupCommit(unittest.TestCase):
+    def build(self, commit_interval=0.01, **kwargs):
+        self.state = {"count": 0}
+        self.path = self.mktemp()
+        clock = task.Clock()
+        j = journal.GroupCommitJournal(self.path, lambda: dict(self.state),
+                                       clock, commit_interval, **kwargs)
+        self.addCleanup(j.close)
+        return j, clock
+
+    def test_group_commit(self):
+        events = []
+        j, clock = self.build()
+        self.assert_(IJournal.providedBy(j))
+
+        with j.process():
+            self.state["count"] = 1
+            j.queue_outbound(events.append, "message1")
+        with j.process():
+            self.state["count"] = 2
+            j.queue_outbound(events.append, "message2")
+        # both checkpoints are written, but nothing is released until the
+        # fsync that covers them
+        self.assertEqual(events, [])
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        with mock.patch("os.fsync") as fsync:
+            clock.advance(0.01)
+        self.assertEqual(len(fsync.mock_calls), 1)
+        self.assertEqual(events, ["message1", "message2"])
+        self.assertEqual(journal.load_checkpoint(self.path), {"count": 2})
+
+    def test_immediate_commit(self):
+        events = []
+        j, clock = self.build(commit_interval=0)
+        with j.process():
+            self.state["count"] = 1
+            j.queue_outbound(events.append, "message1")
+        self.assertEqual(events, ["message1"])
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(journal.load_checkpoint(self.path), {"count": 1})
+
+    def test_torn_record(self):
+        j, clock = self.build()
+        with j.process():
+            self.state["count"] = 1
+        j.commit()
+        # a crash in the middle of writing the next record
+        with open(self.path, "ab") as f:
+            f.write(b'{"count": ')
+        self.assertEqual(journal.load_checkpoint(self.path), {"count": 1})
+        self.assertEqual(journal.load_checkpoint(self.path + "-missing"),
+                         None)
+
+    def test_compact(self):
+        j, clock = self.build(max_log_size=100)
+        for i in range(20):
+            with j.process():
+                self.state["count"] = i
+        j.commit()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b'{"count": 19}\n')
+        with j.process():
+            self.state["count"] = 20
+        j.commit()
+        self.assertEqual(journal.load_checkpoint(self.path), {"count": 20})
+
+    def test_restart_after_torn_record(self):
+        j, clock = self.build()
+        with j.process():
+            self.state["count"] = 1
+        j.close()
+        with open(self.path, "ab") as f:
+            f.write(b'{"count": ')
+        # the torn record is cut off when the log is opened again, so the
+        # next record isn't appended to it
+        j = journal.GroupCommitJournal(self.path, lambda: dict(self.state),
+                                       clock, 0)
+        self.assertEqual(journal.load_checkpoint(self.path), {"count": 1})
+        with j.process():
+            self.state["count"] = 2
+        j.close()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b'{"count": 1}\n{"count": 2}\n')
+        self.assertEqual(journal.load_checkpoint(self.path), {"count": 2})
+
+    def test_restart_with_big_log(self):
+        j, clock = self.build()
+        for i in range(20):
+            with j.process():
+                self.state["count"] = i
+        j.close()
+        # a smaller limit after a restart compacts to the last record, even
+        # before we've written one of our own
+        j = journal.GroupCommitJournal(self.path, lambda: dict(self.state),
+                                       clock, max_log_size=100)
+        j.commit()
+        with open(self.path, "rb") as f:
+            self.assertEqual(f.read(), b'{"count": 19}\n')
+        j.close()
+        # and a log with nothing complete in it is left alone
+        with open(self.path, "wb") as f:
+            f.write(b"x" * 200)
+        j = journal.GroupCommitJournal(self.path, lambda: dict(self.state),
+                                       clock, max_log_size=100)
+        j.close()
+        self.assertEqual(journal.load_checkpoint(self.path), None)
@@ -4,7 +4,8 @@ import mock
 
 from twisted.trial import unittest
 
-from .._key import derive_key, derive_phase_key, encrypt_data, decrypt_data
+from .._key import (CryptoError, PhaseKeys, derive_key, derive_phase_key,
+                    encrypt_data, decrypt_data)
 from ..util import bytes_to_hexstr, hexstr_to_bytes
 
 
@@ -81,3 +82,54 @@ class Encrypt(unittest.TestCase):
         self.assertEqual(len(decrypted), len(encrypted) - 24 - 16)
         self.assertEqual(bytes_to_hexstr(decrypted),
                          "edc089a518219ec1cee184e89d2d37af")
+
+
+class Phases(unittest.TestCase):
+    def setUp(self):
+        m = "588ba9eef353778b074413a0140205d90d7479e36e0dd4ee35bb729d26131ef1"
+        self.main = hexstr_to_bytes(m)
+
+    def test_phase_key(self):
+        pk = PhaseKeys(self.main)
+        for side in ["side1", "side2"]:
+            for phase in ["phase1", "phase2", "phase1"]:
+                self.assertEqual(pk.phase_key(side, phase),
+                                 derive_phase_key(self.main, side, phase))
+
+    def test_encrypt(self):
+        pk = PhaseKeys(self.main)
+        encrypted = pk.encrypt("side1", "phase1", b"data")
+        key = derive_phase_key(self.main, "side1", "phase1")
+        self.assertEqual(decrypt_data(key, encrypted), b"data")
+        encrypted = encrypt_data(key, b"data")
+        self.assertEqual(pk.decrypt("side1", "phase1", encrypted), b"data")
+        with self.assertRaises(CryptoError):
+            pk.decrypt("side1", "phase2", encrypted)
+
+    def test_many(self):
+        pk = PhaseKeys(self.main)
+        nonces = b"".join(bytes(bytearray([i])) * 24 for i in range(3))
+        messages = [("0", b"zero"), ("1", b"one"), ("2", b"two")]
+        with mock.patch("nacl.utils.random",
+                        return_value=nonces) as random:
+            encrypted = pk.encrypt_many("side1", messages)
+        self.assertEqual(random.mock_calls, [mock.call(3 * 24)])
+        # each message gets its own nonce
+        self.assertEqual([e[:24] for e in encrypted],
+                         [nonces[0:24], nonces[24:48], nonces[48:72]])
+        received = list(zip(["0", "1", "2"], encrypted))
+        self.assertEqual(pk.decrypt_many("side1", received),
+                         [b"zero", b"one", b"two"])
+        with self.assertRaises(CryptoError):
+            pk.decrypt_many("side2", received)
+        self.assertEqual(pk.encrypt_many("side1", []), [])
+
+    def test_boxes(self):
+        pk = PhaseKeys(self.main)
+        pk.MAX_BOXES = 2
+        pk.encrypt("side1", "1", b"")
+        pk.encrypt("side1", "2", b"")
+        pk.encrypt("side1", "1", b"")
+        pk.encrypt("side1", "3", b"")
+        # "2" was the least recently used
+        self.assertEqual(list(pk._boxes), [("side1", "1"), ("side1", "3")])
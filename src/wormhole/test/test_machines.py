@@ -4,6 +4,7 @@ import json
 
 from nacl.secret import SecretBox
 from spake2 import SPAKE2_Symmetric
+from twisted.internet import defer, error, protocol, task
 from twisted.trial import unittest
 from zope.interface import directlyProvides, implementer
 
@@ -14,8 +15,8 @@ from .. import (__version__, _allocator, _boss, _code, _input, _key, _lister,
                 _terminator, errors, timing)
 from .._interfaces import (IAllocator, IBoss, ICode, IDilator, IInput, IKey,
                            ILister, IMailbox, INameplate, IOrder, IReceive,
-                           IRendezvousConnector, ISend, ITerminator, IWordlist,
-                           ITorManager)
+                           IRendezvousConnector, ISend, ITerminator, ITiming,
+                           IWordlist, ITorManager)
 from .._key import derive_key, derive_phase_key, encrypt_data
 from ..journal import ImmediateJournal
 from ..util import (bytes_to_dict, bytes_to_hexstr, dict_to_bytes,
@@ -551,6 +552,41 @@ class Lister(unittest.TestCase):
             ("i.got_nameplates", {"1", "2", "3", "4"}),
         ])
 
+    def test_cache(self):
+        clock = task.Clock()
+        events = []
+        lister = _lister.Lister(timing.DebugTiming(), clock)
+        rc = Dummy("rc", events, IRendezvousConnector, "tx_list")
+        i = Dummy("i", events, IInput, "got_nameplates")
+        lister.wire(rc, i)
+        lister.connected()
+        lister.refresh()
+        lister.rx_nameplates({"1", "2"})
+        self.assertEqual(events, [
+            ("rc.tx_list", ),
+            ("i.got_nameplates", {"1", "2"}),
+        ])
+        events[:] = []
+        # a fresh answer is reused, without asking the server
+        clock.advance(lister.CACHE_TTL - 1)
+        lister.refresh()
+        self.assertEqual(events, [("i.got_nameplates", {"1", "2"})])
+        events[:] = []
+        # a stale one is handed out while we ask for a new one
+        clock.advance(1)
+        lister.refresh()
+        self.assertEqual(events, [
+            ("i.got_nameplates", {"1", "2"}),
+            ("rc.tx_list", ),
+        ])
+        events[:] = []
+        lister.rx_nameplates({"2", "3"})
+        lister.refresh()
+        self.assertEqual(events, [
+            ("i.got_nameplates", {"2", "3"}),
+            ("i.got_nameplates", {"2", "3"}),
+        ])
+
     def test_reconnect(self):
         l, rc, i, events = self.build()
         l.refresh()
@@ -1065,6 +1101,84 @@ class Mailbox(unittest.TestCase):
         self.assertEqual(events[:len(initial_events)], initial_events)
         self.assertEqual(set(events[len(initial_events):]), tx_add_events)
 
+    def test_resume(self):
+        # after reconnecting, we re-open the mailbox but only re-send the
+        # messages the server never acknowledged
+        m, n, rc, o, t, events = self.build()
+        m.connected()
+        m.got_mailbox("mbox1")
+        m.add_message("phase1", b"msg1")
+        m.add_message("phase2", b"msg2")
+        m.rx_acked("phase1")
+        events[:] = []
+        m.lost()
+        m.connected()
+        self.assertEqual(events, [("rc.tx_open", "mbox1"),
+                                  ("rc.tx_add", "phase2", b"msg2")])
+        events[:] = []
+        # acks that arrive while closing, or closed, are ignored
+        m.close("happy")
+        m.rx_acked("phase2")
+        m.rx_closed()
+        m.rx_acked("phase2")
+        self.assertEqual(events, [("rc.tx_close", "mbox1", "happy"),
+                                  ("t.mailbox_done", )])
+
+    def test_serialize(self):
+        # a restored Mailbox is disconnected, and re-sends what the server
+        # never acknowledged once it connects
+        m, n, rc, o, t, events = self.build()
+        m.connected()
+        m.got_mailbox("mbox1")
+        m.add_message("phase1", b"msg1")
+        m.add_message("phase2", b"msg2")
+        m.rx_acked("phase1")
+        m.rx_message("side2", "pake", b"body")
+        data = m.serialize()
+        self.assertEqual(data["state"], "S2A")
+        self.assertEqual(data["pending_outbound"], [["phase2", "6d736732"]])
+
+        m2, n, rc, o, t, events = self.build()
+        m2.restore(data)
+        self.assertEqual(events, [])
+        m2.connected()
+        m2.rx_message("side2", "pake", b"body")  # already processed
+        self.assertEqual(events, [("rc.tx_open", "mbox1"),
+                                  ("rc.tx_add", "phase2", b"msg2"),
+                                  ("n.release", )])
+
+    def test_window(self):
+        m, n, rc, o, t, events = self.build()
+        m.MAX_IN_FLIGHT = 10
+        m.connected()
+        m.got_mailbox("mbox1")
+        m.add_message("phase1", b"1234")
+        m.add_message("phase2", b"1234")
+        m.add_message("phase3", b"1234")
+        # a message bigger than the window still goes out on its own
+        m.add_message("phase4", b"12345678901")
+        self.assertEqual(events, [("rc.tx_open", "mbox1"),
+                                  ("rc.tx_add", "phase1", b"1234"),
+                                  ("rc.tx_add", "phase2", b"1234")])
+        events[:] = []
+        m.rx_acked("phase1")
+        self.assertEqual(events, [("rc.tx_add", "phase3", b"1234")])
+        events[:] = []
+        m.rx_message("side1", "phase2", b"1234")  # the echo counts too
+        m.rx_acked("phase2")
+        m.rx_acked("phase3")
+        self.assertEqual(events, [("rc.tx_add", "phase4", b"12345678901")])
+        events[:] = []
+        # a new connection gets a fresh window
+        m.add_message("phase5", b"1")
+        m.lost()
+        m.connected()
+        self.assertEqual(events, [("rc.tx_open", "mbox1"),
+                                  ("rc.tx_add", "phase4", b"12345678901")])
+        events[:] = []
+        m.rx_acked("phase4")
+        self.assertEqual(events, [("rc.tx_add", "phase5", b"1")])
+
     def test_connect_first(self):  # connect before got_mailbox
         m, n, rc, o, t, events = self.build()
         m.add_message("phase1", b"msg1")
@@ -1324,6 +1438,16 @@ class Boss(unittest.TestCase):
         b._D = Dummy("d", events, IDilator, "got_wormhole_versions", "got_key")
         return b, events
 
+    def test_not_serializable(self):
+        b, events = self.build()
+        with self.assertRaises(errors.NotSerializableError):
+            b.serialize()  # S0_empty: no code yet
+        b.set_code("1-code")
+        b.got_code("1-code")
+        b.close()
+        with self.assertRaises(errors.NotSerializableError):
+            b.serialize()  # S3_closing
+
     def test_basic(self):
         b, events = self.build()
         b.set_code("1-code")
@@ -1368,6 +1492,54 @@ class Boss(unittest.TestCase):
         b.closed()
         self.assertEqual(events, [("w.closed", "happy")])
 
+    def test_chunks(self):
+        b, events = self.build()
+        b.CHUNK_SIZE = 4
+        b.set_code("1-code")
+        b.got_code("1-code")
+        b.got_key(b"key")
+        b.happy()
+        events[:] = []
+
+        # we can't chunk until we know they can reassemble
+        b.send(b"0123456789")
+        b.send(b"msg")
+        self.assertEqual(events, [("s.send", "1", b"msg")])
+        events[:] = []
+        b.got_message("version", b'{"can-chunk": ["1"]}')
+        self.assertEqual(events, [
+            ("d.got_wormhole_versions", {"can-chunk": ["1"]}),
+            ("w.got_versions", {}),
+            ("s.send", "0.0/3", b"0123"),
+            ("s.send", "0.1/3", b"4567"),
+            ("s.send", "0.2/3", b"89"),
+        ])
+        events[:] = []
+        b.send(b"0123")
+        self.assertEqual(events, [("s.send", "2", b"0123")])
+        events[:] = []
+
+        # the pieces can arrive in any order
+        b.got_message("0.1/2", b"4567")
+        b.got_message("1", b"msg1")
+        self.assertEqual(events, [])
+        b.got_message("0.0/2", b"0123")
+        self.assertEqual(events, [("w.received", b"01234567"),
+                                  ("w.received", b"msg1")])
+
+    def test_no_chunks(self):
+        b, events = self.build()
+        b.CHUNK_SIZE = 4
+        b.set_code("1-code")
+        b.got_code("1-code")
+        b.got_key(b"key")
+        b.happy()
+        b.send(b"0123456789")
+        events[:] = []
+        # older peers get the whole thing
+        b.got_message("version", b"{}")
+        self.assertEqual(events[-1], ("s.send", "0", b"0123456789"))
+
     def test_unwelcome(self):
         b, events = self.build()
         unwelcome = {"error": "go away"}
@@ -1543,9 +1715,9 @@ class Boss(unittest.TestCase):
 
 
 class Rendezvous(unittest.TestCase):
-    def build(self):
+    def build(self, reactor=None):
         events = []
-        reactor = object()
+        reactor = reactor or object()
         journal = ImmediateJournal()
         tor_manager = None
         client_version = ("python", __version__)
@@ -1611,7 +1783,8 @@ class Rendezvous(unittest.TestCase):
                     side="side",
                     client_version=["python", __version__],
                     id="0000",
-                    type="bind"),
+                    type="bind",
+                    **{"body-encodings-v1": ["base64"]}),
             ])
 
         rc.ws_close(True, None, None)
@@ -1622,6 +1795,272 @@ class Rendezvous(unittest.TestCase):
             ("a.lost", ),
         ])
 
+    def test_acks(self):
+        rc, events = self.build()
+        m = Dummy("m", events, IMailbox, "connected", "lost", "rx_acked")
+        rc.wire(rc._B, rc._N, m, rc._A, rc._L, rc._T)
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        ids = iter([b"\x00\x01", b"\x00\x02"])
+        with mock.patch("os.urandom", side_effect=lambda n: next(ids)):
+            rc.tx_add("phase1", b"")
+            rc.tx_add("phase2", b"")
+        events[:] = []
+        rc.ws_message(dict_to_bytes(dict(type="ack", id="0001")))
+        # acks for anything other than an add are ignored
+        rc.ws_message(dict_to_bytes(dict(type="ack", id="ffff")))
+        self.assertEqual(events, [("m.rx_acked", "phase1")])
+        events[:] = []
+        # an ack can't arrive on a new connection for a message sent on an
+        # old one
+        rc.ws_close(True, None, None)
+        rc.ws_open(ws)
+        events[:] = []
+        rc.ws_message(dict_to_bytes(dict(type="ack", id="0002")))
+        self.assertEqual(events, [])
+
+    def test_body_encoding(self):
+        rc, events = self.build()
+        b = Dummy("b", events, IBoss, "rx_welcome")
+        m = Dummy("m", events, IMailbox, "connected", "lost", "rx_message")
+        rc.wire(b, rc._N, m, rc._A, rc._L, rc._T)
+        ws = mock.Mock()
+
+        def bodies(ws):
+            for c in ws.mock_calls:
+                msg = bytes_to_dict(c[1][0])
+                if msg["type"] == "add":
+                    yield msg["body"]
+
+        # bodies stay hex until the server says it can do base64
+        rc.ws_open(ws)
+        rc.tx_add("phase", b"\xff\xfe")
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome={})))
+        rc.tx_add("phase", b"\xff\xfe")
+        rc.ws_message(dict_to_bytes(dict(type="message", side="side2",
+                                         phase="phase", body="fffe")))
+        self.assertEqual(list(bodies(ws)), ["fffe", "fffe"])
+
+        rc.ws_close(True, None, None)
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        welcome = {"body-encodings-v1": ["base64", "something-else"]}
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome=welcome)))
+        rc.tx_add("phase", b"\xff\xfe")
+        rc.ws_message(dict_to_bytes(dict(type="message", side="side2",
+                                         phase="phase", body="//4=")))
+        self.assertEqual(list(bodies(ws)), ["//4="])
+        self.assertEqual([e for e in events if e[0] == "m.rx_message"],
+                         [("m.rx_message", "side2", "phase", b"\xff\xfe"),
+                          ("m.rx_message", "side2", "phase", b"\xff\xfe")])
+
+        # and the choice doesn't outlive the connection
+        rc.ws_close(True, None, None)
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        rc.tx_add("phase", b"\xff\xfe")
+        self.assertEqual(list(bodies(ws)), ["fffe"])
+
+        # a client can decline, even if the server offers
+        rc.ws_close(True, None, None)
+        rc.BODY_ENCODINGS = []
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome=welcome)))
+        rc.tx_add("phase", b"\xff\xfe")
+        self.assertEqual(list(bodies(ws)), ["fffe"])
+        bind = bytes_to_dict(ws.mock_calls[0][1][0])
+        self.assertEqual(bind["body-encodings-v1"], [])
+
+    def test_batch(self):
+        clock = task.Clock()
+        rc, events = self.build(clock)
+        m = Dummy("m", events, IMailbox, "connected", "lost", "rx_acked")
+        b = Dummy("b", events, IBoss, "rx_welcome")
+        rc.wire(b, rc._N, m, rc._A, rc._L, rc._T)
+        ws = mock.Mock()
+
+        def sent(ws):
+            msgs = [bytes_to_dict(c[1][0]) for c in ws.mock_calls]
+            ws.mock_calls[:] = []
+            return msgs
+
+        rc.ws_open(ws)
+        welcome = {"batch-v1": {}}
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome=welcome)))
+        sent(ws)
+
+        # adds from one turn go out together, at the end of it
+        ids = iter([b"\x00\x01", b"\x00\x02", b"\x00\x03"])
+        with mock.patch("os.urandom", side_effect=lambda n: next(ids)):
+            rc.tx_add("0", b"\x00")
+            rc.tx_add("1", b"\x01")
+            self.assertEqual(sent(ws), [])
+            clock.advance(0)
+        msgs = sent(ws)
+        self.assertEqual(len(msgs), 1)
+        self.assertEqual(msgs[0]["type"], "batch")
+        self.assertEqual(msgs[0]["id"], "0003")
+        self.assertEqual(msgs[0]["messages"], [
+            dict(type="add", phase="0", body="00", id="0001"),
+            dict(type="add", phase="1", body="01", id="0002"),
+        ])
+        # the server acks each add
+        events[:] = []
+        rc.ws_message(dict_to_bytes(dict(type="ack", id="0003")))
+        rc.ws_message(dict_to_bytes(dict(type="ack", id="0002")))
+        self.assertEqual(events, [("m.rx_acked", "1")])
+
+        # a lone add goes out as usual
+        rc.tx_add("2", b"\x02")
+        clock.advance(0)
+        self.assertEqual([(m["type"], m["phase"]) for m in sent(ws)],
+                         [("add", "2")])
+
+        # anything else flushes the adds before it
+        rc.tx_add("3", b"\x03")
+        rc.tx_add("4", b"\x04")
+        rc.tx_close("mailbox", "happy")
+        msgs = sent(ws)
+        self.assertEqual([m["type"] for m in msgs], ["batch", "close"])
+        self.assertEqual([m["phase"] for m in msgs[0]["messages"]],
+                         ["3", "4"])
+        clock.advance(0)
+        self.assertEqual(sent(ws), [])
+
+        # adds still waiting when the connection is lost are dropped: the
+        # Mailbox sends them again
+        rc.tx_add("5", b"\x05")
+        rc.ws_close(True, None, None)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        rc.ws_open(ws)
+        sent(ws)
+        # and without batch-v1 in the welcome, each add is sent by itself
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome={})))
+        rc.tx_add("5", b"\x05")
+        self.assertEqual([m["type"] for m in sent(ws)], ["add"])
+
+    def test_unique_ids(self):
+        rc, events = self.build()
+        m = Dummy("m", events, IMailbox, "connected", "lost")
+        rc.wire(rc._B, rc._N, m, rc._A, rc._L, rc._T)
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        # ids of adds that are still waiting for their ack aren't reused
+        ids = iter([b"\x00\x01", b"\x00\x01", b"\x00\x02"])
+        with mock.patch("os.urandom", side_effect=lambda n: next(ids)):
+            rc.tx_add("0", b"")
+            rc.tx_add("1", b"")
+        self.assertEqual(rc._unacked_adds, {"0001": "0", "0002": "1"})
+
+    def test_unique_ids_other_frames(self):
+        rc, events = self.build()
+        m = Dummy("m", events, IMailbox, "connected", "lost", "rx_acked")
+        rc.wire(rc._B, rc._N, m, rc._A, rc._L, rc._T)
+        ws = mock.Mock()
+        rc.ws_open(ws)
+        # nor are the ids of other messages still waiting for theirs, so
+        # their acks can't be mistaken for the add's
+        ids = iter([b"\x00\x01", b"\x00\x01", b"\x00\x02"])
+        with mock.patch("os.urandom", side_effect=lambda n: next(ids)):
+            rc.tx_claim("1")
+            rc.tx_add("0", b"")
+        self.assertEqual(rc._unacked_adds, {"0002": "0"})
+        events[:] = []
+        rc.ws_message(dict_to_bytes(dict(type="ack", id="0001")))
+        self.assertEqual(events, [])
+        rc.ws_message(dict_to_bytes(dict(type="ack", id="0002")))
+        self.assertEqual(events, [("m.rx_acked", "0")])
+
+    def test_custom_timing(self):
+        # a timing object of the caller's own, without .enabled, still gets
+        # every event
+        @implementer(ITiming)
+        class Timing(object):
+            def __init__(self):
+                self.events = []
+
+            def add(self, name, **details):
+                self.events.append(name)
+
+        t = Timing()
+        rc = _rendezvous.RendezvousConnector(
+            "ws://host:4000/v1", "appid", "side", object(),
+            ImmediateJournal(), None, t, ("python", __version__))
+        events = []
+        rc.wire(Dummy("b", events, IBoss, "rx_welcome"),
+                Dummy("n", events, INameplate, "connected"),
+                Dummy("m", events, IMailbox, "connected"),
+                Dummy("a", events, IAllocator, "connected"),
+                Dummy("l", events, ILister, "connected"),
+                Dummy("t", events, ITerminator))
+        rc.ws_open(mock.Mock())
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome={})))
+        self.assertEqual(t.events, ["ws_send", "ws_receive"])
+
+    def test_list_deltas(self):
+        rc, events = self.build()
+        b = Dummy("b", events, IBoss, "rx_welcome")
+        lister = Dummy("l", events, ILister, "connected", "lost", "rx_nameplates")
+        rc.wire(b, rc._N, rc._M, rc._A, lister, rc._T)
+        ws = mock.Mock()
+
+        def sent(ws):
+            msgs = [bytes_to_dict(c[1][0]) for c in ws.mock_calls]
+            ws.mock_calls[:] = []
+            return [(m["type"], m.get("since")) for m in msgs]
+
+        def nameplates(*nids):
+            return [{"id": nid} for nid in nids]
+
+        rc.ws_open(ws)
+        welcome = {"nameplates-since-v1": {}}
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome=welcome)))
+        sent(ws)
+        rc.tx_list()
+        self.assertEqual(sent(ws), [("list", None)])
+        events[:] = []
+        rc.ws_message(dict_to_bytes(dict(type="nameplates", version="v1",
+                                         nameplates=nameplates("1", "2"))))
+        self.assertEqual(events, [("l.rx_nameplates", {"1", "2"})])
+
+        # the next list only asks for what changed
+        rc.tx_list()
+        self.assertEqual(sent(ws), [("list", "v1")])
+        events[:] = []
+        rc.ws_message(dict_to_bytes(dict(type="nameplates", version="v2",
+                                         since="v1",
+                                         added=nameplates("3"),
+                                         removed=nameplates("1"))))
+        self.assertEqual(events, [("l.rx_nameplates", {"2", "3"})])
+
+        # a delta we can't apply provokes a request for the whole list
+        events[:] = []
+        rc.ws_message(dict_to_bytes(dict(type="nameplates", version="v9",
+                                         since="v8", added=[], removed=[])))
+        self.assertEqual(events, [])
+        self.assertEqual(sent(ws), [("list", None)])
+
+        # the versions only mean something on the connection they came from
+        rc.ws_message(dict_to_bytes(dict(type="nameplates", version="v3",
+                                         nameplates=nameplates("4"))))
+        rc.ws_close(True, None, None)
+        rc.ws_open(ws)
+        sent(ws)
+        rc.ws_message(dict_to_bytes(dict(type="welcome", welcome=welcome)))
+        rc.tx_list()
+        self.assertEqual(sent(ws), [("list", None)])
+
+    def test_retry_policy(self):
+        policy = _rendezvous.retry_policy(_random=lambda: 0.0)
+        self.assertEqual([policy(a) for a in range(1, 5)],
+                         [0.1, 0.2, 0.4, 0.8])
+        self.assertEqual(policy(20), 60.0)
+        self.assertEqual(policy(100000), 60.0)
+        policy = _rendezvous.retry_policy(initial_delay=1.0, jitter=0.5,
+                                          _random=lambda: 1.0)
+        self.assertEqual(policy(1), 1.5)
+
     def test_endpoints(self):
         # parse different URLs and check the tls status of each
         reactor = object()
@@ -1687,6 +2126,242 @@ class Rendezvous(unittest.TestCase):
                          [mock.call.stream_via("host", 443, tls=True)])
 
 
+class SharedConnection(unittest.TestCase):
+    def build(self):
+        self.events = []
+        self.clock = task.Clock()
+        self.pool = _rendezvous.RendezvousPool()
+        self.services = []
+
+        def make_service(ep, f, retryPolicy):
+            cs = mock.Mock()
+            cs.stopService = mock.Mock(return_value=None)
+            self.services.append(cs)
+            return cs
+
+        self.patcher = mock.patch("twisted.application.internet.ClientService",
+                                  side_effect=make_service)
+        self.patcher.start()
+        self.addCleanup(self.patcher.stop)
+
+    def add(self, side):
+        rc = _rendezvous.RendezvousConnector(
+            "ws://host:4000/v1", "appid", side, self.clock,
+            ImmediateJournal(), None, timing.DebugTiming(),
+            ("python", __version__), None, self.pool)
+        events = self.events
+        rc.wire(Dummy("b" + side, events, IBoss, "rx_welcome", "rx_error",
+                      "error"),
+                Dummy("n" + side, events, INameplate, "connected", "lost",
+                      "rx_claimed"),
+                Dummy("m" + side, events, IMailbox, "connected", "lost"),
+                Dummy("a" + side, events, IAllocator, "connected", "lost"),
+                Dummy("l" + side, events, ILister, "connected", "lost"),
+                Dummy("t" + side, events, ITerminator, "stoppedRC"))
+        rc.start()
+        return rc
+
+    def sent(self, ws):
+        msgs = [bytes_to_dict(c[1][0]) for c in ws.sendMessage.mock_calls]
+        ws.sendMessage.reset_mock()
+        return [(m["type"], m.get("channel")) for m in msgs]
+
+    def test_multiplex(self):
+        self.build()
+        rc1 = self.add("1")
+        rc2 = self.add("2")
+        # one connection between them
+        self.assertEqual(len(self.services), 1)
+        cs = self.services[0]
+        self.assertEqual(cs.startService.mock_calls, [mock.call()])
+        shared = self.pool._connections[("ws://host:4000/v1", None)]
+
+        ws = mock.Mock()
+        shared.ws_open(ws)
+        # nobody binds until the welcome says they all can
+        self.assertEqual(self.events, [])
+        welcome = {"multiplex-v1": {}}
+        shared.ws_message(dict_to_bytes(dict(type="welcome",
+                                             welcome=welcome)))
+        self.assertEqual(self.events, [
+            ("b1.rx_welcome", welcome),
+            ("n1.connected", ), ("m1.connected", ), ("l1.connected", ),
+            ("a1.connected", ),
+            ("b2.rx_welcome", welcome),
+            ("n2.connected", ), ("m2.connected", ), ("l2.connected", ),
+            ("a2.connected", ),
+        ])
+        self.assertEqual(self.sent(ws), [("bind", "1"), ("bind", "2")])
+        self.events[:] = []
+
+        # responses are routed by their channel
+        shared.ws_message(dict_to_bytes(dict(type="claimed", mailbox="mb",
+                                             channel="2")))
+        shared.ws_message(dict_to_bytes(dict(type="error", error="oops",
+                                             orig=dict(channel="1"))))
+        shared.ws_message(dict_to_bytes(dict(type="claimed", mailbox="mb",
+                                             channel="gone")))
+        self.assertEqual(self.events, [("n2.rx_claimed", "mb"),
+                                       ("b1.rx_error", "oops",
+                                        dict(channel="1"))])
+        self.events[:] = []
+
+        # a later wormhole joins right away
+        rc3 = self.add("3")
+        self.assertEqual(self.events, [])
+        self.clock.advance(0)
+        self.assertEqual(self.events[0], ("b3.rx_welcome", welcome))
+        self.assertEqual(self.sent(ws), [("bind", "3")])
+        self.assertEqual(len(self.services), 1)
+        self.events[:] = []
+
+        # leaving unbinds, but keeps the connection for the others
+        rc3.stop()
+        self.assertEqual(self.sent(ws), [("unbind", "3")])
+        self.assertEqual(self.events, [("t3.stoppedRC", )])
+        self.events[:] = []
+
+        # losing the connection loses it for everyone
+        shared.ws_close(True, None, None)
+        self.assertEqual(self.events, [
+            ("n1.lost", ), ("m1.lost", ), ("l1.lost", ), ("a1.lost", ),
+            ("n2.lost", ), ("m2.lost", ), ("l2.lost", ), ("a2.lost", ),
+        ])
+        self.events[:] = []
+
+        rc1.stop()
+        self.assertEqual(cs.stopService.mock_calls, [])
+        rc2.stop()
+        self.assertEqual(cs.stopService.mock_calls, [mock.call()])
+        self.assertEqual(self.events, [("t1.stoppedRC", ),
+                                       ("t2.stoppedRC", )])
+        self.assertEqual(self.pool._connections, {})
+
+    def test_no_multiplex(self):
+        self.build()
+        self.add("1")
+        self.add("2")
+        shared = self.pool._connections[("ws://host:4000/v1", None)]
+        ws = mock.Mock()
+        shared.ws_open(ws)
+        shared.ws_message(dict_to_bytes(dict(type="welcome", welcome={})))
+        # the server can't share, so rc2 gets its own connection
+        self.assertEqual(len(self.services), 2)
+        self.assertEqual(self.services[1].startService.mock_calls,
+                         [mock.call()])
+        self.assertEqual(self.sent(ws), [("bind", "1")])
+        # and everything on the first connection goes to rc1
+        self.events[:] = []
+        shared.ws_message(dict_to_bytes(dict(type="claimed", mailbox="mb")))
+        self.assertEqual(self.events, [("n1.rx_claimed", "mb")])
+        # as do later wormholes, right away
+        self.add("3")
+        self.assertEqual(len(self.services), 3)
+
+
+class Replicas(unittest.TestCase):
+    def build(self, count):
+        self.cancelled = []
+        clock = task.Clock()
+        attempts = []  # (replica, Deferred from connect)
+        replicas = []
+        for i in range(count):
+            ws_factory = mock.Mock()
+            ws_factory.buildProtocol = lambda addr: mock.Mock()
+            ep = mock.Mock()
+
+            def connect(f, i=i):
+                d = defer.Deferred(lambda d, i=i: self.cancelled.append(i))
+                d.proto = f.buildProtocol(None)
+                attempts.append((i, d))
+                return d
+
+            ep.connect = connect
+            replicas.append(("ws://r%d/v1" % i, ws_factory, ep))
+        r = _rendezvous._Replicas(clock, replicas, 0.5)
+        f = protocol.Factory.forProtocol(_rendezvous._Session)
+        return r, f, clock, attempts
+
+    def connected(self, attempt):
+        i, d = attempt
+        d.callback(d.proto)
+        return d.proto
+
+    def test_stagger(self):
+        r, f, clock, attempts = self.build(3)
+        d = r.connect(f)
+        self.assertEqual([i for (i, _) in attempts], [0])
+        clock.advance(0.5)
+        self.assertEqual([i for (i, _) in attempts], [0, 1])
+        # a failure starts the next one right away
+        attempts[0][1].errback(error.ConnectionRefusedError())
+        self.assertEqual([i for (i, _) in attempts], [0, 1, 2])
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertNoResult(d)
+
+    def test_first_welcome_wins(self):
+        r, f, clock, attempts = self.build(3)
+        d = r.connect(f)
+        clock.advance(0.5)
+        p0 = self.connected(attempts[0])
+        p1 = self.connected(attempts[1])
+        self.assertEqual(p0._replica, 0)
+        # p1 is welcomed first, although p0 connected first
+        p1._race.welcomed(p1, b"welcome")
+        session = self.successResultOf(d)
+        self.assertIs(session.transport, p1.transport)
+        self.assertIs(p1._session, session)
+        self.assertEqual(p1.won.mock_calls, [mock.call(b"welcome")])
+        self.assertEqual(p0.transport.abortConnection.mock_calls, [mock.call()])
+        # the third one never starts
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(len(attempts), 2)
+        # the loser's welcome, and its close, are ignored
+        p0._race.welcomed(p0, b"welcome")
+        p0._race.closed(p0, "aborted")
+        self.assertEqual(p0.won.mock_calls, [])
+
+        # if we reconnect, the replica that dropped us goes last
+        attempts[:] = []
+        r.connect(f)
+        clock.advance(0.5)
+        clock.advance(0.5)
+        self.assertEqual([i for (i, _) in attempts], [2, 0, 1])
+
+    def test_all_fail(self):
+        r, f, clock, attempts = self.build(2)
+        d = r.connect(f)
+        attempts[0][1].errback(error.ConnectionRefusedError())
+        p1 = self.connected(attempts[1])
+        self.assertNoResult(d)
+        p1._race.closed(p1, "not a websocket server")
+        self.failureResultOf(d, error.ConnectError)
+
+    def test_cancel(self):
+        r, f, clock, attempts = self.build(2)
+        d = r.connect(f)
+        p0 = self.connected(attempts[0])
+        clock.advance(0.5)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+        self.assertEqual(self.cancelled, [1])
+        self.assertEqual(p0.transport.abortConnection.mock_calls, [mock.call()])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+    def test_connector(self):
+        reactor = object()
+        with mock.patch("twisted.application.internet.ClientService") as cs:
+            _rendezvous.RendezvousConnector(
+                "ws://a/v1, ws://b/v1", "appid", "side", reactor,
+                ImmediateJournal(), None, timing.DebugTiming(),
+                ("python", __version__))
+        ep, f = cs.mock_calls[0][1]
+        self.assertEqual(f.protocol, _rendezvous._Session)
+        self.assertIsInstance(ep, _rendezvous._Replicas)
+        self.assertEqual([url for (url, _, _) in ep._replicas],
+                         ["ws://a/v1", "ws://b/v1"])
+        self.assertEqual([f.url for (_, f, _) in ep._replicas],
+                         ["ws://a/v1", "ws://b/v1"])
 
 
 # TODO
@@ -0,0 +1,51 @@
+from __future__ import print_function, unicode_literals
+
+import io
+import json
+
+from twisted.trial import unittest
+
+from ..timing import DebugTiming, NullTiming
+
+
+class Null(unittest.TestCase):
+    def test_add(self):
+        t = NullTiming()
+        self.assertFalse(t.enabled)
+        ev = t.add("name", when=1.0, detail="x")
+        ev.detail(more="y")
+        ev.finish(when=2.0)
+        with t.add("block") as ev:
+            pass
+        with self.assertRaises(ValueError):
+            with t.add("block"):
+                raise ValueError()
+
+
+class Debug(unittest.TestCase):
+    def read(self, t):
+        fn = self.mktemp()
+        t.write(fn, io.StringIO())
+        with open(fn) as f:
+            return json.load(f)
+
+    def test_write(self):
+        t = DebugTiming()
+        self.assertTrue(t.enabled)
+        t.add("one", when=1.0, a=1).finish(when=2.0, b=2)
+        with t.add("two", when=3.0):
+            pass
+        data = self.read(t)
+        self.assertEqual([e["name"] for e in data], ["one", "two"])
+        self.assertEqual(data[0], dict(name="one", start=1.0, stop=2.0,
+                                       details=dict(a=1, b=2)))
+        self.assertEqual(data[1]["start"], 3.0)
+        self.assertIsNot(data[1]["stop"], None)
+
+    def test_ring(self):
+        t = DebugTiming(max_events=3)
+        for i in range(5):
+            t.add("event%d" % i)
+        data = self.read(t)
+        self.assertEqual([e["name"] for e in data],
+                         ["event2", "event3", "event4"])
@@ -2,12 +2,14 @@ from __future__ import print_function, unicode_literals
 
 import gc
 import io
+import os
 from binascii import hexlify, unhexlify
 
 import six
 from nacl.exceptions import CryptoError
 from nacl.secret import SecretBox
-from twisted.internet import address, defer, endpoints, error, protocol, task
+from twisted.internet import (address, defer, error, interfaces, protocol,
+                              reactor, task)
 from twisted.internet.defer import gatherResults, inlineCallbacks
 from twisted.python import log
 from twisted.test import proto_helpers
@@ -16,9 +18,10 @@ from twisted.trial import unittest
 import mock
 from wormhole_transit_relay import transit_server
 
-from .. import transit
+from .. import ipaddrs, transit
 from .._hints import DirectTCPV1Hint
 from ..errors import InternalError
+from ..timing import DebugTiming
 from ..util import HKDF
 from .common import ServerBase
 
@@ -68,6 +71,18 @@ class Highlander(unittest.TestCase):
         self.failureResultOf(d, defer.CancelledError)
         self.assertEqual(cancelled, set(range(4)))
 
+    def test_late_contender(self):
+        contenders = [defer.Deferred() for i in range(2)]
+        h = transit._ThereCanBeOnlyOne(contenders)
+        d = h.run()
+        contenders[0].errback(ValueError())
+        late = defer.Deferred()
+        h.add(late)
+        contenders[1].errback(TypeError())
+        self.assertNoResult(d)
+        late.callback("yay")
+        self.assertEqual(self.successResultOf(d), "yay")
+
     def test_cancel_after_one_failure(self):
         cancelled = set()
         contenders = [
@@ -170,6 +185,16 @@ class Basic(unittest.TestCase):
         }])
         self.assertRaises(InternalError, transit.Common, 123)
 
+    @inlineCallbacks
+    def test_split_hints(self):
+        c = transit.Common("tcp:host:1234", no_listen=True)
+        direct = yield c.get_direct_connection_hints()
+        self.assertEqual(direct, [])
+        relay = c.get_relay_connection_hints()
+        hints = yield c.get_connection_hints()
+        self.assertEqual(hints, relay)
+        self.assertEqual(relay[0]["type"], "relay-v1")
+
     @inlineCallbacks
     def test_no_relay_hints(self):
         c = transit.Common(None, no_listen=True)
@@ -237,6 +262,54 @@ class Basic(unittest.TestCase):
             },
         ])
 
+    def test_abilities_unix(self):
+        c = transit.Common(None)
+        abilities = c.get_connection_abilities()
+        self.assertEqual(abilities[-1], {
+            "type": "unix-v1",
+            "host": ipaddrs.find_host_id()
+        })
+
+    @inlineCallbacks
+    def test_same_host(self):
+        s = transit.TransitSender(None)
+        r = transit.TransitReceiver(None)
+        r.add_connection_abilities(s.get_connection_abilities())
+        hints = self.successResultOf(r.get_connection_hints())
+        self.assertEqual(hints[0]["type"], "unix-v1")
+        self.assertEqual(hints[0]["priority"], 1.0)
+        path = hints[0]["path"]
+        self.assertTrue(os.path.exists(path))
+        self.assertEqual(set(h["type"] for h in hints[1:]),
+                         set(["direct-tcp-v1"]))
+        r._stop_listening()
+        # the socket and its directory are cleaned up, once the port closes
+        for i in range(100):
+            if not os.path.exists(os.path.dirname(path)):
+                break
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        self.assertFalse(os.path.exists(os.path.dirname(path)))
+
+    def test_other_host(self):
+        r = transit.TransitReceiver(None)
+        r.add_connection_abilities([{"type": "unix-v1", "host": "other"}])
+        r.add_connection_abilities([{"type": "unknown"}])
+        hints = self.successResultOf(r.get_connection_hints())
+        r._stop_listening()
+        self.assertEqual(set(h["type"] for h in hints),
+                         set(["direct-tcp-v1"]))
+
+    def test_same_host_no_listen(self):
+        s = transit.TransitSender(None)
+        r = transit.TransitReceiver(None, no_listen=True)
+        r.add_connection_abilities(s.get_connection_abilities())
+        hints = self.successResultOf(r.get_connection_hints())
+        self.assertEqual(hints, [])
+
+    if not interfaces.IReactorUNIX.providedBy(reactor):
+        test_abilities_unix.skip = "no Unix sockets here"
+        test_same_host.skip = "no Unix sockets here"
+
     def test_transit_key_wait(self):
         KEY = b"123"
         c = transit.Common("")
@@ -287,6 +360,7 @@ class Basic(unittest.TestCase):
 
     def test_connection_ready(self):
         s = transit.TransitSender("")
+        s.SELECTION_WINDOW = 0  # first one wins
         self.assertEqual(s.connection_ready("p1"), "go")
         self.assertEqual(s._winner, "p1")
         self.assertEqual(s.connection_ready("p2"), "nevermind")
@@ -296,6 +370,191 @@ class Basic(unittest.TestCase):
         self.assertEqual(r.connection_ready("p1"), "wait-for-decision")
         self.assertEqual(r.connection_ready("p2"), "wait-for-decision")
 
+    def _inbound(self, factory, host):
+        p = mock.Mock()
+        p.factory = factory
+        p.transport.getHost.return_value = address.IPv6Address("TCP", host,
+                                                               1234)
+        return p
+
+    def test_extra_streams(self):
+        s = transit.TransitSender("", streams=3)
+        s.SELECTION_WINDOW = 0
+        f = transit.InboundConnectionFactory(s)
+        winner = self._inbound(f, "2001:db8::1")
+        self.assertEqual(s.connection_ready(winner), "go")
+        s._accepting_streams = True
+        # a straggler from the race, which reached a different address
+        straggler = self._inbound(f, "::ffff:192.0.2.1")
+        self.assertEqual(s.connection_ready(straggler), "nevermind")
+        extra = self._inbound(f, "2001:db8::1")
+        self.assertEqual(s.connection_ready(extra), "go")
+        self.assertEqual(s.connection_ready(extra), "go")
+        # that's all the streams we asked for
+        self.assertEqual(s.connection_ready(extra), "nevermind")
+
+    def _candidate(self, description, rtt, relay=False):
+        p = mock.Mock()
+        p.state = "deciding"
+        p.relay_handshake = b"relay handshake" if relay else None
+        p.describe = mock.Mock(return_value=description)
+        p.handshake_rtt = rtt
+        return p
+
+    def _select(self, *candidates):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock)
+        s._hint_priorities = {"->tcp:low:1234": 0.0,
+                              "->tcp:high:1234": 1.0,
+                              "->relay:tcp:relay:1234": 2.0}
+        for p in candidates:
+            self.assertEqual(s.connection_ready(p), "deciding")
+            clock.advance(s.SELECTION_WINDOW / (len(candidates) + 1))
+        for p in candidates:
+            self.assertEqual(p.select.mock_calls, [])
+        clock.advance(s.SELECTION_WINDOW)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        winners = [p for p in candidates
+                   if p.select.mock_calls == [mock.call(True)]]
+        self.assertEqual(len(winners), 1)
+        for p in candidates:
+            if p is not winners[0]:
+                self.assertEqual(p.select.mock_calls, [mock.call(False)])
+        # late arrivals lose right away
+        self.assertEqual(s.connection_ready(self._candidate("late", 0.0)),
+                         "nevermind")
+        return winners[0]
+
+    def test_select_direct_over_relay(self):
+        relay = self._candidate("->relay:tcp:relay:1234", 0.01, relay=True)
+        direct = self._candidate("->tcp:low:1234", 0.5)
+        self.assertIdentical(self._select(relay, direct), direct)
+
+    def test_select_priority(self):
+        low = self._candidate("->tcp:low:1234", 0.01)
+        high = self._candidate("->tcp:high:1234", 0.5)
+        self.assertIdentical(self._select(low, high), high)
+
+    def test_select_rtt(self):
+        slow = self._candidate("<-1.2.3.4:5678", 0.5)
+        fast = self._candidate("->tcp:low:1234", 0.01)
+        self.assertIdentical(self._select(slow, fast), fast)
+
+    def test_select_skips_lost(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock)
+        p1 = self._candidate("->tcp:low:1234", 0.01)
+        p2 = self._candidate("->tcp:low:1234", 0.5)
+        self.assertEqual(s.connection_ready(p1), "deciding")
+        self.assertEqual(s.connection_ready(p2), "deciding")
+        p1.state = "hung up"
+        clock.advance(s.SELECTION_WINDOW)
+        self.assertEqual(p1.select.mock_calls, [])
+        self.assertEqual(p2.select.mock_calls, [mock.call(True)])
+
+    def test_select_all_lost(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock)
+        p1 = self._candidate("->tcp:low:1234", 0.01)
+        self.assertEqual(s.connection_ready(p1), "deciding")
+        p1.state = "hung up"
+        clock.advance(s.SELECTION_WINDOW)
+        self.assertEqual(p1.select.mock_calls, [])
+        # so the next one starts a new window
+        p2 = self._candidate("->tcp:low:1234", 0.5)
+        self.assertEqual(s.connection_ready(p2), "deciding")
+        clock.advance(s.SELECTION_WINDOW)
+        self.assertEqual(p2.select.mock_calls, [mock.call(True)])
+
+
+class RelayProbe(unittest.TestCase):
+    def setUp(self):
+        self.clock = task.Clock()
+        self.connects = {}  # hostname -> Deferred from ep.connect()
+
+    def _endpoint(self, hint_obj, tor, reactor):
+        ep = mock.Mock()
+        d = self.connects[hint_obj.hostname] = defer.Deferred()
+        ep.connect = mock.Mock(return_value=d)
+        return ep
+
+    def start(self, relays):
+        c = transit.Common(relays, no_listen=True, reactor=self.clock,
+                           timing=DebugTiming())
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint):
+            d = c.get_connection_hints()
+        return c, d
+
+    def priorities(self, hints):
+        return [(h["hints"][0]["hostname"], h["hints"][0]["priority"])
+                for h in hints]
+
+    def probes(self, c):
+        return [(e._details["relay"], e._details.get("rtt"),
+                 "error" in e._details) for e in c._timing._events
+                if e._name == "transit relay probe"]
+
+    def test_several_relays(self):
+        for relays in ["tcp:a:1,tcp:b:2", ["tcp:a:1", "tcp:b:2"]]:
+            c = transit.Common(relays, no_listen=True)
+            self.assertEqual(self.priorities(c.get_relay_connection_hints()),
+                             [("a", 0.0), ("b", 0.0)])
+        self.assertRaises(InternalError, transit.Common, [123])
+
+    def test_one_relay(self):
+        c, d = self.start("tcp:a:1")
+        self.assertEqual(self.connects, {})
+        self.assertEqual(self.priorities(self.successResultOf(d)),
+                         [("a", 0.0)])
+
+    def test_order_by_rtt(self):
+        c, d = self.start("tcp:a:1,tcp:b:2,tcp:c:3")
+        self.assertEqual(sorted(self.connects), ["a", "b", "c"])
+        self.assertNoResult(d)
+        self.clock.advance(0.25)
+        p = mock.Mock()
+        self.connects["b"].callback(p)
+        # we hang up without saying anything
+        self.assertEqual(p.mock_calls, [mock.call.transport.loseConnection()])
+        self.assertNoResult(d)
+        self.clock.advance(0.25)
+        self.connects["a"].callback(mock.Mock())
+        self.connects["c"].errback(error.ConnectionRefusedError())
+        hints = self.successResultOf(d)
+        self.assertEqual(self.priorities(hints),
+                         [("b", 0.0), ("a", -1.0 / 3), ("c", -2.0 / 3)])
+        # connect() will use the new priorities too
+        self.assertEqual(c._our_relay_hints, set(c._transit_relays))
+        self.assertEqual(self.probes(c), [("->relay:tcp:a:1", 0.5, False),
+                                          ("->relay:tcp:b:2", 0.25, False),
+                                          ("->relay:tcp:c:3", None, True)])
+        # we only measure once
+        self.assertIs(c.probe_relays(), c.probe_relays())
+        self.assertEqual(len(self.probes(c)), 3)
+
+    def test_timeout(self):
+        c, d = self.start("tcp:a:1,tcp:b:2")
+        self.connects["b"].callback(mock.Mock())
+        self.clock.advance(c.PROBE_TIMEOUT)
+        # the slow probe was cancelled, and its failure consumed
+        self.assertIsNone(self.successResultOf(self.connects["a"]))
+        self.assertEqual(self.probes(c), [("->relay:tcp:a:1", None, True),
+                                          ("->relay:tcp:b:2", 0, False)])
+        self.assertEqual(self.priorities(self.successResultOf(d)),
+                         [("b", 0.0), ("a", -0.5)])
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_priority_wins(self):
+        # a priority= from the user beats a faster relay
+        c, d = self.start("tcp:a:1:priority=1.0,tcp:b:2,tcp:c:3")
+        self.connects["c"].callback(mock.Mock())
+        self.clock.advance(0.05)
+        self.connects["b"].callback(mock.Mock())
+        self.connects["a"].callback(mock.Mock())
+        self.assertEqual(self.priorities(self.successResultOf(d)),
+                         [("a", 1.0), ("c", 0.0), ("b", -0.5)])
+
 
 class Listener(unittest.TestCase):
     def test_listener(self):
@@ -304,7 +563,15 @@ class Listener(unittest.TestCase):
         self.assertIsInstance(hints, (list, set))
         if hints:
             self.assertIsInstance(hints[0], DirectTCPV1Hint)
-        self.assertIsInstance(ep, endpoints.TCP4ServerEndpoint)
+        self.assertIsInstance(ep, ipaddrs.DualStackServerEndpoint)
+
+    def test_listen_ports(self):
+        c = transit.Common("", listen_ports=[4000, 4001])
+        with mock.patch("wormhole.ipaddrs.choose_listen_port",
+                        return_value=4001) as clp:
+            hints, ep = c._build_listener()
+        self.assertEqual(clp.mock_calls, [mock.call([4000, 4001])])
+        self.assertEqual(set(h.port for h in hints), set([4001]))
 
     def test_get_direct_hints(self):
         # this actually starts the listener
@@ -321,6 +588,18 @@ class Listener(unittest.TestCase):
 
         c._stop_listening()
 
+    def test_rejected(self):
+        c = transit.TransitSender("", timing=DebugTiming())
+        self.successResultOf(c.get_connection_hints())
+        c._listener_f.rejected["idle"] = 2
+        c._stop_listening()
+        # the rejections are noted in the timing data
+        events = [e for e in c._timing._events
+                  if e._name == "transit listener"]
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]._details["rejected"],
+                         {"busy": 0, "idle": 2, "bad-handshake": 0})
+
 
 class DummyProtocol(protocol.Protocol):
     def __init__(self):
@@ -398,6 +677,8 @@ class MockConnection:
         self._d = defer.Deferred(cancel)
         self._start_negotiation_called = False
         self._cancelled = False
+        self.state = "handshake"
+        self.buf = b""  # nothing received yet
 
     def startNegotiation(self):
         self._start_negotiation_called = True
@@ -528,6 +809,72 @@ class InboundConnectionFactory(unittest.TestCase):
         self.assertEqual(p1._cancelled, True)
         self.assertEqual(p2._cancelled, True)
 
+    def _connect(self, f, port):
+        p = f.buildProtocol(address.IPv4Address("TCP", "1.2.3.4", port))
+        if p:
+            f.connectionWasMade(p)
+        return p
+
+    def test_drop_idle(self):
+        f = transit.InboundConnectionFactory("owner")
+        f.protocol = MockConnection
+        f.MAX_PENDING = 2
+        p1 = self._connect(f, 1)
+        p2 = self._connect(f, 2)
+        p2.buf = b"transit"  # p2 has started its handshake
+        # to make room, the oldest silent connection is dropped
+        p3 = self._connect(f, 3)
+        self.assertIsInstance(p3, MockConnection)
+        self.assertEqual(p1._cancelled, True)
+        self.assertEqual(p2._cancelled, False)
+        self.assertEqual(f.rejected, {"busy": 0, "idle": 1,
+                                      "bad-handshake": 0})
+
+    def test_drop_slow(self):
+        f = transit.InboundConnectionFactory("owner")
+        f.protocol = MockConnection
+        f.MAX_PENDING = 2
+        p1 = self._connect(f, 1)
+        p1.buf = b"t"  # a stranger can send part of the handshake, and stop
+        p2 = self._connect(f, 2)
+        p2.buf = b"transit"
+        # nobody is silent, so the oldest one still negotiating is dropped
+        p3 = self._connect(f, 3)
+        self.assertIsInstance(p3, MockConnection)
+        self.assertEqual(p1._cancelled, True)
+        self.assertEqual(p2._cancelled, False)
+        self.assertEqual(f.rejected, {"busy": 0, "idle": 1,
+                                      "bad-handshake": 0})
+
+    def test_busy(self):
+        f = transit.InboundConnectionFactory("owner")
+        f.protocol = MockConnection
+        f.MAX_PENDING = 2
+        p1 = self._connect(f, 1)
+        p1.state = "wait-for-decision"
+        p2 = self._connect(f, 2)
+        p2.state = "wait-for-decision"
+        # both have finished their handshakes, so the new one is turned away
+        self.assertIdentical(self._connect(f, 3), None)
+        self.assertEqual(f.rejected, {"busy": 1, "idle": 0,
+                                      "bad-handshake": 0})
+        # until one of them finishes
+        p1._d.errback(transit.BadHandshake("connection lost"))
+        self.assertIsInstance(self._connect(f, 4), MockConnection)
+        self.assertEqual(p2._cancelled, False)
+        f.whenDone().cancel()
+        self.failureResultOf(f.whenDone(), defer.CancelledError)
+
+    def test_bad_handshake(self):
+        f = transit.InboundConnectionFactory("owner")
+        f.protocol = MockConnection
+        p1 = self._connect(f, 1)
+        p2 = self._connect(f, 2)
+        p1._d.errback(transit.HandshakeMismatch("got 'GET /' want ..."))
+        p2._d.errback(transit.BadHandshake("timeout"))
+        self.assertEqual(f.rejected, {"busy": 0, "idle": 0,
+                                      "bad-handshake": 1})
+
 
 # XXX check descriptions
 
@@ -591,7 +938,8 @@ class Connection(unittest.TestCase):
         self.assertEqual(c.buf, b"")
 
         c.buf = b"unexpected"
-        e = self.assertRaises(transit.BadHandshake, c._check_and_remove, EXP)
+        e = self.assertRaises(transit.HandshakeMismatch, c._check_and_remove,
+                              EXP)
         self.assertEqual(
             str(e), "got %r want %r" % (b'unexpected', b'expectation'))
         self.assertEqual(c.buf, b"unexpected")
@@ -666,6 +1014,70 @@ class Connection(unittest.TestCase):
         f = self.failureResultOf(d, transit.BadHandshake)
         self.assertEqual(str(f.value), "abandoned")
 
+    def test_sender_deciding(self):
+        owner = MockOwner()
+        factory = MockFactory()
+        addr = address.HostnameAddress("example.com", 1234)
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, addr)
+        c.factory = factory
+        c.connectionMade()
+
+        owner._state = "deciding"
+        d = c.startNegotiation()
+        self.assertEqual(t.read_buf(), b"send_this")
+        self.assertIdentical(c.handshake_rtt, None)
+        c.dataReceived(b"expect_this")
+        self.assertEqual(c.state, "deciding")
+        self.assertIsInstance(c.handshake_rtt, float)
+        self.assertEqual(t.read_buf(), b"")
+        self.assertNoResult(d)
+
+        c.select(True)
+        self.assertEqual(t.read_buf(), b"go\n")
+        self.assertEqual(c.state, "records")
+        self.assertEqual(self.successResultOf(d), c)
+        c.select(False)  # ignored
+        self.assertEqual(c.state, "records")
+
+    def test_sender_deciding_nevermind(self):
+        owner = MockOwner()
+        factory = MockFactory()
+        addr = address.HostnameAddress("example.com", 1234)
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, addr)
+        c.factory = factory
+        c.connectionMade()
+
+        owner._state = "deciding"
+        d = c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        self.assertEqual(t.read_buf(), b"send_this")
+        c.select(False)
+        self.assertEqual(t.read_buf(), b"nevermind\n")
+        self.assertEqual(t._connected, False)
+        self.assertEqual(c.state, "hung up")
+        f = self.failureResultOf(d, transit.BadHandshake)
+        self.assertEqual(str(f.value), "abandoned")
+
+    def test_sender_deciding_lost(self):
+        owner = MockOwner()
+        factory = MockFactory()
+        addr = address.HostnameAddress("example.com", 1234)
+        c = transit.Connection(owner, None, None, "description")
+        t = c.transport = FakeTransport(c, addr)
+        c.factory = factory
+        c.connectionMade()
+
+        owner._state = "deciding"
+        d = c.startNegotiation()
+        c.dataReceived(b"expect_this")
+        c.connectionLost()
+        self.assertEqual(c.state, "hung up")
+        self.failureResultOf(d, transit.BadHandshake)
+        c.select(True)  # too late
+        self.assertEqual(t.read_buf(), b"send_this")
+
     def test_handshake_other_error(self):
         owner = MockOwner()
         factory = MockFactory()
@@ -1046,6 +1458,53 @@ class Connection(unittest.TestCase):
         # happens? We currently get a type-check assertion from HKDF because
         # the key is None.
 
+    def test_stream_nonces(self):
+        # in a striped transfer, the stream number is in the top of the nonce
+        t, c, owner = self.make_connection()
+        c.stream = 2
+
+        c.send_record(b"record")
+        encrypted = t.read_buf()[4:]
+        nonce = int(hexlify(encrypted[:SecretBox.NONCE_SIZE]), 16)
+        self.assertEqual(nonce, (2 << transit.STREAM_NONCE_BITS) + 0)
+        c.send_record(b"record")
+        encrypted = t.read_buf()[4:]
+        nonce = int(hexlify(encrypted[:SecretBox.NONCE_SIZE]), 16)
+        self.assertEqual(nonce, (2 << transit.STREAM_NONCE_BITS) + 1)
+
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        send_box = SecretBox(owner._receiver_record_key())
+        nonce_buf = unhexlify("%048x" % (2 << transit.STREAM_NONCE_BITS))
+        encrypted = send_box.encrypt(b"record1", nonce_buf)
+        length = unhexlify("%08x" % len(encrypted))
+        c.dataReceived(length + encrypted)
+        self.assertEqual(inbound_records, [b"record1"])
+
+        # a record from some other stream is rejected
+        nonce_buf = unhexlify("%048x" % ((3 << transit.STREAM_NONCE_BITS) + 1))
+        encrypted = send_box.encrypt(b"record2", nonce_buf)
+        length = unhexlify("%08x" % len(encrypted))
+        self.assertRaises(transit.BadNonce, c.dataReceived, length + encrypted)
+        self.assertEqual(t._connected, False)
+
+    def test_learn_stream(self):
+        # the receiver learns the stream number from the first record
+        t, c, owner = self.make_connection()
+        c.stream = None
+
+        inbound_records = []
+        c.recordReceived = inbound_records.append
+        send_box = SecretBox(owner._receiver_record_key())
+        for i in range(2):
+            nonce_buf = unhexlify("%048x" % (
+                (5 << transit.STREAM_NONCE_BITS) + i))
+            encrypted = send_box.encrypt(b"record%d" % i, nonce_buf)
+            length = unhexlify("%08x" % len(encrypted))
+            c.dataReceived(length + encrypted)
+        self.assertEqual(inbound_records, [b"record0", b"record1"])
+        self.assertEqual(c.stream, 5)
+
     def test_receive_queue(self):
         c = transit.Connection(None, None, None, "description")
         c.transport = FakeTransport(c, None)
@@ -1227,6 +1686,104 @@ class Connection(unittest.TestCase):
         self.assertEqual(c.transport.producer, None)
 
 
+class FakeStream:
+    def __init__(self, name):
+        self.name = name
+        self.sent = []
+        self.received = []
+        self.producer = None
+        self.closed = False
+        self.paused = False
+
+    def describe(self):
+        return self.name
+
+    def send_record(self, record):
+        self.sent.append(record)
+
+    def receive_record(self):
+        return defer.succeed(self.received.pop(0))
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+
+    def close(self):
+        self.closed = True
+
+
+class Striped(unittest.TestCase):
+    def test_send(self):
+        streams = [FakeStream("s%d" % i) for i in range(3)]
+        c = transit.StripedConnection(streams)
+        self.assertEqual(c.describe(), "s0, 3 streams")
+        for i in range(4):
+            c.send_record(b"r%d" % i)
+        c.write(b"r4")
+        self.assertEqual(streams[0].sent, [b"r0", b"r3"])
+        self.assertEqual(streams[1].sent, [b"r1", b"r4"])
+        self.assertEqual(streams[2].sent, [b"r2"])
+
+        # every stream can ask the producer for more
+        p = object()
+        c.registerProducer(p, False)
+        self.assertEqual([s.producer for s in streams], [p, p, p])
+        c.unregisterProducer()
+        self.assertEqual([s.producer for s in streams], [None, None, None])
+
+        # a pull producer that finishes right away isn't left behind
+        def _done(producer, streaming):
+            c.unregisterProducer()
+        streams[0].registerProducer = _done
+        c.registerProducer(p, False)
+        self.assertEqual([s.producer for s in streams], [None, None, None])
+
+        c.pauseProducing()
+        self.assertEqual([s.paused for s in streams], [True, True, True])
+        c.resumeProducing()
+        self.assertEqual([s.paused for s in streams], [False, False, False])
+
+        c.close()
+        self.assertEqual([s.closed for s in streams], [True, True, True])
+
+    def test_receive(self):
+        streams = [FakeStream("s%d" % i) for i in range(2)]
+        streams[0].received = [b"r0", b"r2"]
+        streams[1].received = [b"r1", b"r3"]
+        c = transit.StripedConnection(streams)
+        records = [self.successResultOf(c.receive_record()) for i in range(4)]
+        self.assertEqual(records, [b"r0", b"r1", b"r2", b"r3"])
+
+    def test_writeToFile(self):
+        streams = [FakeStream("s%d" % i) for i in range(2)]
+        streams[0].received = [b"abc", b"ghi"]
+        streams[1].received = [b"def"]
+        c = transit.StripedConnection(streams)
+        f = io.BytesIO()
+        progress = []
+        d = c.writeToFile(f, 9, progress.append)
+        self.assertEqual(self.successResultOf(d), 9)
+        self.assertEqual(f.getvalue(), b"abcdefghi")
+        self.assertEqual(progress, [3, 3, 3])
+
+    def test_stream_records(self):
+        r = transit.build_stream_record(2, 3)
+        self.assertEqual(r, b"stream 2 of 3")
+        self.assertEqual(transit.parse_stream_record(r), (2, 3))
+        for bad in [b"stream 3 of 3", b"stream 0 of 99", b"stream 0",
+                    b"flow 0 of 1"]:
+            self.assertRaises(transit.TransitError,
+                              transit.parse_stream_record, bad)
+
+
 class FileConsumer(unittest.TestCase):
     def test_basic(self):
         f = io.BytesIO()
@@ -1264,6 +1821,11 @@ DIRECT_HINT_JSON = {
     "hostname": "direct",
     "port": 1234
 }
+DIRECT_HINT_JSON2 = {
+    "type": "direct-tcp-v1",
+    "hostname": "direct2",
+    "port": 1234
+}
 RELAY_HINT_JSON = {
     "type": "relay-v1",
     "hints": [{
@@ -1508,6 +2070,243 @@ class Transit(unittest.TestCase):
             self._waiters[0].callback("winner")
             self.assertEqual(self.successResultOf(d), "winner")
 
+    @inlineCallbacks
+    def test_fast_failover(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([DIRECT_HINT_JSON, DIRECT_HINT_JSON2,
+                                RELAY_HINT_JSON])
+        s._start_connector = self._start_connector
+
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+            self.assertEqual(sorted(self._connectors), ["direct", "direct2"])
+
+            # one unreachable direct hint is not enough to give up on the
+            # other one
+            self._waiters[0].errback(error.ConnectionRefusedError())
+            clock.advance(0)
+            self.assertEqual(len(self._connectors), 2)
+
+            # but once they're all dead, the relay is started right away,
+            # without waiting for RELAY_DELAY
+            self._waiters[1].errback(error.ConnectionRefusedError())
+            self.assertEqual(len(self._connectors), 2)
+            clock.advance(0)
+            self.assertEqual(self._connectors[2:], ["relay"])
+
+            self._waiters[2].callback("winner")
+            self.assertEqual(self.successResultOf(d), "winner")
+
+            # and nothing else is started later
+            clock.advance(s.RELAY_DELAY * 2)
+            self.assertEqual(len(self._connectors), 3)
+            self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_happy_eyeballs(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([
+            {"type": "direct-tcp-v1", "hostname": "10.0.0.1", "port": 1234},
+            {"type": "direct-tcp-v1", "hostname": "10.0.0.2", "port": 1234},
+            {"type": "direct-tcp-v1", "hostname": "2001:db8::1",
+             "port": 1234},
+        ])
+        s._start_connector = self._start_connector
+
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+            # IPv6 goes first, then they alternate, ATTEMPT_DELAY apart
+            self.assertEqual(self._connectors, ["2001:db8::1"])
+            clock.advance(s.ATTEMPT_DELAY)
+            self.assertEqual(self._connectors, ["2001:db8::1", "10.0.0.1"])
+            # a failure moves on to the next one right away
+            self._waiters[1].errback(error.ConnectionRefusedError())
+            clock.advance(0)
+            self.assertEqual(self._connectors,
+                             ["2001:db8::1", "10.0.0.1", "10.0.0.2"])
+
+            self._waiters[0].callback("winner")
+            self.assertEqual(self.successResultOf(d), "winner")
+            self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_happy_eyeballs_cancel(self):
+        # attempts that are still waiting for their turn are dropped when
+        # another one wins
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([
+            {"type": "direct-tcp-v1", "hostname": "2001:db8::1",
+             "port": 1234},
+            {"type": "direct-tcp-v1", "hostname": "10.0.0.1", "port": 1234},
+        ])
+        s._start_connector = self._start_connector
+
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+            self.assertEqual(self._connectors, ["2001:db8::1"])
+            self._waiters[0].callback("winner")
+            self.assertEqual(self.successResultOf(d), "winner")
+            clock.advance(s.ATTEMPT_DELAY)
+            self.assertEqual(self._connectors, ["2001:db8::1"])
+            self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_fast_failover_priorities(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([{
+            "type": "relay-v1",
+            "hints": [{
+                "type": "direct-tcp-v1",
+                "priority": 3.0,
+                "hostname": "relay3",
+                "port": 1234
+            }, {
+                "type": "direct-tcp-v1",
+                "priority": 2.0,
+                "hostname": "relay2",
+                "port": 1234
+            }]
+        }])
+        s._start_connector = self._start_connector
+
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+            clock.advance(0)
+            self.assertEqual(self._connectors, ["relay3"])
+
+            # the preferred relay is down, so cut over to the next one
+            self._waiters[0].errback(error.ConnectionRefusedError())
+            clock.advance(0)
+            self.assertEqual(self._connectors, ["relay3", "relay2"])
+
+            self._waiters[1].callback("winner")
+            self.assertEqual(self.successResultOf(d), "winner")
+
+    @inlineCallbacks
+    def test_no_failover_when_hanging(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([DIRECT_HINT_JSON, RELAY_HINT_JSON])
+        s._start_connector = self._start_connector
+
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+            self.assertEqual(self._connectors, ["direct"])
+
+            # a direct hint that doesn't answer holds the relay back for
+            # RELAY_DELAY, as before
+            clock.advance(s.RELAY_DELAY - 0.5)
+            self.assertEqual(self._connectors, ["direct"])
+            clock.advance(1.0)
+            self.assertEqual(self._connectors, ["direct", "relay"])
+
+            self._waiters[1].callback("winner")
+            self.assertEqual(self.successResultOf(d), "winner")
+            self.assertEqual(clock.getDelayedCalls(), [])
+
+    @inlineCallbacks
+    def test_late_hints(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        # the receiver sends its relay hints first, and says that more
+        # hints are coming
+        s.add_connection_hints([RELAY_HINT_JSON], more=True)
+        s._start_connector = self._start_connector
+
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+            # so the relay waits, as if there were direct hints
+            clock.advance(0)
+            self.assertEqual(self._connectors, [])
+
+            # the direct hints join the race as soon as they arrive
+            s.add_connection_hints([DIRECT_HINT_JSON])
+            self.assertEqual(self._connectors, ["direct"])
+            clock.advance(s.RELAY_DELAY)
+            self.assertEqual(self._connectors, ["direct", "relay"])
+
+            # hints we already know about don't start anything
+            s.add_connection_hints([RELAY_HINT_JSON])
+            self.assertEqual(self._connectors, ["direct", "relay"])
+
+            self._waiters[0].callback("winner")
+            self.assertEqual(self.successResultOf(d), "winner")
+            self.assertEqual(clock.getDelayedCalls(), [])
+
+            # hints that arrive after the race are just remembered
+            s.add_connection_hints([DIRECT_HINT_JSON2])
+            self.assertEqual(len(self._connectors), 2)
+
+    @inlineCallbacks
+    def test_late_hints_none(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([RELAY_HINT_JSON], more=True)
+        s._start_connector = self._start_connector
+
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+            clock.advance(0)
+            self.assertEqual(self._connectors, [])
+            # the last message has no usable hints, so stop waiting
+            s.add_connection_hints([], more=False)
+            clock.advance(0)
+            self.assertEqual(self._connectors, ["relay"])
+
+            self._waiters[0].callback("winner")
+            self.assertEqual(self.successResultOf(d), "winner")
+
+    @inlineCallbacks
+    def test_late_listener(self):
+        clock = task.Clock()
+        s = transit.TransitReceiver("", reactor=clock)
+        s.set_transit_key(b"key")
+        s.add_connection_hints([DIRECT_HINT_JSON])
+        s._start_connector = self._start_connector
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+        # we start listening after we started connecting, and the listener
+        # joins the race
+        hints = yield s.get_direct_connection_hints()
+        self.assertNotEqual(hints, [])
+        highlander, _ = s._race
+        self.assertIn(s._listener_d, highlander._remaining)
+        d.cancel()
+        self.failureResultOf(d, defer.CancelledError)
+
     @inlineCallbacks
     def test_no_contenders(self):
         clock = task.Clock()
@@ -1524,6 +2323,25 @@ class Transit(unittest.TestCase):
             f = self.failureResultOf(d, transit.TransitError)
             self.assertEqual(str(f.value), "No contenders for connection")
 
+    @inlineCallbacks
+    def test_no_contenders_yet(self):
+        clock = task.Clock()
+        s = transit.TransitSender("", reactor=clock, no_listen=True)
+        s.set_transit_key(b"key")
+        hints = yield s.get_connection_hints()
+        del hints
+        s.add_connection_hints([], more=True)  # more on the way
+        s._start_connector = self._start_connector
+
+        with mock.patch("wormhole.transit.endpoint_from_hint_obj",
+                        self._endpoint_from_hint_obj):
+            d = s.connect()
+            self.assertNoResult(d)
+            # and then they turn out to be empty too
+            s.add_connection_hints([])
+            f = self.failureResultOf(d, transit.TransitError)
+            self.assertEqual(str(f.value), "No contenders for connection")
+
 
 class RelayHandshake(unittest.TestCase):
     def old_build_relay_handshake(self, key):
@@ -1619,3 +2437,138 @@ class Full(ServerBase, unittest.TestCase):
 
         yield x.close()
         yield y.close()
+
+    @inlineCallbacks
+    def striped(self, s, r):
+        KEY = b"k" * 32
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x, y) = yield self.doBoth(s.connect(), r.connect())
+        self.assertIsInstance(x, transit.StripedConnection)
+        self.assertIsInstance(y, transit.StripedConnection)
+        self.assertEqual(x.describe()[-9:], "3 streams")
+
+        d = y.receive_record()
+        for i in range(7):
+            x.send_record(b"record%d" % i)
+        records = [(yield d)]
+        for i in range(6):
+            records.append((yield y.receive_record()))
+        self.assertEqual(records, [b"record%d" % i for i in range(7)])
+
+        # and the receiver's ack comes back on the first stream
+        y.send_record(b"ack")
+        ack = yield x.receive_record()
+        self.assertEqual(ack, b"ack")
+
+        yield x.close()
+        yield y.close()
+
+    def test_direct_striped(self):
+        # only the sender listens, so there is just one way to win, and the
+        # receiver makes the other streams
+        s = transit.TransitSender(None, streams=3)
+        r = transit.TransitReceiver(None, no_listen=True, streams=3)
+        return self.striped(s, r)
+
+    @inlineCallbacks
+    def test_striped_lost_stream(self):
+        # if one of the extra streams never reaches the receiver, both
+        # sides fall back to the first one instead of waiting for it
+        s = transit.TransitSender(None, streams=3)
+        r = transit.TransitReceiver(None, no_listen=True, streams=3)
+        r.STREAMS_WAIT = 0.1
+        add_stream = r._add_stream
+        lost = []
+
+        def _add_stream(p):
+            if not lost:
+                lost.append(p)
+                return
+            add_stream(p)
+        r._add_stream = _add_stream
+        KEY = b"k" * 32
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        s.add_connection_hints((yield r.get_connection_hints()))
+        r.add_connection_hints((yield s.get_connection_hints()))
+
+        (x, y) = yield self.doBoth(s.connect(), r.connect())
+        lost[0].close()
+        self.assertIsInstance(x, transit.Connection)
+        self.assertIsInstance(y, transit.Connection)
+        self.assertEqual(y.stream, 0)
+
+        d = y.receive_record()
+        for i in range(3):
+            x.send_record(b"record%d" % i)
+        records = [(yield d)]
+        for i in range(2):
+            records.append((yield y.receive_record()))
+        self.assertEqual(records, [b"record%d" % i for i in range(3)])
+        y.send_record(b"ack")
+        ack = yield x.receive_record()
+        self.assertEqual(ack, b"ack")
+
+        yield x.close()
+        yield y.close()
+
+    def test_relay_striped(self):
+        s = transit.TransitSender(self.transit, no_listen=True, streams=3)
+        r = transit.TransitReceiver(self.transit, no_listen=True, streams=3)
+        return self.striped(s, r)
+
+    @inlineCallbacks
+    def test_striped_fewer(self):
+        # the receiver only wants two streams
+        s = transit.TransitSender(self.transit, no_listen=True, streams=3)
+        r = transit.TransitReceiver(self.transit, no_listen=True, streams=2)
+        s.set_streams(2)
+        KEY = b"k" * 32
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        s.add_connection_hints((yield r.get_connection_hints()))
+        r.add_connection_hints((yield s.get_connection_hints()))
+
+        (x, y) = yield self.doBoth(s.connect(), r.connect())
+        self.assertEqual(x.describe()[-9:], "2 streams")
+        self.assertEqual(y.describe()[-9:], "2 streams")
+        yield x.close()
+        yield y.close()
+
+    @inlineCallbacks
+    def test_unix(self):
+        KEY = b"k" * 32
+        s = transit.TransitSender(None)
+        r = transit.TransitReceiver(None)
+        s.set_transit_key(KEY)
+        r.set_transit_key(KEY)
+        r.add_connection_abilities(s.get_connection_abilities())
+
+        shints = yield s.get_connection_hints()
+        rhints = yield r.get_connection_hints()
+
+        s.add_connection_hints(rhints)
+        r.add_connection_hints(shints)
+
+        (x, y) = yield self.doBoth(s.connect(), r.connect())
+        # the sender prefers the Unix socket over TCP
+        self.assertTrue(x.describe().startswith("->unix:"), x.describe())
+
+        d = y.receive_record()
+        x.send_record(b"record1")
+        r = yield d
+        self.assertEqual(r, b"record1")
+
+        yield x.close()
+        yield y.close()
+
+    if not interfaces.IReactorUNIX.providedBy(reactor):
+        test_unix.skip = "no Unix sockets here"
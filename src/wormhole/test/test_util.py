@@ -1,5 +1,7 @@
 from __future__ import unicode_literals
 
+import hashlib
+import json
 import unicodedata
 
 import six
@@ -7,7 +9,7 @@ from twisted.trial import unittest
 
 import mock
 
-from .. import util
+from .. import _json, util
 
 
 class Utils(unittest.TestCase):
@@ -34,6 +36,17 @@ class Utils(unittest.TestCase):
         self.assertIsInstance(b, type(b""))
         self.assertEqual(b, b"\x00\x45\x91\xfe\xff")
 
+    def test_bytes_to_b64str(self):
+        b = b"\x00\x45\x91\xfe\xff"
+        b64str = util.bytes_to_b64str(b)
+        self.assertIsInstance(b64str, type(""))
+        self.assertEqual(b64str, "AEWR/v8=")
+
+    def test_b64str_to_bytes(self):
+        b = util.b64str_to_bytes("AEWR/v8=")
+        self.assertIsInstance(b, type(b""))
+        self.assertEqual(b, b"\x00\x45\x91\xfe\xff")
+
     def test_dict_to_bytes(self):
         d = {"a": "b"}
         b = util.dict_to_bytes(d)
@@ -47,6 +60,54 @@ class Utils(unittest.TestCase):
         self.assertEqual(d, {"a": "b", "c": 2})
 
 
+class JSONCodecs(unittest.TestCase):
+    def setUp(self):
+        self.addCleanup(_json.use_codec)
+
+    def test_identical(self):
+        # every codec we'd use must give the same bytes and dicts as the
+        # stdlib json module
+        d = {"type": "add", "phase": "pake", "body": "ab/cd\u00e9",
+             "n": [1, 2.5, None, True], "big": 2 ** 70, "tiny": 1e-7,
+             "t": (1.5e-7, ("x", 2.5e-8))}
+        for name in _json.available_codecs():
+            _json.use_codec(name)
+            b = util.dict_to_bytes(d)
+            self.assertEqual(b, json.dumps(d).encode("utf-8"), name)
+            self.assertEqual(util.bytes_to_dict(b), json.loads(b), name)
+            self.assertEqual(util.bytes_to_dict(b'{"x": NaN, "y": 1}')["y"],
+                             1, name)
+            with self.assertRaises(ValueError):
+                util.bytes_to_dict(b'{"x": ')
+
+    def test_use_codec(self):
+        _json.use_codec("json")
+        self.assertEqual((_json.encoder_name, _json.decoder_name),
+                         ("json", "json"))
+        with self.assertRaises(ValueError):
+            _json.use_codec("nope")
+        _json.use_codec()
+        self.assertEqual(_json.decoder_name, _json.available_codecs()[-1])
+
+
+class Hashing(unittest.TestCase):
+    def test_sha256_file(self):
+        fn = self.mktemp()
+        with open(fn, "wb") as f:
+            f.write(b"data" * 100000)
+        self.assertEqual(util.sha256_file(fn),
+                         hashlib.sha256(b"data" * 100000).hexdigest())
+
+    def test_sha256_tree(self):
+        a = ("a", hashlib.sha256(b"a").hexdigest())
+        b = ("sub/b", hashlib.sha256(b"b").hexdigest())
+        # order-independent, but sensitive to names and contents
+        self.assertEqual(util.sha256_tree([a, b]), util.sha256_tree([b, a]))
+        self.assertNotEqual(util.sha256_tree([a, b]), util.sha256_tree([a]))
+        self.assertNotEqual(util.sha256_tree([a]),
+                            util.sha256_tree([("c", a[1])]))
+
+
 class Space(unittest.TestCase):
     def test_free_space(self):
         free = util.estimate_free_space(".")
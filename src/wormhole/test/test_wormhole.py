@@ -1,6 +1,7 @@
 from __future__ import print_function, unicode_literals
 
 import io
+import json
 import re
 
 from twisted.internet import reactor
@@ -12,11 +13,13 @@ import mock
 
 from .. import _rendezvous, wormhole
 from ..errors import (KeyFormatError, LonelyError, NoKeyError,
-                      OnlyOneCodeError, ServerConnectionError, WormholeClosed,
+                      NotSerializableError, OnlyOneCodeError,
+                      ServerConnectionError, WormholeClosed,
                       WrongPasswordError)
 from ..eventual import EventualQueue
 from ..transit import allocate_tcp_port
-from .common import ServerBase, poll_until
+from .common import (Base64WebSocketServer, BatchWebSocketServer,
+                     DeltaListWebSocketServer, ServerBase, poll_until)
 
 APPID = "appid"
 
@@ -116,6 +119,70 @@ class Delegated(ServerBase, unittest.TestCase):
         yield poll_until(lambda: dg.code is not None)
         w1.close()
 
+    @inlineCallbacks
+    def test_serialize(self):
+        dg = Delegate()
+        w1 = wormhole.create(APPID, self.relayurl, reactor, delegate=dg)
+        with self.assertRaises(NotSerializableError):
+            w1.serialize()  # no code yet
+        w1.set_code("1-abc")
+        w2 = wormhole.create(APPID, self.relayurl, reactor)
+        w2.set_code(dg.code)
+        yield poll_until(lambda: dg.verifier is not None)
+        w1.send_message(b"ping")
+        got = yield w2.get_message()
+        self.assertEqual(got, b"ping")
+        key1 = w1.derive_key("purpose", 16)
+
+        # pretend w1's process is replaced: save it, drop its connection,
+        # and build a new one from the saved state
+        data = json.loads(json.dumps(w1.serialize()))
+        yield w1._boss._RC._connector.stopService()
+        dg2 = Delegate()
+        w1b = wormhole.from_serialized(data, reactor, dg2)
+        self.assertEqual(w1b.derive_key("purpose", 16), key1)
+
+        w2.send_message(b"pong")
+        yield poll_until(lambda: dg2.messages)
+        self.assertEqual(dg2.messages, [b"pong"])
+        w1b.send_message(b"ping2")
+        got = yield w2.get_message()
+        self.assertEqual(got, b"ping2")
+
+        w1b.close()
+        yield poll_until(lambda: dg2.closed is not None)
+        self.assertEqual(dg2.closed, "happy")
+        yield w2.close()
+
+    @inlineCallbacks
+    def test_serialize_lonely(self):
+        # restore in the middle of the PAKE exchange, before the other side
+        # has even shown up
+        dg = Delegate()
+        w1 = wormhole.create(APPID, self.relayurl, reactor, delegate=dg)
+        w1.set_code("1-abc")
+        w1.send_message(b"queued")
+        yield poll_until(lambda: w1._boss._M._pending_outbound == {})
+        data = json.loads(json.dumps(w1.serialize()))
+        yield w1._boss._RC._connector.stopService()
+        dg2 = Delegate()
+        w1b = wormhole.from_serialized(data, reactor, dg2)
+
+        w2 = wormhole.create(APPID, self.relayurl, reactor)
+        w2.set_code("1-abc")
+        got = yield w2.get_message()
+        self.assertEqual(got, b"queued")
+        yield poll_until(lambda: dg2.verifier is not None)
+        w2.send_message(b"reply")
+        yield poll_until(lambda: dg2.messages)
+        self.assertEqual(dg2.messages, [b"reply"])
+        self.assertEqual(w1b.derive_key("purpose", 16),
+                         w2.derive_key("purpose", 16))
+
+        w1b.close()
+        yield poll_until(lambda: dg2.closed is not None)
+        yield w2.close()
+
 
 class Wormholes(ServerBase, unittest.TestCase):
     # integration test, with a real server
@@ -138,6 +205,74 @@ class Wormholes(ServerBase, unittest.TestCase):
         # w.close() fails because we closed before connecting
         yield self.assertFailure(w1.close(), LonelyError)
 
+    @inlineCallbacks
+    def test_replicas(self):
+        # one replica is down, so w1 uses the other. Both of w2's answer,
+        # and it uses whichever welcomes it first.
+        down = "ws://127.0.0.1:%d/v1" % allocate_tcp_port()
+        w1 = wormhole.create(APPID, down + "," + self.relayurl, reactor)
+        w2 = wormhole.create(APPID, self.relayurl + "," + self.relayurl,
+                             reactor)
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w2.set_code(code)
+        w1.send_message(b"data1")
+        w2.send_message(b"data2")
+        dataX = yield w1.get_message()
+        dataY = yield w2.get_message()
+        self.assertEqual(dataX, b"data2")
+        self.assertEqual(dataY, b"data1")
+        yield w1.close()
+        yield w2.close()
+
+    @inlineCallbacks
+    def test_pool(self):
+        # this server can't share a connection, so w1 keeps the pool's
+        # connection and w2 gets one of its own
+        pool = _rendezvous.RendezvousPool()
+        w1 = wormhole.create(APPID, self.relayurl, reactor,
+                             rendezvous_pool=pool)
+        w2 = wormhole.create(APPID, self.relayurl, reactor,
+                             rendezvous_pool=pool)
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w2.set_code(code)
+        w1.send_message(b"data1")
+        w2.send_message(b"data2")
+        dataX = yield w1.get_message()
+        dataY = yield w2.get_message()
+        self.assertEqual(dataX, b"data2")
+        self.assertEqual(dataY, b"data1")
+        connector1 = w1._boss._RC._connector
+        connector2 = w2._boss._RC._connector
+        self.assertIs(connector1._solo, None)
+        self.assertIsNot(connector2._solo, None)
+        yield w1.close()
+        yield w2.close()
+        self.assertEqual(pool._connections, {})
+
+    @inlineCallbacks
+    def test_chunks(self):
+        w1 = wormhole.create(APPID, self.relayurl, reactor)
+        w2 = wormhole.create(APPID, self.relayurl, reactor)
+        w1._boss.CHUNK_SIZE = 1000
+        w1._boss._S.send = mock.Mock(wraps=w1._boss._S.send)
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w2.set_code(code)
+        big = bytes(bytearray(range(256))) * 20
+        w1.send_message(big)
+        w1.send_message(b"data1")
+        dataX = yield w2.get_message()
+        dataY = yield w2.get_message()
+        self.assertEqual(dataX, big)
+        self.assertEqual(dataY, b"data1")
+        phases = [c[1][0] for c in w1._boss._S.send.mock_calls]
+        self.assertEqual(phases, ["1", "0.0/6", "0.1/6", "0.2/6", "0.3/6",
+                                  "0.4/6", "0.5/6"])
+        yield w1.close()
+        yield w2.close()
+
     @inlineCallbacks
     def test_allocate_more_words(self):
         w1 = wormhole.create(APPID, self.relayurl, reactor)
@@ -590,6 +725,92 @@ class MessageDoubler(_rendezvous.RendezvousConnector):
         _rendezvous.RendezvousConnector._response_handle_message(self, msg)
 
 
+class Base64Bodies(ServerBase, unittest.TestCase):
+    websocket_protocol = Base64WebSocketServer
+
+    @inlineCallbacks
+    def test_interop(self):
+        # w1 sends and receives base64 bodies, w2 (like an older client)
+        # sticks with hex, and they can still talk through the same server
+        w1 = wormhole.create(APPID, self.relayurl, reactor)
+        w2 = wormhole.create(APPID, self.relayurl, reactor)
+        w2._boss._RC.BODY_ENCODINGS = []
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w2.set_code(code)
+        w1.send_message(b"data1")
+        w2.send_message(b"data2")
+        dataX = yield w1.get_message()
+        dataY = yield w2.get_message()
+        self.assertEqual(dataX, b"data2")
+        self.assertEqual(dataY, b"data1")
+        self.assertTrue(w1._boss._RC._base64)
+        self.assertFalse(w2._boss._RC._base64)
+        yield w1.close()
+        yield w2.close()
+
+
+class Batches(ServerBase, unittest.TestCase):
+    websocket_protocol = BatchWebSocketServer
+
+    @inlineCallbacks
+    def test_burst(self):
+        w1 = wormhole.create(APPID, self.relayurl, reactor)
+        w2 = wormhole.create(APPID, self.relayurl, reactor)
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w2.set_code(code)
+        w2.send_message(b"data0")
+        yield w1.get_message()
+        rc = w1._boss._RC
+        rc._tx = mock.Mock(wraps=rc._tx)
+        w1.send_message(b"data1")
+        w1.send_message(b"data2")
+        w1.send_message(b"data3")
+        for expected in [b"data1", b"data2", b"data3"]:
+            data = yield w2.get_message()
+            self.assertEqual(data, expected)
+        self.assertEqual([c[1][0] for c in rc._tx.mock_calls], ["batch"])
+        yield w1.close()
+        yield w2.close()
+
+
+class ListDeltas(ServerBase, unittest.TestCase):
+    websocket_protocol = DeltaListWebSocketServer
+
+    @inlineCallbacks
+    def test_completion(self):
+        w1 = wormhole.create(APPID, self.relayurl, reactor)
+        w1.set_code("1-purple-elephant")
+        yield poll_until(lambda: w1._boss._N._nameplate == "1" and
+                         w1._boss._M._mailbox is not None)
+        w2 = wormhole.create(APPID, self.relayurl, reactor)
+        w2._boss._L.CACHE_TTL = 0  # ask the server every time
+        rc = w2._boss._RC
+        rc._tx = mock.Mock(wraps=rc._tx)
+        h = w2.input_code()
+        yield poll_until(lambda: h.get_nameplate_completions("") == {"1-"})
+
+        w3 = wormhole.create(APPID, self.relayurl, reactor)
+        w3.set_code("2-purple-elephant")
+        yield poll_until(lambda: w3._boss._M._mailbox is not None)
+        h.refresh_nameplates()
+        yield poll_until(
+            lambda: h.get_nameplate_completions("") == {"1-", "2-"})
+        lists = [c[2] for c in rc._tx.mock_calls if c[1][0] == "list"]
+        self.assertEqual(lists[0], {})
+        self.assertEqual(lists[-1], {"since": "0"})
+
+        h.choose_nameplate("1")
+        h.choose_words("purple-elephant")
+        w1.send_message(b"data")
+        data = yield w2.get_message()
+        self.assertEqual(data, b"data")
+        yield w1.close()
+        yield w2.close()
+        yield self.assertFailure(w3.close(), LonelyError)
+
+
 class Errors(ServerBase, unittest.TestCase):
     @inlineCallbacks
     def test_derive_key_early(self):
@@ -666,6 +887,39 @@ class Reconnection(ServerBase, unittest.TestCase):
         c2 = yield w2.close()
         self.assertEqual(c2, "happy")
 
+    @inlineCallbacks
+    def test_replicas(self):
+        # when the mailbox server we're using drops us, we fail over to
+        # another replica
+        replica = self.relayurl.replace("127.0.0.1", "localhost")
+        w1 = wormhole.create(APPID, self.relayurl + "," + replica, reactor)
+        w1_in = []
+        w1._boss._RC._debug_record_inbound_f = w1_in.append
+        w1.allocate_code()
+        code = yield w1.get_code()
+        w1.send_message(b"data1")
+
+        def seen_our_pake():
+            for m in w1_in:
+                if m["type"] == "message" and m["phase"] == "pake":
+                    return True
+            return False
+
+        yield poll_until(seen_our_pake)
+        first = w1._boss._RC._ws.factory.url
+        w1_in[:] = []
+        w1._boss._RC._ws.transport.loseConnection()
+        yield poll_until(seen_our_pake)
+        self.assertNotEqual(w1._boss._RC._ws.factory.url, first)
+
+        w2 = wormhole.create(APPID, self.relayurl, reactor)
+        w2.set_code(code)
+        dataY = yield w2.get_message()
+        self.assertEqual(dataY, b"data1")
+        c1 = yield w1.close()
+        self.assertEqual(c1, "happy")
+        yield w2.close()
+
 
 class InitialFailure(unittest.TestCase):
     @inlineCallbacks
@@ -717,6 +971,14 @@ class InitialFailure(unittest.TestCase):
         yield self.assertSCE(d4, ConnectionRefusedError)
         yield self.assertSCE(d5, ConnectionRefusedError)
 
+    @inlineCallbacks
+    def test_no_replica_connection(self):
+        # none of the replicas will connect
+        urls = ",".join("ws://127.0.0.1:%d/v1" % allocate_tcp_port()
+                        for i in range(2))
+        w = wormhole.create(APPID, urls, reactor)
+        yield self.assertSCE(w.get_code(), ConnectionRefusedError)
+
     @inlineCallbacks
     def test_all_deferreds(self):
         # point at a URL that will never connect
@@ -2,6 +2,7 @@ from __future__ import absolute_import, print_function, unicode_literals
 
 import json
 import time
+from collections import deque
 
 from zope.interface import implementer
 
@@ -41,10 +42,38 @@ class Event:
             self.finish()
 
 
+class _NullEvent:
+    def detail(self, **details):
+        pass
+
+    def finish(self, when=None, **details):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_tb):
+        pass
+
+
+@implementer(ITiming)
+class NullTiming:
+    # records nothing: this is what you get unless you ask for timing data
+    enabled = False
+    _event = _NullEvent()
+
+    def add(self, name, when=None, **details):
+        return self._event
+
+
 @implementer(ITiming)
 class DebugTiming:
-    def __init__(self):
-        self._events = []
+    enabled = True
+
+    def __init__(self, max_events=100000):
+        # only the most recent events are kept, so a long-lived wormhole
+        # doesn't grow without bound
+        self._events = deque(maxlen=max_events)
 
     def add(self, name, when=None, **details):
         ev = Event(name, when, **details)
@@ -8,7 +8,7 @@ from twisted.internet.endpoints import clientFromString
 from zope.interface.declarations import directlyProvides
 
 from . import _interfaces, errors
-from .timing import DebugTiming
+from .timing import NullTiming
 
 try:
     import txtorcon
@@ -76,7 +76,7 @@ def get_tor(reactor,
     assert tor_control_port != ""
     if launch_tor and tor_control_port is not None:
         raise ValueError("cannot combine --launch-tor and --tor-control-port=")
-    timing = timing or DebugTiming()
+    timing = timing or NullTiming()
 
     # Connect to an existing Tor, or create a new one. If we need to
     # launch an onion service, then we need a working control port (and
@@ -2,16 +2,18 @@
 from __future__ import absolute_import, print_function
 
 import os
+import shutil
 import socket
 import sys
+import tempfile
 import time
 from binascii import hexlify, unhexlify
-from collections import deque
+from collections import OrderedDict, deque
 
 import six
 from nacl.secret import SecretBox
 from twisted.internet import (address, defer, endpoints, error, interfaces,
-                              protocol, reactor, task)
+                              protocol, reactor)
 from twisted.internet.defer import inlineCallbacks, returnValue
 from twisted.protocols import policies
 from twisted.python import log
@@ -20,11 +22,12 @@ from zope.interface import implementer
 
 from . import ipaddrs
 from .errors import InternalError
-from .timing import DebugTiming
+from .timing import NullTiming
 from .util import bytes_to_hexstr, HKDF
-from ._hints import (DirectTCPV1Hint, RelayV1Hint,
+from ._hints import (DirectTCPV1Hint, RelayV1Hint, UnixV1Hint,
                      parse_hint_argv, describe_hint_obj, endpoint_from_hint_obj,
-                     parse_tcp_v1_hint)
+                     parse_tcp_v1_hint, parse_unix_v1_hint, encode_hint,
+                     is_ipv6_hint, happy_eyeballs_order)
 
 
 class TransitError(Exception):
@@ -35,6 +38,11 @@ class BadHandshake(Exception):
     pass
 
 
+class HandshakeMismatch(BadHandshake):
+    # the other end said something other than what we expected
+    pass
+
+
 class TransitClosed(TransitError):
     pass
 
@@ -95,6 +103,13 @@ def build_sided_relay_handshake(key, side):
 
 TIMEOUT = 60  # seconds
 
+# In a striped transfer, the top 32 bits of each record's nonce hold the
+# index of the stream (connection) it was sent on, and the rest count the
+# records sent on that stream. Stream 0 uses the same nonces as a plain
+# (unstriped) Connection.
+STREAM_NONCE_BITS = 8 * 20
+MAX_STREAMS = 16
+
 
 @implementer(interfaces.IProducer, interfaces.IConsumer)
 class Connection(protocol.Protocol, policies.TimeoutMixin):
@@ -113,6 +128,9 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         self._consumer_deferred = None
         self._inbound_records = deque()
         self._waiting_reads = deque()
+        self._handshake_sent = None
+        self.handshake_rtt = None
+        self.stream = 0  # None means "learn it from the first record"
 
     def connectionMade(self):
         self.setTimeout(TIMEOUT)  # does timeoutConnection() when it expires
@@ -151,7 +169,7 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     def _check_and_remove(self, expected):
         # any divergence is a handshake error
         if not self.buf.startswith(expected[:len(self.buf)]):
-            raise BadHandshake("got %r want %r" % (self.buf, expected))
+            raise HandshakeMismatch("got %r want %r" % (self.buf, expected))
         if len(self.buf) < len(expected):
             return False  # keep waiting
         self.buf = self.buf[len(expected):]
@@ -173,18 +191,23 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             self.state = "start"
         if self.state == "start":
             self.transport.write(self.owner._send_this())
+            self._handshake_sent = time.time()
             self.state = "handshake"
         if self.state == "handshake":
             if not self._check_and_remove(self.owner._expect_this()):
                 return
+            self.handshake_rtt = time.time() - self._handshake_sent
             self.state = self.owner.connection_ready(self)
             # If we're the receiver, we'll be moved to state
             # "wait-for-decision", which means we're waiting for the other
             # side (the sender) to make a decision. If we're the sender,
             # we'll either be moved to state "go" (send GO and move directly
-            # to state "records") or state "nevermind" (send NEVERMIND and
-            # hang up).
+            # to state "records"), state "nevermind" (send NEVERMIND and
+            # hang up), or state "deciding" (wait for select() to tell us
+            # which of those two it will be).
 
+        if self.state == "deciding":
+            return
         if self.state == "wait-for-decision":
             if not self._check_and_remove(b"go\n"):
                 return
@@ -204,6 +227,13 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             raise self.state
         raise ValueError("internal error: unknown state %s" % (self.state, ))
 
+    def select(self, won):
+        # the sender calls this to end the "deciding" state
+        if self.state != "deciding":
+            return  # we were cancelled or lost the connection meanwhile
+        self.state = "go" if won else "nevermind"
+        self.dataReceived(b"")
+
     def _negotiationSuccessful(self):
         self.state = "records"
         self.setTimeout(None)
@@ -231,10 +261,13 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
     def _decrypt_record(self, encrypted):
         nonce_buf = encrypted[:SecretBox.NONCE_SIZE]  # assume it's prepended
         nonce = int(hexlify(nonce_buf), 16)
-        if nonce != self.next_receive_nonce:
+        if self.stream is None:
+            self.stream = nonce >> STREAM_NONCE_BITS
+        expected = (self.stream << STREAM_NONCE_BITS) + self.next_receive_nonce
+        if nonce != expected:
             raise BadNonce(
                 "received out-of-order record: got %d, expected %d" %
-                (nonce, self.next_receive_nonce))
+                (nonce, expected))
         self.next_receive_nonce += 1
         record = self.receive_box.decrypt(encrypted)
         return record
@@ -246,9 +279,10 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         if not isinstance(record, type(b"")):
             raise InternalError
         assert SecretBox.NONCE_SIZE == 24
-        assert self.send_nonce < 2**(8 * 24)
+        assert self.send_nonce < 2**STREAM_NONCE_BITS
         assert len(record) < 2**(8 * 4)
-        nonce = unhexlify("%048x" % self.send_nonce)  # big-endian
+        nonce = unhexlify("%048x" % ((self.stream << STREAM_NONCE_BITS) +
+                                     self.send_nonce))  # big-endian
         self.send_nonce += 1
         encrypted = self.send_box.encrypt(record, nonce)
         length = unhexlify("%08x" % len(encrypted))  # always 4 bytes long
@@ -286,6 +320,8 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
 
     def connectionLost(self, reason=None):
         self.setTimeout(None)
+        if self.state == "deciding":
+            self.state = "hung up"  # don't let select() pick us
         d, self._negotiation_d = self._negotiation_d, None
         # the Deferred is only relevant until negotiation finishes, so skip
         # this if it's already been fired
@@ -304,6 +340,9 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
             d.errback(self._error or BadHandshake("connection lost"))
         if self._consumer_deferred:
             self._consumer_deferred.errback(error.ConnectionClosed())
+        while self._waiting_reads:
+            d = self._waiting_reads.popleft()
+            d.errback(error.ConnectionClosed())
 
     # IConsumer methods, for outbound flow-control. We pass these through to
     # the transport. The 'producer' is something like a t.p.basic.FileSender
@@ -402,6 +441,104 @@ class Connection(protocol.Protocol, policies.TimeoutMixin):
         return self.connectConsumer(fc, expected)
 
 
+@implementer(interfaces.IProducer, interfaces.IConsumer)
+class StripedConnection:
+    """I make several negotiated Connections look like a single one. Records
+    are dealt out to them in turn, and read back from them in the same order,
+    so each connection gets its own TCP congestion window."""
+
+    def __init__(self, streams):
+        self._streams = streams
+        self._next_send = 0
+        self._next_receive = 0
+        self._producer = None
+        self._registered = []
+
+    def describe(self):
+        return "%s, %d streams" % (self._streams[0].describe(),
+                                   len(self._streams))
+
+    def send_record(self, record):
+        stream = self._streams[self._next_send % len(self._streams)]
+        self._next_send += 1
+        stream.send_record(record)
+
+    def receive_record(self):
+        stream = self._streams[self._next_receive % len(self._streams)]
+        self._next_receive += 1
+        return stream.receive_record()
+
+    def close(self):
+        for stream in self._streams:
+            stream.close()
+
+    # IConsumer methods, for outbound flow-control. A pull producer (like
+    # FileSender) is only asked for more when a transport drains its buffer,
+    # so it must be registered with every stream, or the ones that don't
+    # have it would stall.
+    def registerProducer(self, producer, streaming):
+        self._producer = producer
+        for stream in self._streams:
+            self._registered.append(stream)
+            stream.registerProducer(producer, streaming)
+            if self._producer is not producer:
+                break  # it finished while we were registering it
+
+    def unregisterProducer(self):
+        self._producer = None
+        registered, self._registered = self._registered, []
+        for stream in registered:
+            stream.unregisterProducer()
+
+    def write(self, data):
+        self.send_record(data)
+
+    # IProducer methods, for inbound flow-control.
+    def stopProducing(self):
+        for stream in self._streams:
+            stream.stopProducing()
+
+    def pauseProducing(self):
+        for stream in self._streams:
+            stream.pauseProducing()
+
+    def resumeProducing(self):
+        for stream in self._streams:
+            stream.resumeProducing()
+
+    @inlineCallbacks
+    def connectConsumer(self, consumer, expected):
+        # like Connection.connectConsumer, but 'expected' is required
+        consumer.registerProducer(self, True)
+        written = 0
+        if expected == 0:
+            consumer.write(b"")
+        while written < expected:
+            record = yield self.receive_record()
+            consumer.write(record)
+            written += len(record)
+        consumer.unregisterProducer()
+        returnValue(written)
+
+    def writeToFile(self, f, expected, progress=None, hasher=None):
+        fc = FileConsumer(f, progress, hasher)
+        return self.connectConsumer(fc, expected)
+
+
+def build_stream_record(index, count):
+    return b"stream %d of %d" % (index, count)
+
+
+def parse_stream_record(record):
+    words = record.split(b" ")
+    if len(words) != 4 or words[0] != b"stream" or words[2] != b"of":
+        raise TransitError("bad stream record %r" % (record, ))
+    index, count = int(words[1]), int(words[3])
+    if not 0 <= index < count <= MAX_STREAMS:
+        raise TransitError("bad stream record %r" % (record, ))
+    return index, count
+
+
 class OutboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
 
@@ -424,12 +561,21 @@ class OutboundConnectionFactory(protocol.ClientFactory):
 
 class InboundConnectionFactory(protocol.ClientFactory):
     protocol = Connection
+    # Strangers (port scanners, say) can connect to our listener too, so
+    # only this many connections may be negotiating at once. To make room
+    # for a new one, we drop the oldest one that hasn't sent us anything
+    # yet, or failing that, the oldest one that hasn't finished its
+    # handshake: our peer sends the whole handshake right away, so it only
+    # takes a round trip, while a stranger can't finish it at all.
+    MAX_PENDING = 10
 
     def __init__(self, owner):
         self.owner = owner
         self.start = time.time()
         self._inbound_d = defer.Deferred(self._cancel)
-        self._pending_connections = set()
+        self._pending_connections = OrderedDict()  # Deferred -> Connection
+        # connections we turned away, by reason
+        self.rejected = {"busy": 0, "idle": 0, "bad-handshake": 0}
 
     def whenDone(self):
         return self._inbound_d
@@ -450,26 +596,50 @@ class InboundConnectionFactory(protocol.ClientFactory):
         return "<-%r" % addr
 
     def buildProtocol(self, addr):
+        if (len(self._pending_connections) >= self.MAX_PENDING and
+                not self._drop_idle()):
+            # they've all spoken, so this one can't be more important
+            self.rejected["busy"] += 1
+            return None  # Twisted closes it right away
         p = self.protocol(self.owner, None, self.start,
                           self._describePeer(addr))
         p.factory = self
         return p
 
+    def _drop_idle(self):
+        negotiating = [(d, p) for (d, p) in self._pending_connections.items()
+                       if p.state == "handshake"]
+        silent = [(d, p) for (d, p) in negotiating if not p.buf]
+        victims = silent or negotiating
+        if not victims:
+            return False
+        d, p = victims[0]
+        self.rejected["idle"] += 1
+        d.cancel()  # that fires _remove
+        return True
+
     def connectionWasMade(self, p):
         d = p.startNegotiation()
-        self._pending_connections.add(d)
+        self._pending_connections[d] = p
         d.addBoth(self._remove, d)
         d.addCallbacks(self._proto_succeeded, self._proto_failed)
 
     def _remove(self, res, d):
-        self._pending_connections.remove(d)
+        del self._pending_connections[d]
         return res
 
     def _proto_succeeded(self, p):
+        if self._inbound_d.called:
+            # we won, and were kept listening for the other streams of a
+            # striped transfer
+            self.owner._add_stream(p)
+            return
         self._shutdown()
         self._inbound_d.callback(p)
 
     def _proto_failed(self, f):
+        if f.check(HandshakeMismatch):
+            self.rejected["bad-handshake"] += 1
         # ignore these two, let Twisted log everything else
         f.trap(BadHandshake, defer.CancelledError)
 
@@ -516,11 +686,26 @@ class _ThereCanBeOnlyOne:
 
     def run(self):
         for d in list(self._remaining):
-            d.addBoth(self._remove, d)
-            d.addCallbacks(self._succeeded, self._failed)
-            d.addCallback(self._maybe_done)
+            self._watch(d)
         return self._winner_d
 
+    def add(self, d):
+        # a late contender joins the race, which must still be running
+        assert not self._fired
+        self._remaining.add(d)
+        self._watch(d)
+
+    def no_more(self, f):
+        # we were waiting for late contenders, and none are coming
+        if not self._remaining and not self._fired:
+            self._fired = True
+            self._winner_d.errback(f)
+
+    def _watch(self, d):
+        d.addBoth(self._remove, d)
+        d.addCallbacks(self._succeeded, self._failed)
+        d.addCallback(self._maybe_done)
+
     def _remove(self, res, d):
         self._remaining.remove(d)
         return res
@@ -551,8 +736,168 @@ def there_can_be_only_one(contenders):
     return _ThereCanBeOnlyOne(contenders).run()
 
 
+class _Failover:
+    """Start groups of connection attempts, one group at a time. Each group
+    is started 'delay' seconds after the previous one, or on the next
+    reactor turn once every attempt in the most recently started group has
+    failed (fast failover). Each attempt is represented by a contender
+    Deferred, which can be handed to there_can_be_only_one() before the
+    attempt is actually started. Groups can be added while the race is
+    running. Call stop() when the race is over.
+    """
+
+    def __init__(self, reactor, delay):
+        self._reactor = reactor
+        self._delay = delay
+        self._waiting = deque()  # stages that have not been started yet
+        self._current = None  # the stage we started most recently
+        self._timer = None
+        self._stopped = False
+        # while our peer has more hints on the way, don't assume the race
+        # is lost just because nothing is running
+        self.waiting_for_hints = False
+
+    def start_stage(self, starters):
+        # each starter is a no-argument callable that returns a Deferred
+        stage = _Stage(self, starters)
+        self._current = stage
+        if self._waiting and not self._timer:
+            self._schedule(self._delay)
+        stage.start()
+        return stage.contenders
+
+    def add_stage(self, starters):
+        stage = _Stage(self, starters)
+        self._waiting.append(stage)
+        if not self._timer and not self._stopped:
+            self._schedule(0 if self._idle() else self._delay)
+        return stage.contenders
+
+    def hurry(self):
+        if self._timer and self._timer.active() and self._idle():
+            self._timer.reset(0)
+
+    def stop(self, res=None):
+        self._stopped = True
+        if self._timer and self._timer.active():
+            self._timer.cancel()
+        self._timer = None
+        return res
+
+    def _idle(self):
+        if self.waiting_for_hints:
+            return False
+        return self._current is None or self._current.all_failed()
+
+    def _schedule(self, delay):
+        self._timer = self._reactor.callLater(delay, self._start_next)
+
+    def _start_next(self):
+        self._timer = None
+        stage = self._waiting.popleft()
+        self._current = stage
+        if self._waiting:
+            self._schedule(self._delay)
+        stage.start()
+
+    def _stage_failed(self, stage):
+        if stage is self._current:
+            self.hurry()
+
+
+class _Stage:
+    def __init__(self, failover, starters):
+        self._failover = failover
+        self._failures = 0
+        self.contenders = []
+        for start in starters:
+            d = defer.Deferred()
+            d.addCallback(lambda _, start=start: start())
+            d.addErrback(self._failed)
+            self.contenders.append(d)
+
+    def start(self):
+        for d in self.contenders:
+            if not d.called:  # it might have been cancelled already
+                d.callback(None)
+
+    def all_failed(self):
+        return self._failures == len(self.contenders)
+
+    def _failed(self, f):
+        # a cancelled attempt has lost the race: that's no reason to hurry
+        if not f.check(defer.CancelledError, error.ConnectingCancelledError):
+            self._failures += 1
+            if self.all_failed():
+                self._failover._stage_failed(self)
+        return f
+
+
+class _Staggered:
+    """Happy Eyeballs (RFC 8305): give connection attempts their turn one at
+    a time, 'delay' seconds apart, but move on to the next one right away if
+    the current one fails. wrap() turns a starter into one that waits for its
+    turn."""
+
+    def __init__(self, reactor, delay):
+        self._reactor = reactor
+        self._delay = delay
+        self._queue = deque()  # Deferreds waiting for their turn
+        self._timer = None
+        self._started = False
+
+    def wrap(self, start):
+        def _start():
+            d = defer.Deferred(self._cancel)
+            self._queue.append(d)
+            if not self._started:
+                self._started = True
+                self._next_turn()
+            elif not self._timer:
+                self._timer = self._reactor.callLater(self._delay,
+                                                      self._next_turn)
+            d.addCallback(lambda _: start())
+            d.addErrback(self._failed)
+            return d
+
+        return _start
+
+    def _cancel(self, d):
+        self._queue.remove(d)
+        if not self._queue and self._timer and self._timer.active():
+            self._timer.cancel()
+            self._timer = None
+
+    def _next_turn(self):
+        self._timer = None
+        if self._queue:
+            self._queue.popleft().callback(None)
+        if self._queue:
+            self._timer = self._reactor.callLater(self._delay,
+                                                  self._next_turn)
+
+    def _failed(self, f):
+        if not f.check(defer.CancelledError, error.ConnectingCancelledError):
+            if self._timer and self._timer.active():
+                self._timer.reset(0)
+        return f
+
+
 class Common:
     RELAY_DELAY = 2.0
+    # When our peer gives us both IPv6 and IPv4 direct hints, we start them
+    # this far apart (IPv6 first), so a broken IPv6 path costs little.
+    ATTEMPT_DELAY = 0.25
+    # The sender waits this long after the first connection finishes its
+    # handshake, to see if a better one shows up. Zero means the first one
+    # wins.
+    SELECTION_WINDOW = 0.25
+    # In a striped transfer, the sender waits this long after the first
+    # connection for the others to arrive, then makes do with what it has.
+    STREAMS_WAIT = 2.0
+    # When we have several relays, we give up on timing any that take
+    # longer than this to accept a TCP connection.
+    PROBE_TIMEOUT = 2.0
     TRANSIT_KEY_LENGTH = SecretBox.KEY_SIZE
 
     def __init__(self,
@@ -560,33 +905,58 @@ class Common:
                  no_listen=False,
                  tor=None,
                  reactor=reactor,
-                 timing=None):
+                 timing=None,
+                 streams=1,
+                 listen_ports=None):
         self._side = bytes_to_hexstr(os.urandom(8))  # unicode
-        if transit_relay:
-            if not isinstance(transit_relay, type(u"")):
+        # transit_relay is one relay location, a comma-separated string of
+        # them, or a list of them
+        if isinstance(transit_relay, type(u"")):
+            transit_relay = [r for r in transit_relay.split(u",") if r]
+        elif transit_relay and not isinstance(transit_relay, (list, tuple)):
+            raise InternalError
+        self._transit_relays = []
+        for location in transit_relay or []:
+            if not isinstance(location, type(u"")):
                 raise InternalError
             # TODO: allow multiple hints for a single relay
-            relay_hint = parse_hint_argv(transit_relay)
-            relay = RelayV1Hint(hints=(relay_hint, ))
-            self._transit_relays = [relay]
-        else:
-            self._transit_relays = []
+            relay_hint = parse_hint_argv(location.strip())
+            if relay_hint:
+                self._transit_relays.append(RelayV1Hint(hints=(relay_hint, )))
+        self._probe_d = None
         self._their_direct_hints = []  # hintobjs
         self._our_relay_hints = set(self._transit_relays)
+        self._more_hints = False  # our peer will send more hints later
+        self._race = None  # (_ThereCanBeOnlyOne, _Failover) while connecting
         self._tor = tor
         self._transit_key = None
         self._no_listen = no_listen
+        self._listen_ports = listen_ports  # list of acceptable ports, or None
         self._waiting_for_transit_key = []
         self._listener = None
+        self._listener_d = None
+        self._unix_listener = None
+        self._same_host = False  # our peer said it runs on this host
         self._winner = None
+        self._candidates = []
+        self._selection_timer = None
+        self._hint_priorities = {}  # description -> hint priority
+        self._streams = max(1, min(streams, MAX_STREAMS))
+        self._endpoints = {}  # description -> (endpoint, is_relay)
+        self._extra_streams = []
+        self._extra_go = 0
+        self._accepting_streams = False
+        self._streams_d = None
+        self._listening_ports = []
         self._reactor = reactor
-        self._timing = timing or DebugTiming()
+        self._timing = timing or NullTiming()
         self._timing.add("transit")
 
     def _build_listener(self):
         if self._no_listen or self._tor:
             return ([], None)
-        portnum = allocate_tcp_port()
+        # a port-forwarded or firewalled host can choose which port we use
+        portnum = ipaddrs.choose_listen_port(self._listen_ports)
         addresses = ipaddrs.find_addresses()
         non_loopback_addresses = [a for a in addresses if a != "127.0.0.1"]
         if non_loopback_addresses:
@@ -596,11 +966,32 @@ class Common:
         direct_hints = [
             DirectTCPV1Hint(six.u(addr), portnum, 0.0) for addr in addresses
         ]
-        ep = endpoints.serverFromString(reactor, "tcp:%d" % portnum)
+        # listen on IPv6 too, if we can, since some networks have no IPv4
+        ep = ipaddrs.DualStackServerEndpoint(reactor, portnum)
         return direct_hints, ep
 
+    def _can_listen_unix(self):
+        return (not self._no_listen and not self._tor and
+                interfaces.IReactorUNIX.providedBy(reactor))
+
+    def _build_unix_listener(self):
+        # A peer on the same host can skip the TCP stack. The socket goes in
+        # a fresh directory under $TMPDIR, so containers that share a volume
+        # can find it by pointing TMPDIR there.
+        if not (self._same_host and self._can_listen_unix()):
+            return ([], None)
+        self._unix_dir = tempfile.mkdtemp(prefix="wormhole-")
+        path = os.path.join(self._unix_dir, "transit")
+        unix_hints = [UnixV1Hint(six.u(path), 1.0)]
+        ep = endpoints.UNIXServerEndpoint(reactor, path)
+        return unix_hints, ep
+
+    def set_streams(self, streams):
+        # our peer may want fewer streams than we offered
+        self._streams = max(1, min(self._streams, streams))
+
     def get_connection_abilities(self):
-        return [
+        abilities = [
             {
                 u"type": u"direct-tcp-v1"
             },
@@ -608,18 +999,43 @@ class Common:
                 u"type": u"relay-v1"
             },
         ]
+        if self._can_listen_unix():
+            abilities.append({
+                u"type": u"unix-v1",
+                u"host": six.u(ipaddrs.find_host_id()),
+            })
+        return abilities
+
+    def add_connection_abilities(self, abilities):
+        # If our peer is on this host, our direct hints will include a Unix
+        # socket. Call this before get_connection_hints().
+        for a in abilities:
+            if (a.get(u"type") == u"unix-v1" and self._can_listen_unix() and
+                    a.get(u"host") == six.u(ipaddrs.find_host_id())):
+                self._same_host = True
 
     @inlineCallbacks
     def get_connection_hints(self):
+        # time our relays while the listener starts up
+        probed = self.probe_relays()
+        hints = yield self.get_direct_connection_hints()
+        yield probed
+        returnValue(hints + self.get_relay_connection_hints())
+
+    # These two return the same hints as get_connection_hints(), split up
+    # so the relay hints (which are available right away) can be sent
+    # before the direct hints (which must wait for the listener).
+
+    @inlineCallbacks
+    def get_direct_connection_hints(self):
         hints = []
         direct_hints = yield self._get_direct_hints()
         for dh in direct_hints:
-            hints.append({
-                u"type": u"direct-tcp-v1",
-                u"priority": dh.priority,
-                u"hostname": dh.hostname,
-                u"port": dh.port,  # integer
-            })
+            hints.append(encode_hint(dh))
+        returnValue(hints)
+
+    def get_relay_connection_hints(self):
+        hints = []
         for relay in self._transit_relays:
             rhint = {u"type": u"relay-v1", u"hints": []}
             for rh in relay.hints:
@@ -630,7 +1046,83 @@ class Common:
                     u"port": rh.port
                 })
             hints.append(rhint)
-        returnValue(hints)
+        return hints
+
+    def probe_relays(self):
+        """With more than one relay, time a TCP connection to each of them,
+        and re-prioritize their hints so the closest one is advertised (and
+        tried) first. Returns a Deferred that fires with None when that is
+        done. get_connection_hints() does this for you; call it yourself
+        before get_relay_connection_hints()."""
+        if self._probe_d is None:
+            self._probe_d = self._probe_relays()
+        return self._probe_d
+
+    @inlineCallbacks
+    def _probe_relays(self):
+        if len(self._transit_relays) < 2 or self._tor:
+            return
+        probes = []
+        for relay in self._transit_relays:
+            ds = [self._probe_hint(hint_obj) for hint_obj in relay.hints]
+            probes.append(defer.DeferredList(ds, consumeErrors=True))
+        results = yield defer.gatherResults(probes)
+        rtts = []
+        for result in results:
+            times = [rtt for (ok, rtt) in result if ok]
+            rtts.append(min(times) if times else None)
+        self._rank_relays(rtts)
+
+    def _probe_hint(self, hint_obj):
+        # The relay protocol has no ping, so we measure how long the TCP
+        # connection takes, then hang up before saying anything.
+        description = describe_hint_obj(hint_obj, True, None)
+        ev = self._timing.add("transit relay probe", relay=description)
+        ep = endpoint_from_hint_obj(hint_obj, None, self._reactor)
+        if not ep:
+            ev.finish(error="unusable hint")
+            return defer.fail(TransitError("unusable hint"))
+        start = self._reactor.seconds()
+        d = ep.connect(protocol.Factory.forProtocol(protocol.Protocol))
+
+        def _connected(p):
+            rtt = self._reactor.seconds() - start
+            p.transport.loseConnection()
+            ev.finish(rtt=rtt)
+            return rtt
+
+        def _failed(f):
+            ev.finish(error=f.getErrorMessage())
+            return f
+
+        d.addCallbacks(_connected, _failed)
+        return self._not_forever(self.PROBE_TIMEOUT, d)
+
+    def _rank_relays(self, rtts):
+        # Relays that share a priority are spread out below it, fastest
+        # first and unreachable ones last, without crossing into the next
+        # lower priority. So a priority= from the user still wins.
+        relays = self._transit_relays
+        base = [max(h.priority for h in relay.hints) for relay in relays]
+        levels = sorted(set(base), reverse=True)
+        ranked = []
+        for i, p in enumerate(levels):
+            gap = p - levels[i + 1] if i + 1 < len(levels) else 1.0
+            group = [j for j in range(len(relays)) if base[j] == p]
+            group.sort(key=lambda j: (rtts[j] is None, rtts[j] or 0))
+            for k, j in enumerate(group):
+                priority = p - k * gap / len(group)
+                hints = tuple(h._replace(priority=priority)
+                              for h in relays[j].hints)
+                ranked.append((relays[j], RelayV1Hint(hints=hints), rtts[j]))
+        self._transit_relays = [new for (old, new, rtt) in ranked]
+        self._our_relay_hints.difference_update(old for (old, new, rtt)
+                                                in ranked)
+        self._our_relay_hints.update(self._transit_relays)
+        log.msg("transit relays by RTT: %s" % ", ".join(
+            "%s=%s" % (describe_hint_obj(new.hints[0], True, None),
+                       "%.3fs" % rtt if rtt is not None else "failed")
+            for (old, new, rtt) in ranked))
 
     def _get_direct_hints(self):
         if self._listener:
@@ -648,19 +1140,37 @@ class Common:
         if self._listener is None:  # don't listen
             self._listener_d = None
             return defer.succeed(self._my_direct_hints)  # empty
+        unix_hints, self._unix_listener = self._build_unix_listener()
+        self._my_direct_hints = unix_hints + self._my_direct_hints
 
         # Start the server, so it will be running by the time anyone tries to
         # connect to the direct hints we return.
         f = InboundConnectionFactory(self)
         self._listener_f = f  # for tests # XX move to __init__ ?
         self._listener_d = f.whenDone()
+        # note whether we won, before a race that is already running
+        # swallows the result
+        won = []
+        self._listener_d.addCallback(lambda p: won.append(p) or p)
+        if self._race:
+            # we started connecting before sending our direct hints
+            self._race[0].add(self._listener_d)
         d = self._listener.listen(f)
+        if self._unix_listener:
+            # both listeners feed the same factory, so they race as one
+            d = defer.gatherResults([d, self._unix_listener.listen(f)], True)
+        else:
+            d.addCallback(lambda lp: [lp])
 
-        def _listening(lp):
-            # lp is an IListeningPort
-            # self._listener_port = lp # for tests
+        def _listening(lps):
+            # lps are IListeningPorts
             def _stop_listening(res):
-                lp.stopListening()
+                if self._streams > 1 and won:
+                    # we won, so our peer will connect here again for the
+                    # other streams
+                    self._listening_ports = lps
+                    return res
+                self._close_ports(lps)
                 return res
 
             self._listener_d.addBoth(_stop_listening)
@@ -669,6 +1179,20 @@ class Common:
         d.addCallback(_listening)
         return d
 
+    def _close_ports(self, ports):
+        rejected = self._listener_f.rejected
+        if any(rejected.values()):
+            log.msg("transit listener turned away: %s" % ", ".join(
+                "%d %s" % (rejected[k], k) for k in sorted(rejected)))
+            self._timing.add("transit listener", rejected=dict(rejected))
+        d = defer.gatherResults(
+            [defer.maybeDeferred(lp.stopListening) for lp in ports])
+        if self._unix_listener:
+            # the port removes the socket itself once it has closed
+            d.addCallback(
+                lambda _: shutil.rmtree(self._unix_dir, ignore_errors=True))
+        d.addErrback(log.err)
+
     def _stop_listening(self):
         # this is for unit tests. The usual control flow (via connect())
         # wires the listener's Deferred into a there_can_be_only_one(), which
@@ -677,13 +1201,24 @@ class Common:
         self._listener_d.addErrback(lambda f: None)
         self._listener_d.cancel()
 
-    def add_connection_hints(self, hints):
+    def add_connection_hints(self, hints, more=False):
+        # This may be called again with hints that our peer discovered
+        # later. Pass more=True if our peer has said it will do that. If we
+        # are already connecting, the new hints join the race right away.
+        new_direct = []
+        new_relays = []
         for h in hints:  # hint structs
             hint_type = h.get(u"type", u"")
             if hint_type in [u"direct-tcp-v1", u"tor-tcp-v1"]:
                 dh = parse_tcp_v1_hint(h)
                 if dh:
                     self._their_direct_hints.append(dh)  # hint_obj
+                    new_direct.append(dh)
+            elif hint_type == u"unix-v1":
+                dh = parse_unix_v1_hint(h)
+                if dh:
+                    self._their_direct_hints.append(dh)
+                    new_direct.append(dh)
             elif hint_type == u"relay-v1":
                 # TODO: each relay-v1 clause describes a different relay,
                 # with a set of equally-valid ways to connect to it. Treat
@@ -696,9 +1231,14 @@ class Common:
                         relay_hints.append(h)
                 if relay_hints:
                     rh = RelayV1Hint(hints=tuple(sorted(relay_hints)))
-                    self._our_relay_hints.add(rh)
+                    if rh not in self._our_relay_hints:
+                        self._our_relay_hints.add(rh)
+                        new_relays.append(rh)
             else:
                 log.msg("unknown hint type: %r" % (h, ))
+        self._more_hints = more
+        if self._race:
+            self._join_race(new_direct, new_relays)
 
     def _send_this(self):
         assert self._transit_key
@@ -770,66 +1310,128 @@ class Common:
             # connections, so those connections will know what to say when
             # they connect
             winner = yield self._connect()
+            if self._streams > 1:
+                winner = yield self._connect_streams(winner)
         returnValue(winner)
 
     def _connect(self):
-        # It might be nice to wire this so that a failure in the direct hints
-        # causes the relay hints to be used right away (fast failover). But
-        # none of our current use cases would take advantage of that: if we
-        # have any viable direct hints, then they're either going to succeed
-        # quickly or hang for a long time.
         contenders = []
         if self._listener_d:
             contenders.append(self._listener_d)
-        relay_delay = 0
+        failover = _Failover(self._reactor, self.RELAY_DELAY)
+        failover.waiting_for_hints = self._more_hints
 
-        for hint_obj in self._their_direct_hints:
-            # Check the hint type to see if we can support it (e.g. skip
-            # onion hints on a non-Tor client). Do not increase relay_delay
-            # unless we have at least one viable hint.
-            ep = endpoint_from_hint_obj(hint_obj, self._tor, self._reactor)
-            if not ep:
-                continue
-            d = self._start_connector(ep,
-                                      describe_hint_obj(hint_obj, False, self._tor))
-            contenders.append(d)
-            relay_delay = self.RELAY_DELAY
+        # Check the hint type to see if we can support it (e.g. skip onion
+        # hints on a non-Tor client). Do not delay the relays unless we have
+        # at least one viable hint, or our peer has more on the way.
+        direct = self._direct_starters(self._their_direct_hints)
+        if direct:
+            contenders.extend(failover.start_stage(direct))
 
         # Start trying the relays a few seconds after we start to try the
         # direct hints. The idea is to prefer direct connections, but not be
         # afraid of using a relay when we have direct hints that don't
         # resolve quickly. Many direct hints will be to unused local-network
         # IP addresses, which won't answer, and would take the full TCP
-        # timeout (30s or more) to fail.
+        # timeout (30s or more) to fail. But if all the direct hints fail
+        # quickly (e.g. "connection refused"), there's nothing left to wait
+        # for, so the relays are started right away (fast failover). The
+        # same applies between relay priorities.
+        for relays in self._relay_stages(self._our_relay_hints):
+            contenders.extend(failover.add_stage(relays))
+
+        if not contenders and not self._expecting_contenders():
+            raise TransitError("No contenders for connection")
+
+        highlander = _ThereCanBeOnlyOne(contenders)
+        self._race = (highlander, failover)
+        winner = highlander.run()
+        winner.addBoth(self._race_over)
+        return self._not_forever(2 * TIMEOUT, winner)
 
+    def _join_race(self, direct_hints, relay_hints):
+        # hints that arrive while we're connecting become late contenders
+        highlander, failover = self._race
+        direct = self._direct_starters(direct_hints)
+        if direct:
+            for d in failover.start_stage(direct):
+                highlander.add(d)
+        for relays in self._relay_stages(relay_hints):
+            for d in failover.add_stage(relays):
+                highlander.add(d)
+        failover.waiting_for_hints = self._more_hints
+        failover.hurry()
+        if not self._expecting_contenders():
+            highlander.no_more(TransitError("No contenders for connection"))
+
+    def _expecting_contenders(self):
+        # Our peer may have more hints on the way, or (when our relay hints
+        # went out first) our own listener may not have started yet. Either
+        # will join the race when it arrives.
+        return self._more_hints or (not self._no_listen and not self._tor
+                                    and self._listener is None)
+
+    def _race_over(self, res):
+        _, failover = self._race
+        self._race = None
+        failover.stop()
+        return self._stop_selection(res)
+
+    def _direct_starters(self, hint_objs):
+        starters = []
+        usable = []
+        for hint_obj in hint_objs:
+            ep = endpoint_from_hint_obj(hint_obj, self._tor, self._reactor)
+            if not ep:
+                continue
+            usable.append((hint_obj, ep))
+        # when the peer offers both IPv6 and IPv4 addresses, interleave them
+        # and give each attempt a head start over the next (happy eyeballs).
+        # Unix-domain hints are never held back.
+        tcp = [h for (h, ep) in usable if isinstance(h, DirectTCPV1Hint)]
+        staggered = None
+        if len(set(is_ipv6_hint(h) for h in tcp)) > 1:
+            staggered = _Staggered(self._reactor, self.ATTEMPT_DELAY)
+            eps = dict(usable)
+            usable = ([(h, ep) for (h, ep) in usable if h not in tcp] +
+                      [(h, eps[h]) for h in happy_eyeballs_order(tcp)])
+        for hint_obj, ep in usable:
+            description = describe_hint_obj(hint_obj, False, self._tor)
+            self._hint_priorities[description] = hint_obj.priority
+            starter = self._make_starter(ep, description)
+            if staggered and isinstance(hint_obj, DirectTCPV1Hint):
+                starter = staggered.wrap(starter)
+            starters.append(starter)
+        return starters
+
+    def _relay_stages(self, relay_hints):
+        # one list of starters per relay priority, best first
         prioritized_relays = {}
-        for rh in self._our_relay_hints:
+        for rh in relay_hints:
             for hint_obj in rh.hints:
                 priority = hint_obj.priority
                 if priority not in prioritized_relays:
                     prioritized_relays[priority] = set()
                 prioritized_relays[priority].add(hint_obj)
 
+        stages = []
         for priority in sorted(prioritized_relays, reverse=True):
+            relays = []
             for hint_obj in prioritized_relays[priority]:
                 ep = endpoint_from_hint_obj(hint_obj, self._tor, self._reactor)
                 if not ep:
                     continue
-                d = task.deferLater(
-                    self._reactor,
-                    relay_delay,
-                    self._start_connector,
-                    ep,
-                    describe_hint_obj(hint_obj, True, self._tor),
-                    is_relay=True)
-                contenders.append(d)
-            relay_delay += self.RELAY_DELAY
-
-        if not contenders:
-            raise TransitError("No contenders for connection")
-
-        winner = there_can_be_only_one(contenders)
-        return self._not_forever(2 * TIMEOUT, winner)
+                description = describe_hint_obj(hint_obj, True, self._tor)
+                self._hint_priorities[description] = hint_obj.priority
+                relays.append(self._make_starter(ep, description,
+                                                 is_relay=True))
+            if relays:
+                stages.append(relays)
+        return stages
+
+    def _make_starter(self, ep, description, is_relay=False):
+        return lambda: self._start_connector(ep, description,
+                                             is_relay=is_relay)
 
     def _not_forever(self, timeout, d):
         """If the timer fires first, cancel the deferred. If the deferred fires
@@ -852,6 +1454,7 @@ class Common:
         if is_relay:
             assert self._transit_key
             relay_handshake = self._build_relay_handshake()
+        self._endpoints[description] = (ep, is_relay)
         f = OutboundConnectionFactory(self, relay_handshake, description)
         d = ep.connect(f)
         # fires with protocol, or ConnectError
@@ -864,14 +1467,187 @@ class Common:
         # ones lose and get a "nevermind" before being closed.
 
         if not self.is_sender:
+            if self._streams > 1:
+                # the sender numbers the streams, and this one will learn
+                # its number from the first record
+                p.stream = None
             return "wait-for-decision"
 
         if self._winner:
+            if (self._accepting_streams and
+                    self._extra_go < self._streams - 1 and
+                    self._same_path(p, self._winner)):
+                # one of the other streams of a striped transfer
+                self._extra_go += 1
+                return "go"
             # we already have a winner, so this one loses
             return "nevermind"
-        # this one wins!
-        self._winner = p
-        return "go"
+        if not self.SELECTION_WINDOW:
+            # this one wins!
+            self._winner = p
+            return "go"
+        # The first connection to finish its handshake might be a congested
+        # relay, while a LAN connection is just a moment behind. So gather
+        # candidates for a little while, then pick the best.
+        self._candidates.append(p)
+        if not self._selection_timer:
+            self._selection_timer = self._reactor.callLater(
+                self.SELECTION_WINDOW, self._select_winner)
+        return "deciding"
+
+    def _score(self, p):
+        # prefer direct connections over relayed ones, then higher hint
+        # priorities, then faster handshakes
+        is_direct = p.relay_handshake is None
+        priority = self._hint_priorities.get(p.describe(), 0.0)
+        return (is_direct, priority, -p.handshake_rtt)
+
+    def _select_winner(self):
+        self._selection_timer = None
+        candidates = [p for p in self._candidates if p.state == "deciding"]
+        self._candidates = []
+        if not candidates:
+            return  # they all went away, so the next one starts over
+        winner = max(candidates, key=self._score)
+        self._winner = winner
+        for p in candidates:
+            if p is not winner:
+                p.select(False)
+        winner.select(True)
+
+    def _stop_selection(self, res):
+        if self._selection_timer and self._selection_timer.active():
+            self._selection_timer.cancel()
+        self._selection_timer = None
+        return res
+
+    # Striping: once both sides have a winner, whichever side made the
+    # winning connection makes the other streams the same way (for a relay,
+    # both sides do). The sender numbers them and tells the receiver with a
+    # control record on each stream.
+
+    @inlineCallbacks
+    def _connect_streams(self, winner):
+        attempts = []
+        self._accepting_streams = True
+        self._streams_d = defer.Deferred()
+        if isinstance(winner.factory, OutboundConnectionFactory):
+            ep, is_relay = self._endpoints[winner.describe()]
+
+            def _start(_=None):
+                if (len(attempts) >= self._streams - 1 or
+                        not self._accepting_streams):
+                    return
+                d = self._start_connector(ep, winner.describe(), is_relay)
+                d.addCallback(self._add_stream)
+                d.addErrback(lambda f: None)  # we make do with fewer
+                attempts.append(d)
+                if is_relay:
+                    # the relay drops the other waiting connections for our
+                    # token when it pairs one up, so take turns
+                    d.addCallback(_start)
+
+            for i in range(1 if is_relay else self._streams - 1):
+                _start()
+        try:
+            if self.is_sender:
+                self._maybe_enough_streams()
+                d = self._not_forever(self.STREAMS_WAIT, self._streams_d)
+                d.addErrback(lambda f: f.trap(defer.CancelledError))
+                yield d
+                self._accepting_streams = False
+                streams = [winner] + self._extra_streams
+                for i, p in enumerate(streams):
+                    p.stream = i
+                    p.send_record(build_stream_record(i, len(streams)))
+                # the receiver says whether it got them all, or wants to
+                # make do with just the first
+                record = yield winner.receive_record()
+                _, count = parse_stream_record(record)
+                if count == 1:
+                    for p in streams[1:]:
+                        p.close()
+                    streams = [winner]
+                elif count != len(streams):
+                    for p in streams:
+                        p.close()
+                    raise TransitError("bad stream record %r" % (record, ))
+            else:
+                # the sender's winner might reach us after one of the other
+                # streams, so it isn't necessarily stream 0
+                record = yield winner.receive_record()
+                _, count = parse_stream_record(record)
+                self._streams = count
+                self._maybe_enough_streams()
+                # The sender has all of them, but one might have been lost
+                # on the way (or reached us too early), so don't wait long.
+                d = self._not_forever(self.STREAMS_WAIT, self._streams_d)
+                d.addErrback(lambda f: f.trap(defer.CancelledError))
+                yield d
+                self._accepting_streams = False
+                extra = self._extra_streams[:count - 1]
+                for p in self._extra_streams[count - 1:]:
+                    p.close()
+                streams = [winner]
+                for p in extra:
+                    try:
+                        # the sender closes any it didn't number
+                        record = yield p.receive_record()
+                    except error.ConnectionClosed:
+                        continue
+                    if parse_stream_record(record)[1] != count:
+                        raise TransitError("bad stream record %r" %
+                                           (record, ))
+                    streams.append(p)
+                streams.sort(key=lambda p: p.stream)
+                numbers = [p.stream for p in streams]
+                if numbers != list(range(count)):
+                    if numbers[0] != 0 or len(set(numbers)) != len(numbers):
+                        for p in streams:
+                            p.close()
+                        raise TransitError("bad stream numbers")
+                    # fall back to the sender's winner alone
+                    for p in streams[1:]:
+                        p.close()
+                    streams = streams[:1]
+                winner = streams[0]
+                winner.send_record(build_stream_record(0, len(streams)))
+        finally:
+            self._accepting_streams = False
+            for d in attempts:
+                d.cancel()
+            if self._listening_ports:
+                self._close_ports(self._listening_ports)
+                self._listening_ports = []
+                self._listener_f._shutdown()
+        if len(streams) == 1:
+            returnValue(winner)
+        returnValue(StripedConnection(streams))
+
+    def _same_path(self, p, winner):
+        # The other streams are made the same way as the winner. A late
+        # contender from the original race (e.g. the IPv4 attempt that
+        # happy eyeballs held back) may finish its handshake now too, but
+        # our peer has already given up on it.
+        if isinstance(winner.factory, OutboundConnectionFactory):
+            return p.describe() == winner.describe()
+        # inbound: they must reach the same listener, at the same address
+        if p.factory is not winner.factory:
+            return False
+        return (getattr(p.transport.getHost(), "host", None) ==
+                getattr(winner.transport.getHost(), "host", None))
+
+    def _add_stream(self, p):
+        if not self._accepting_streams:
+            p.close()
+            return
+        self._extra_streams.append(p)
+        self._maybe_enough_streams()
+
+    def _maybe_enough_streams(self):
+        if (len(self._extra_streams) >= self._streams - 1 and
+                not self._streams_d.called):
+            self._streams_d.callback(None)
 
 
 class TransitSender(Common):
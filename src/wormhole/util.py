@@ -1,10 +1,13 @@
 # No unicode_literals
-import json
+import hashlib
 import os
 import unicodedata
+from base64 import b64decode, b64encode
 from binascii import hexlify, unhexlify
 from hkdf import Hkdf
 
+from . import _json
+
 
 def HKDF(skm, outlen, salt=None, CTXinfo=b""):
     return Hkdf(salt, skm).expand(CTXinfo, outlen)
@@ -31,20 +34,58 @@ def hexstr_to_bytes(hexstr):
     return b
 
 
+def bytes_to_b64str(b):
+    assert isinstance(b, type(b""))
+    b64str = b64encode(b).decode("ascii")
+    assert isinstance(b64str, type(u""))
+    return b64str
+
+
+def b64str_to_bytes(b64str):
+    assert isinstance(b64str, type(u""))
+    b = b64decode(b64str.encode("ascii"))
+    assert isinstance(b, type(b""))
+    return b
+
+
 def dict_to_bytes(d):
     assert isinstance(d, dict)
-    b = json.dumps(d).encode("utf-8")
+    b = _json.dumps(d).encode("utf-8")
     assert isinstance(b, type(b""))
     return b
 
 
 def bytes_to_dict(b):
     assert isinstance(b, type(b""))
-    d = json.loads(b.decode("utf-8"))
+    d = _json.loads(b)
     assert isinstance(d, dict)
     return d
 
 
+def sha256_file(fn, blocksize=64 * 1024):
+    # returns the hex SHA256 digest of a file's contents
+    hasher = hashlib.sha256()
+    with open(fn, "rb") as f:
+        while True:
+            data = f.read(blocksize)
+            if not data:
+                break
+            hasher.update(data)
+    return hasher.hexdigest()
+
+
+def sha256_tree(entries):
+    # 'entries' is an iterable of (relpath, hexdigest) pairs, one per file,
+    # with relpath using "/" as the separator regardless of platform. The
+    # result only depends upon the names and contents of the files, not on
+    # the order they were visited or on any zipfile metadata.
+    hasher = hashlib.sha256()
+    for (relpath, hexdigest) in sorted(entries):
+        hasher.update(relpath.encode("utf-8") + b"\0" +
+                      hexdigest.encode("ascii") + b"\n")
+    return hasher.hexdigest()
+
+
 def estimate_free_space(target):
     # f_bfree is the blocks available to a root user. It might be more
     # accurate to use f_bavail (blocks available to non-root user), but we
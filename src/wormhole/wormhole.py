@@ -8,7 +8,7 @@ from twisted.python import failure
 from twisted.internet.task import Cooperator
 from zope.interface import implementer
 
-from ._boss import Boss
+from ._boss import CHUNK_VERSIONS, Boss
 from ._dilation.manager import DILATION_VERSIONS
 from ._dilation.connector import Connector
 from ._interfaces import IDeferredWormhole, IWormhole
@@ -17,8 +17,8 @@ from .errors import NoKeyError, WormholeClosed
 from .eventual import EventualQueue
 from .journal import ImmediateJournal
 from .observer import OneShotObserver, SequenceObserver
-from .timing import DebugTiming
-from .util import bytes_to_hexstr, to_bytes
+from .timing import NullTiming
+from .util import bytes_to_hexstr, hexstr_to_bytes, to_bytes
 from ._version import get_versions
 
 __version__ = get_versions()['version']
@@ -68,11 +68,12 @@ class _DelegatedWormhole(object):
     def set_code(self, code):
         self._boss.set_code(code)
 
-    # def serialize(self):
-    #     s = {"serialized_wormhole_version": 1,
-    #          "boss": self._boss.serialize(),
-    #          }
-    #     return s
+    def serialize(self):
+        s = {"serialized_wormhole_version": 1,
+             "key": bytes_to_hexstr(self._key) if self._key else None,
+             "boss": self._boss.serialize(),
+             }
+        return s
 
     def send_message(self, plaintext):
         self._boss.send(plaintext)
@@ -193,10 +194,12 @@ class _DeferredWormhole(object):
             raise NoKeyError()
         return derive_key(self._key, to_bytes(purpose), length)
 
-    def dilate(self, transit_relay_location=None, no_listen=False):
+    def dilate(self, transit_relay_location=None, no_listen=False,
+               listen_ports=None):
         if not self._enable_dilate:
             raise NotImplementedError
-        return self._boss.dilate(transit_relay_location, no_listen)  # fires with (endpoints)
+        return self._boss.dilate(transit_relay_location, no_listen,
+                                 listen_ports)  # fires with (endpoints)
 
     def close(self):
         # fails with WormholeError unless we established a connection
@@ -264,9 +267,11 @@ def create(
         tor=None,
         timing=None,
         stderr=sys.stderr,
+        retry_policy=None,
+        rendezvous_pool=None,
         _eventual_queue=None,
         _enable_dilate=False):
-    timing = timing or DebugTiming()
+    timing = timing or NullTiming()
     side = bytes_to_hexstr(os.urandom(5))
     journal = journal or ImmediateJournal()
     eq = _eventual_queue or EventualQueue(reactor)
@@ -282,27 +287,44 @@ def create(
     }
     if not _enable_dilate:
         wormhole_versions = {} # don't advertise Dilation yet: not ready
+    wormhole_versions["can-chunk"] = CHUNK_VERSIONS
     wormhole_versions["app_versions"] = versions  # app-specific capabilities
     v = __version__
     if isinstance(v, type(b"")):
         v = v.decode("utf-8", errors="replace")
     client_version = ("python", v)
     b = Boss(w, side, relay_url, appid, wormhole_versions, client_version,
-             reactor, eq, cooperator, journal, tor, timing)
+             reactor, eq, cooperator, journal, tor, timing,
+             retry_policy=retry_policy, rendezvous_pool=rendezvous_pool)
     w._set_boss(b)
     b.start()
     return w
 
 
-# def from_serialized(serialized, reactor, delegate,
-#                     journal=None, tor=None,
-#                     timing=None, stderr=sys.stderr):
-#     assert serialized["serialized_wormhole_version"] == 1
-#     timing = timing or DebugTiming()
-#     w = _DelegatedWormhole(delegate)
-#     # now unpack state machines, including the SPAKE2 in Key
-#     b = Boss.from_serialized(w, serialized["boss"], reactor, journal, timing)
-#     w._set_boss(b)
-#     b.start() # ??
-#     raise NotImplemented
-#     # should the new Wormhole call got_code? only if it wasn't called before.
+def from_serialized(serialized,
+                    reactor,
+                    delegate,
+                    journal=None,
+                    tor=None,
+                    timing=None,
+                    stderr=sys.stderr,
+                    retry_policy=None,
+                    rendezvous_pool=None,
+                    _eventual_queue=None):
+    if serialized.get("serialized_wormhole_version") != 1:
+        raise ValueError("unknown serialized wormhole version")
+    timing = timing or NullTiming()
+    journal = journal or ImmediateJournal()
+    eq = _eventual_queue or EventualQueue(reactor)
+    cooperator = Cooperator(scheduler=eq.eventually)
+    w = _DelegatedWormhole(delegate)
+    if serialized["key"] is not None:
+        w._key = hexstr_to_bytes(serialized["key"])
+    # the delegate already heard about the code, key, and verifier before we
+    # were serialized, so the restored wormhole only reports what's new
+    b = Boss.from_serialized(w, serialized["boss"], reactor, eq, cooperator,
+                             journal, tor, timing, retry_policy=retry_policy,
+                             rendezvous_pool=rendezvous_pool)
+    w._set_boss(b)
+    b.start()
+    return w